@@ -1,4 +1,9 @@
+from functools import partial
+import os
+from typing import Dict, List
+
 import pandas as pd
+import yaml
 
 from wikidata_parser import WikidataParser
 from refs_html_collection import HTMLFetcher
@@ -7,58 +12,334 @@ from claim_entailment import ClaimEntailmentChecker
 from utils.textual_entailment_module import TextualEntailmentModule
 from utils.sentence_retrieval_module import SentenceRetrievalModule
 from utils.verbalisation_module import VerbModule
+from utils.score_cache import ScoreCache, VerbalisationCache
+from utils.bi_encoder_module import BiEncoderPreRanker
+from utils.cpu_threads import apply_tuning, configure_threads, tune_models
+from utils.staged_models import StageModels
+from utils.stage_spans import TaskSpans
+from utils.logger import logger
 
-def initialize_models():
-    """Initialize all required models once"""
-    text_entailment = TextualEntailmentModule()
-    sentence_retrieval = SentenceRetrievalModule(max_len=512)
-    verb_module = VerbModule()
-    return text_entailment, sentence_retrieval, verb_module
+def load_config(config_path: str = 'config.yaml') -> dict:
+    with open(config_path, 'r') as file:
+        return resolve_cache_paths(yaml.safe_load(file) or {}, config_path)
 
-def process_entity(qid: str, models: tuple) -> tuple:
+def resolve_cache_paths(config: dict, config_path: str) -> dict:
     """
-    Process a single entity with pre-loaded models
+    Resolve relative cache paths against the directory of the config file, so that the API and
+    the service share the same cache files wherever they are launched from
     """
-    text_entailment, sentence_retrieval, verb_module = models
-    
+    config_dir = os.path.dirname(os.path.abspath(config_path))
+    for section in ('score_cache', 'verbalisation_cache'):
+        cache_config = config.get(section)
+        if isinstance(cache_config, dict):
+            cache_config['path'] = os.path.join(config_dir, cache_config.get('path', 'score_cache.db'))
+    return config
+
+def initialize_score_cache(config: dict):
+    """Open the score cache shared by the cross-encoders, if enabled"""
+    cache_config = config.get('score_cache', {})
+    if not cache_config.get('enabled', False):
+        return None
+    return ScoreCache(
+        path=cache_config.get('path', 'score_cache.db'),
+        memory_items=cache_config.get('memory_items', 100000)
+    )
+
+def initialize_verbalisation_cache(config: dict):
+    """Open the persistent verbalisation store, if enabled"""
+    cache_config = config.get('verbalisation_cache', {})
+    if not cache_config.get('enabled', False):
+        return None
+    return VerbalisationCache(
+        path=cache_config.get('path', 'score_cache.db'),
+        memory_items=cache_config.get('memory_items', 100000)
+    )
+
+def initialize_pre_ranker(config: dict):
+    """Load the distilled bi-encoder pre-ranker, if enabled"""
+    pre_ranking_config = config.get('pre_ranking', {})
+    if not pre_ranking_config.get('enabled', False):
+        return None
+    return BiEncoderPreRanker(
+        model_path=pre_ranking_config['model_path'],
+        index_dir=pre_ranking_config['index_dir'],
+        top_n=pre_ranking_config.get('top_n', 30),
+        batch_size=pre_ranking_config.get('batch_size', 64)
+    )
+
+def quantised_models_dir(config: dict):
+    """Directory of the pre-quantised int8 models, if enabled"""
+    quantisation_config = config.get('quantisation', {})
+    if not quantisation_config.get('enabled', False):
+        return None
+    return quantisation_config['dir']
+
+def safetensors_models_dir(config: dict):
+    """Directory of the memory-mapped safetensors models, if enabled"""
+    safetensors_config = config.get('safetensors', {})
+    if not safetensors_config.get('enabled', False):
+        return None
+    return safetensors_config['dir']
+
+def initialize_models(config_path: str = 'config.yaml'):
+    """Initialize all required models once, or connect to the shared inference server"""
+    config = load_config(config_path)
+    server_config = config.get('inference_server', {})
+    if server_config.get('enabled', False):
+        from utils.inference_server import connect_models
+        return connect_models(config)
+    return load_models(config)
+
+def cross_encoder_backend(config: dict) -> dict:
+    """Backend arguments shared by the two cross-encoders"""
+    cross_encoders_config = config.get('cross_encoders', {})
+    return {
+        'backend': cross_encoders_config.get('backend', 'pytorch'),
+        'onnx_dir': cross_encoders_config.get('onnx_dir'),
+        'intra_op_threads': cross_encoders_config.get('intra_op_threads', 0),
+        'inter_op_threads': cross_encoders_config.get('inter_op_threads', 0),
+    }
+
+def load_text_entailment(config: dict, score_cache=None):
+    """Load the textual entailment cross-encoder"""
+    return TextualEntailmentModule(
+        score_cache=score_cache, quantised_dir=quantised_models_dir(config),
+        safetensors_dir=safetensors_models_dir(config), **cross_encoder_backend(config)
+    )
+
+def load_sentence_retrieval(config: dict, score_cache=None):
+    """Load the sentence retrieval cross-encoder with its optional pre-ranker"""
+    return SentenceRetrievalModule(
+        max_len=512, score_cache=score_cache, pre_ranker=initialize_pre_ranker(config),
+        quantised_dir=quantised_models_dir(config), safetensors_dir=safetensors_models_dir(config),
+        **cross_encoder_backend(config)
+    )
+
+def load_verb_module(config: dict, verbalisation_cache=None):
+    """Load the verbalisation model"""
+    verbalisation_config = config.get('verbalisation', {})
+    return VerbModule(
+        verbalisation_cache=verbalisation_cache,
+        batch_size=verbalisation_config.get('batch_size', 32),
+        token_budget=verbalisation_config.get('token_size'),
+        backend=verbalisation_config.get('backend', 'pytorch'),
+        onnx_dir=verbalisation_config.get('onnx_dir'),
+        intra_op_threads=verbalisation_config.get('intra_op_threads', 0),
+        inter_op_threads=verbalisation_config.get('inter_op_threads', 0),
+        quantised_dir=quantised_models_dir(config),
+        safetensors_dir=safetensors_models_dir(config)
+    )
+
+def load_models(config: dict):
+    """Load the retrieval, entailment and verbalisation models in this process"""
+    if config.get('workers', {}).get('processes', 1) <= 1:
+        # With forked workers, each of them applies its own share after the fork
+        configure_threads(config)
+    score_cache = initialize_score_cache(config)
+    text_entailment = load_text_entailment(config, score_cache)
+    sentence_retrieval = load_sentence_retrieval(config, score_cache)
+    verb_module = load_verb_module(config, initialize_verbalisation_cache(config))
+    models = (text_entailment, sentence_retrieval, verb_module)
+    if config.get('threads', {}).get('tune', False):
+        apply_tuning(models, tune_models(models, config), config)
+    return models
+
+def prepare_entity(qid: str) -> Dict:
+    """
+    Network-bound part of process_entity: parse the entity, fetch and split its references and
+    label its claims. No model is involved, so it can run ahead of the inference in another thread.
+
+    Returns:
+        Dict: qid, parser_stats, the stage spans and, for entities with fetched references,
+            html_df, sentences_df and claims. Entities that end before the models have their final
+            results in 'result'.
+    """
+    spans = TaskSpans()
+
     # Get URLs and claims
     parser = WikidataParser()
-    parser_result = parser.process_entity(qid)
+    with spans.span('parsing') as span:
+        parser_result = parser.process_entity(qid)
+        span.count('claims', len(parser_result.get('claims', ())))
+        span.count('urls', len(parser_result.get('urls', ())))
     parser_stats = parser.get_processing_stats()
-    
+    parser_stats['stages'] = spans.stages
+    prepared = {'qid': qid, 'parser_stats': parser_stats, 'spans': spans}
+
     # Check if URLs exist
     if 'urls' not in parser_result or parser_result['urls'].empty:
         # Return empty DataFrames and parser stats
-        empty_df = pd.DataFrame()
-        empty_results = pd.DataFrame()
-        return empty_df, empty_results, parser_stats
-    
-    # Initialize processors with pre-loaded models
-    selector = EvidenceSelector(sentence_retrieval=sentence_retrieval, 
-                              verb_module=verb_module)
-    checker = ClaimEntailmentChecker(text_entailment=text_entailment)
-    
+        prepared['result'] = (pd.DataFrame(), pd.DataFrame(), parser_stats)
+        return prepared
+
     # Fetch HTML content
     fetcher = HTMLFetcher(config_path='config.yaml')
-    html_df = fetcher.fetch_all_html(parser_result['urls'], parser_result)
-    
+    with spans.span('fetching') as span:
+        html_df = fetcher.fetch_all_html(parser_result['urls'], parser_result)
+        span.count('urls', len(html_df))
+        span.add_bytes(sum(
+            len(html.encode('utf-8')) for html in html_df.loc[html_df['status'] == 200, 'html']
+            if isinstance(html, str)
+        ))
+    prepared['html_df'] = html_df
+
     # Check if there are any successful (status 200) URLs
     if not (html_df['status'] == 200).any():
         # Return current html_df with failed fetches, empty results and parser stats
-        empty_results = pd.DataFrame()
-        return html_df, empty_results, parser_stats
-    
+        prepared['result'] = (html_df, pd.DataFrame(), parser_stats)
+        return prepared
+
     # Convert HTML to sentences
     processor = HTMLSentenceProcessor()
-    sentences_df = processor.process_html_to_sentences(html_df)
-    
+    with spans.span('extraction') as span:
+        prepared['sentences_df'] = processor.process_html_to_sentences(html_df)
+        span.count('sentences', sum(map(len, prepared['sentences_df']['nlp_sentences'])))
+
+    # Get relevant claims with references and their labels
+    selector = EvidenceSelector(load_models=False)
+    with spans.span('label_sparql') as span:
+        prepared['claims'] = selector.get_relevant_claims(
+            prepared['sentences_df'], parser_result['claims'], parser_result['claims_refs']
+        )
+        span.count('claims', len(prepared['claims']))
+    return prepared
+
+def _verbalisation_stage(prepared: Dict, selector: EvidenceSelector) -> None:
+    with prepared['spans'].span('verbalisation') as span:
+        prepared['claims'] = selector.verbalize_claims(prepared['claims'])
+        span.count('claims', len(prepared['claims']))
+
+def _retrieval_stage(prepared: Dict, selector: EvidenceSelector) -> None:
+    with prepared['spans'].span('retrieval') as span:
+        prepared['evidence_df'] = selector.select_relevant_sentences(prepared['claims'], prepared['sentences_df'])
+        span.count('pairs', selector.scored_pairs)
+        span.count('sentences', len(prepared['evidence_df']))
+
+def _entailment_stage(prepared: Dict, checker: ClaimEntailmentChecker) -> None:
+    with prepared['spans'].span('entailment') as span:
+        span.count('pairs', len(prepared['evidence_df']))
+        entailment_results = checker.process_entailment(
+            prepared['evidence_df'], prepared['html_df'], prepared['qid']
+        )
+    prepared['result'] = (prepared['html_df'], entailment_results, prepared['parser_stats'])
+
+def process_prepared_entity(prepared: Dict, models: tuple) -> tuple:
+    """
+    Model-bound part of process_entity, on the output of prepare_entity
+    """
+    if 'result' in prepared:
+        return prepared['result']
+    text_entailment, sentence_retrieval, verb_module = models
+    parser_stats = prepared['parser_stats']
+
+    # Initialize processors with pre-loaded models
+    selector = EvidenceSelector(sentence_retrieval=sentence_retrieval,
+                              verb_module=verb_module)
+    checker = ClaimEntailmentChecker(text_entailment=text_entailment)
+
     # Process evidence selection
-    evidence_df = selector.process_evidence(sentences_df, parser_result)
-    
+    _verbalisation_stage(prepared, selector)
+    _retrieval_stage(prepared, selector)
+
     # Check entailment with metadata
-    entailment_results = checker.process_entailment(evidence_df, html_df, qid)
-    
-    return html_df, entailment_results, parser_stats
+    _entailment_stage(prepared, checker)
+
+    # Export cumulative cache hit rates with the task statistics
+    if text_entailment.score_cache is not None:
+        parser_stats['score_cache'] = text_entailment.score_cache.metrics()
+    if verb_module.verbalisation_cache is not None:
+        parser_stats['verbalisation_cache'] = verb_module.verbalisation_cache.metrics()
+
+    return prepared['result']
+
+def process_entity(qid: str, models: tuple) -> tuple:
+    """
+    Process a single entity with pre-loaded models
+    """
+    return process_prepared_entity(prepare_entity(qid), models)
+
+def initialize_stage_models(config: dict) -> StageModels:
+    """Loaders of the low-memory profile: each model is loaded by the stage that uses it, the caches stay open"""
+    configure_threads(config)
+    if config.get('threads', {}).get('tune', False):
+        logger.warning("threads.tune needs all the models loaded at once, the low_memory profile ignores it")
+    score_cache = initialize_score_cache(config)
+    return StageModels({
+        'verbalisation': partial(load_verb_module, config, initialize_verbalisation_cache(config)),
+        'retrieval': partial(load_sentence_retrieval, config, score_cache),
+        'entailment': partial(load_text_entailment, config, score_cache),
+    })
+
+def process_entities_staged(qids: List[str], stage_models: StageModels) -> List:
+    """
+    Process a batch of entities stage by stage, loading each model once for the whole batch.
+
+    Every entity gets the results process_entity would give it. An entity that fails skips the
+    stages after the failure and gets its exception instead, without stopping the others.
+
+    Args:
+        qids (List[str]): Entities of the batch.
+        stage_models (StageModels): From initialize_stage_models.
+
+    Returns:
+        List: (html_df, entailment_results, parser_stats) or the exception of each entity, in
+            the order of qids.
+    """
+    tasks = [{'qid': qid} for qid in qids]
+    selector = EvidenceSelector(load_models=False)
+
+    def for_each_task(stage, function):
+        # Tasks that are finished or failed are left out of the later stages
+        for task in tasks:
+            if 'result' in task:
+                continue
+            try:
+                function(task)
+            except Exception as e:
+                logger.error(f"Stage {stage} failed for {task['qid']}: {e}")
+                # Without its traceback, the exception does not keep the model of the stage alive
+                task['result'] = e.with_traceback(None)
+
+    def fetch(task):
+        task.update(prepare_entity(task['qid']))
+
+    def verbalise(verb_module):
+        selector.verb_module = verb_module
+        try:
+            for_each_task('verbalisation', lambda task: _verbalisation_stage(task, selector))
+        finally:
+            selector.verb_module = None
+        if verb_module.verbalisation_cache is not None:
+            for task in tasks:
+                if 'result' not in task:
+                    task['parser_stats']['verbalisation_cache'] = verb_module.verbalisation_cache.metrics()
+
+    def retrieve(sentence_retrieval):
+        selector.sentence_retrieval = sentence_retrieval
+        try:
+            for_each_task('retrieval', lambda task: _retrieval_stage(task, selector))
+        finally:
+            selector.sentence_retrieval = None
+
+    def check(text_entailment):
+        checker = ClaimEntailmentChecker(text_entailment=text_entailment)
+
+        def entail(task):
+            _entailment_stage(task, checker)
+            if text_entailment.score_cache is not None:
+                task['parser_stats']['score_cache'] = text_entailment.score_cache.metrics()
+
+        for_each_task('entailment', entail)
+
+    stage_models.run('fetch', lambda _: for_each_task('fetch', fetch))
+    stage_models.run('verbalisation', verbalise)
+    stage_models.run('retrieval', retrieve)
+    stage_models.run('entailment', check)
+
+    for task in tasks:
+        if not isinstance(task['result'], Exception):
+            task['result'][2]['stage_peak_rss'] = dict(stage_models.peaks)
+    return [task['result'] for task in tasks]
 
 if __name__ == "__main__":
     # Initialize models once
@@ -1,13 +1,16 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 import time
 from threading import Lock
-from typing import List, Dict, Any, Union
+from typing import List, Dict, Any, Optional, Tuple, Union
 import requests
 import signal
 import sys
 import uuid
 
 import nltk
+import pandas as pd
 from pymongo import collection
 import schedule
 from torch.nn import Module
@@ -22,6 +25,7 @@ from utils.logger import logger
 from utils.mongo_handler import MongoDBHandler
 from utils.local_secrets import ENDPOINT, API_KEY
 from utils.auth import AsyncAuth
+from utils.stage_spans import TaskSpans, serve_metrics
 
 
 try:
@@ -47,6 +51,12 @@ class ProVeService:
         task_lock (Lock): A threading lock to ensure thread-safe operations.
         mongo_handler (MongoDBHandler): An instance of MongoDBHandler for database operations.
         models (List[Module]): A list of initialized models for processing tasks.
+        stage_models (StageModels): Loaders of the models of the low-memory profile, None with
+            the models kept loaded.
+        batch_entities (int): Tasks processed together by the low-memory profile.
+        worker_index (int): Index of a forked worker, 0 in a single process.
+        look_ahead (int): Tasks the pipelined profile parses and fetches ahead of the one in
+            inference, 0 without it.
         priority_queue (collection): The priority queue collection in MongoDB.
         secondary_queue (List[collection]): A list of secondary queue collections in MongoDB.
 
@@ -64,9 +74,18 @@ class ProVeService:
         self.task_lock = Lock()
         self.setup_signal_handlers()
         self.models: List[Module] = None
+        self.stage_models = None
+        self.batch_entities = 1
+        workers_config = self.config.get('workers', {})
+        self.look_ahead = 0
+        self.io_pool = None
+        self.pipeline = deque()
+        if workers_config.get('profile', 'default') == 'pipelined':
+            self.look_ahead = max(1, workers_config.get('look_ahead', 2))
         self.priority_queue = priority_queue
         self.secondary_queue = secondary_queue or []
         self.uuid = uuid.uuid4()
+        self.worker_index = 0
 
         # Schedule settings
         schedule.every().day.at("02:00").do(self.run_top_viewed_items)
@@ -87,7 +106,7 @@ class ProVeService:
         try:
             with open(config_path, 'r') as file:
                 config = yaml.safe_load(file)
-            return config
+            return ProVe_main_process.resolve_cache_paths(config or {}, config_path)
         except Exception as e:
             logger.error(f"Error loading config file: {e}")
             return {}
@@ -189,6 +208,55 @@ class ProVeService:
                     return False
                 time.sleep(5)
 
+    def start_task(self, status_dict: Dict[str, Any]) -> None:
+        """Record a task taken from a queue in the status collection."""
+        self.mongo_handler.ensure_connection()
+        self.mongo_handler.save_status(status_dict)
+        logger.info("Saved new status_dict into status")
+
+    def finish_task(
+        self,
+        status_dict: Dict[str, Any],
+        html_df: pd.DataFrame,
+        entailment_results: pd.DataFrame,
+        parser_stats: Dict[str, Any]
+    ) -> None:
+        """Save the results of a task and mark it completed."""
+        qid = status_dict['qid']
+        task_id = status_dict['task_id']
+
+        html_df['task_id'] = task_id
+        entailment_results['task_id'] = task_id
+        parser_stats['task_id'] = task_id
+
+        # Added to the stage breakdown of the task, which is saved with parser_stats afterwards
+        spans = TaskSpans(parser_stats.setdefault('stages', {}))
+        with spans.span('mongo_writes') as span:
+            self.mongo_handler.save_html_content(html_df)
+            self.mongo_handler.save_entailment_results(entailment_results)
+            span.count('documents', len(html_df) + len(entailment_results))
+        self.mongo_handler.save_parser_stats(parser_stats)
+
+        status_dict['status'] = 'completed'
+        status_dict['completed_timestamp'] = datetime.utcnow().strftime(
+            '%Y-%m-%dT%H:%M:%S.%f'
+        )
+        self.mongo_handler.save_status(status_dict)
+        logger.info("Updated new status_dict into status")
+        try:
+            from functions import get_summary
+            get_summary(qid, update=True)
+        except Exception:
+            logger.error(f"Could not update summary for {qid}.")
+            logger.error("Process will continue to keep application consistent")
+
+    def fail_task(self, status_dict: Dict[str, Any], error: Exception) -> None:
+        """Mark a task as failed with its error."""
+        logger.error(f"Error processing task {status_dict.get('task_id')}: {error}")
+        status_dict['status'] = 'error'
+        status_dict['error_message'] = str(error)
+        self.mongo_handler.save_status(status_dict)
+
     def main_loop(self, status_dict: Dict[str, Any]) -> None:
         """
         Main processing loop for handling tasks.
@@ -199,43 +267,65 @@ class ProVeService:
         """
         with self.task_lock:
             try:
-                self.mongo_handler.ensure_connection()
-                self.mongo_handler.save_status(status_dict)
-                logger.info("Saved new status_dict into status")
-
-                qid = status_dict['qid']
-                task_id = status_dict['task_id']
-
+                self.start_task(status_dict)
                 html_df, entailment_results, parser_stats = ProVe_main_process.process_entity(
-                    qid, self.models
+                    status_dict['qid'], self.models
                 )
+                self.finish_task(status_dict, html_df, entailment_results, parser_stats)
+            except Exception as e:
+                self.fail_task(status_dict, e)
 
-                html_df['task_id'] = task_id
-                entailment_results['task_id'] = task_id
-                parser_stats['task_id'] = task_id
-
-                self.mongo_handler.save_html_content(html_df)
-                self.mongo_handler.save_entailment_results(entailment_results)
-                self.mongo_handler.save_parser_stats(parser_stats)
+    def main_loop_prepared(self, status_dict: Dict[str, Any], prepared: Future) -> None:
+        """
+        Run the models on a task of the pipelined profile, whose parsing and fetching ran ahead.
 
-                status_dict['status'] = 'completed'
-                status_dict['completed_timestamp'] = datetime.utcnow().strftime(
-                    '%Y-%m-%dT%H:%M:%S.%f'
+        Args:
+            status_dict (Dict[str, Any]): A dictionary containing the status of the task,
+                including 'qid' and 'task_id'.
+            prepared (Future): The ProVe_main_process.prepare_entity call of the task.
+        """
+        with self.task_lock:
+            try:
+                html_df, entailment_results, parser_stats = ProVe_main_process.process_prepared_entity(
+                    prepared.result(), self.models
                 )
-                self.mongo_handler.save_status(status_dict)
-                logger.info("Updated new status_dict into status")
+                self.finish_task(status_dict, html_df, entailment_results, parser_stats)
+            except Exception as e:
+                self.fail_task(status_dict, e)
+
+    def main_loop_staged(self, status_dicts: List[Dict[str, Any]]) -> None:
+        """
+        Process a batch of tasks stage by stage with the models of the low-memory profile, each
+        model loaded once for the batch. Every task gets its own status, as in main_loop.
+
+        Args:
+            status_dicts (List[Dict[str, Any]]): Status of every task of the batch.
+        """
+        with self.task_lock:
+            started = []
+            for status_dict in status_dicts:
                 try:
-                    from functions import get_summary
-                    get_summary(qid, update=True)
-                except Exception:
-                    logger.error(f"Could not update summary for {qid}.")
-                    logger.error("Process will continue to keep application consistent")
+                    self.start_task(status_dict)
+                    started.append(status_dict)
+                except Exception as e:
+                    self.fail_task(status_dict, e)
 
+            try:
+                results = ProVe_main_process.process_entities_staged(
+                    [status_dict['qid'] for status_dict in started], self.stage_models
+                )
             except Exception as e:
-                logger.error(f"Error processing task {task_id}: {e}")
-                status_dict['status'] = 'error'
-                status_dict['error_message'] = str(e)
-                self.mongo_handler.save_status(status_dict)
+                for status_dict in started:
+                    self.fail_task(status_dict, e)
+                return
+
+            for status_dict, result in zip(started, results):
+                try:
+                    if isinstance(result, Exception):
+                        raise result
+                    self.finish_task(status_dict, *result)
+                except Exception as e:
+                    self.fail_task(status_dict, e)
 
     def retry_processing(self, queue: collection) -> None:
         """
@@ -272,15 +362,105 @@ class ProVeService:
 
     def run(self):
         """
-        Start the ProVe service. This method initializes the service, sets up the MongoDB
-        connection, and starts the main processing loop. It runs indefinitely until a shutdown
-        signal is received.
+        Start the ProVe service, in this process or, with workers.processes above 1 in the
+        config, in forked worker processes sharing the models loaded once.
+
+        Raises:
+            SystemExit: If the service fails to initialize resources or encounters a fatal error.
+        """
+        workers_config = self.config.get('workers', {})
+        if workers_config.get('profile', 'default') == 'low_memory':
+            self.run_low_memory(workers_config)
+        elif workers_config.get('processes', 1) > 1:
+            self.run_workers(workers_config)
+        else:
+            self.serve()
+
+    def run_low_memory(self, workers_config: Dict[str, Any]) -> None:
+        """
+        Serve with the low-memory profile: tasks are taken in batches and each model is only
+        loaded while its stage runs over the batch.
+
+        Args:
+            workers_config (Dict[str, Any]): The workers section of the config.
+
+        Raises:
+            SystemExit: If the profile is combined with settings that keep the models loaded.
+        """
+        if workers_config.get('processes', 1) > 1 or self.config.get('inference_server', {}).get('enabled', False):
+            logger.fatal("The low_memory profile runs a single worker without inference_server. Exiting...")
+            sys.exit(1)
+        self.batch_entities = max(1, workers_config.get('batch_entities', 4))
+        self.stage_models = ProVe_main_process.initialize_stage_models(self.config)
+        self.serve(load_models=False)
+
+    def run_workers(self, workers_config: Dict[str, Any]) -> None:
+        """
+        Load the models once and fork the pipeline workers, which share them copy-on-write.
+
+        Args:
+            workers_config (Dict[str, Any]): The workers section of the config.
+
+        Raises:
+            SystemExit: If the models cannot be loaded.
+        """
+        from utils.worker_supervisor import WorkerSupervisor, freeze_models
+
+        if self.config.get('inference_server', {}).get('enabled', False):
+            logger.fatal("workers.processes and inference_server cannot be combined. Exiting...")
+            sys.exit(1)
+        try:
+            logger.info("Attempting to initialize models...")
+            self.models = ProVe_main_process.initialize_models()
+            freeze_models(self.models)
+            logger.info("Models initialized successfully")
+        except Exception as e:
+            logger.fatal(f"Failed to initialize models: {e}. Exiting...")
+            sys.exit(1)
+
+        WorkerSupervisor(
+            workers_config['processes'],
+            self.run_worker,
+            restart_delay=workers_config.get('restart_delay', 5),
+            drain_timeout=workers_config.get('drain_timeout', 600),
+            memory_report_interval=workers_config.get('memory_report_interval', 600)
+        ).run()
+
+    def run_worker(self, index: int) -> None:
+        """
+        Body of a forked worker: the models come from the supervisor, the connections and the
+        queue identity are the worker's own.
+
+        Args:
+            index (int): Index of the worker, the scheduled jobs run in worker 0 only.
+        """
+        from utils.cpu_threads import configure_threads
+        from utils.worker_supervisor import reopen_caches
+
+        configure_threads(self.config, index)
+        reopen_caches(self.models)
+        self.uuid = uuid.uuid4()
+        self.worker_index = index
+        self.setup_signal_handlers()
+        if index > 0:
+            schedule.clear()
+        self.serve(load_models=False)
+
+    def serve(self, load_models: bool = True):
+        """
+        Initialize the resources and run the main processing loop until a shutdown signal is
+        received.
+
+        Args:
+            load_models (bool, optional): Loads models. Defaults to True, forked workers
+                already have them and the low-memory profile loads them per stage. With the
+                pipelined profile, the tasks already taken are finished before returning.
 
         Raises:
             SystemExit: If the service fails to initialize resources or encounters a fatal error.
         """
         try:
-            if not self.initialize_resources():
+            if not self.initialize_resources(model=load_models):
                 logger.fatal("Failed to initialize resources. Exiting...")
                 sys.exit(1)
 
@@ -289,47 +469,131 @@ class ProVeService:
                 sys.exit(1)
 
             logger.info("Service started successfully")
+            self.start_metrics_server()
 
+            if self.look_ahead:
+                self.io_pool = ThreadPoolExecutor(max_workers=self.look_ahead, thread_name_prefix='prove-io')
             while self.running:
                 try:
                     self.mongo_handler.ensure_connection()
-                    _id = self.get_next_request(self.priority_queue.name)
-                    logger.info(f"Next request {_id}")
-
-                    status_dict = {}
-                    if _id:
-                        status_dict = self.mongo_handler.get_request_by_id(self.priority_queue, _id)
-
-                    if status_dict:
-                        logger.info(f"Processing request for QID: {status_dict['qid']}")
-                        queue = self.priority_queue
-                        self.main_loop(status_dict)
-                        self.update_request(queue, status_dict, "completed")
-                    elif self.secondary_queue:
-                        for queue in self.secondary_queue:
-                            _id = self.get_next_request(queue.name)
-                            status_dict = {}
-                            if _id:
-                                status_dict = self.mongo_handler.get_request_by_id(queue, _id)
-                            logger.info(f"{_id}: {status_dict}")
-
-                            if status_dict:
-                                message = "Processing request from secondary queue for QID: "
-                                message += f"{status_dict['qid']}"
-                                logger.info(message)
-                                self.main_loop(status_dict)
-                                self.update_request(queue, status_dict, "completed")
-                                break
+                    if self.stage_models is not None:
+                        self.process_batch()
+                    elif self.look_ahead:
+                        self.process_pipelined()
+                    else:
+                        queue, status_dict = self.next_task()
+                        if status_dict:
+                            self.main_loop(status_dict)
+                            self.update_request(queue, status_dict, "completed")
 
                     schedule.run_pending()
                 except Exception as e:
                     logger.error(f"Main loop error: {str(e)}")
                     time.sleep(30)
 
+            # Tasks already taken from the queues are finished before exiting
+            while self.pipeline:
+                self.process_pipelined(take_tasks=False)
+            if self.io_pool is not None:
+                self.io_pool.shutdown()
+
         except Exception as e:
             logger.fatal(f"Fatal error in service: {str(e)}")
             sys.exit(1)
 
+    def start_metrics_server(self) -> None:
+        """
+        Expose the stage histograms of this process in the Prometheus format, if enabled. Forked
+        workers listen on the configured port plus their index.
+        """
+        metrics_config = self.config.get('metrics', {})
+        if not metrics_config.get('enabled', False):
+            return
+        port = metrics_config.get('port', 9464) + self.worker_index
+        try:
+            serve_metrics(metrics_config.get('host', '127.0.0.1'), port)
+        except OSError as e:
+            logger.error(f"Could not serve metrics on port {port}: {e}")
+
+    def next_task(self) -> Tuple[Optional[collection], Dict[str, Any]]:
+        """
+        Take the next task, from the priority queue first and then from the secondary queues in
+        order.
+
+        Returns:
+            Tuple[Optional[collection], Dict[str, Any]]: The queue of the task and its status,
+                (None, {}) when every queue is empty.
+        """
+        _id = self.get_next_request(self.priority_queue.name)
+        logger.info(f"Next request {_id}")
+
+        status_dict = {}
+        if _id:
+            status_dict = self.mongo_handler.get_request_by_id(self.priority_queue, _id)
+
+        if status_dict:
+            logger.info(f"Processing request for QID: {status_dict['qid']}")
+            return self.priority_queue, status_dict
+
+        for queue in self.secondary_queue:
+            _id = self.get_next_request(queue.name)
+            status_dict = {}
+            if _id:
+                status_dict = self.mongo_handler.get_request_by_id(queue, _id)
+            logger.info(f"{_id}: {status_dict}")
+
+            if status_dict:
+                message = "Processing request from secondary queue for QID: "
+                message += f"{status_dict['qid']}"
+                logger.info(message)
+                return queue, status_dict
+        return None, {}
+
+    def process_batch(self) -> None:
+        """Take up to batch_entities tasks from the queues and process them together stage by stage."""
+        batch = []
+        while len(batch) < self.batch_entities:
+            queue, status_dict = self.next_task()
+            if not status_dict:
+                break
+            batch.append((queue, status_dict))
+        if not batch:
+            return
+
+        logger.info(f"Processing a batch of {len(batch)} tasks stage by stage")
+        self.main_loop_staged([status_dict for _, status_dict in batch])
+        for queue, status_dict in batch:
+            self.update_request(queue, status_dict, "completed")
+
+    def process_pipelined(self, take_tasks: bool = True) -> None:
+        """
+        Keep up to look_ahead tasks parsed and fetched in the I/O threads while the models run on
+        the oldest task of the pipeline. A task is recorded in the status collection when its
+        preparation starts and completed or failed when its inference ends, in queue order.
+
+        Args:
+            take_tasks (bool, optional): Take new tasks from the queues. Defaults to True, False
+                drains the pipeline on shutdown.
+        """
+        while take_tasks and self.running and len(self.pipeline) <= self.look_ahead:
+            queue, status_dict = self.next_task()
+            if not status_dict:
+                break
+            try:
+                self.start_task(status_dict)
+            except Exception as e:
+                self.fail_task(status_dict, e)
+                self.update_request(queue, status_dict, "completed")
+                continue
+            prepared = self.io_pool.submit(ProVe_main_process.prepare_entity, status_dict['qid'])
+            self.pipeline.append((queue, status_dict, prepared))
+
+        if not self.pipeline:
+            return
+        queue, status_dict, prepared = self.pipeline.popleft()
+        self.main_loop_prepared(status_dict, prepared)
+        self.update_request(queue, status_dict, "completed")
+
     def update_request(self, queue, status_dict, status):
         logger.info(f"Updating {status_dict['qid']} for {queue.name}")
         queue.update_one(
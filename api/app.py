@@ -371,6 +371,24 @@ def process_reference():
         return jsonify({"error": "Something went wrong"}), 400
 
 
+@app.route("/api/items/processReferences", methods=["POST"])
+@swag_from(f'{PATH}/docs/process_references.yml')
+def process_references():
+    data = request.get_json(silent=True) or {}
+    pairs = data.get("references")
+
+    if not isinstance(pairs, list) or not pairs or not all(
+        isinstance(pair, dict) and pair.get("url") and pair.get("sentence") for pair in pairs
+    ):
+        return jsonify({"error": "'references' must be a list of objects with 'url' and 'sentence'"}), 400
+
+    try:
+        results = functions.process_references(pairs)
+        return jsonify({"results": results}), 200
+    except Exception:
+        return jsonify({"error": "Something went wrong"}), 400
+
+
 @app.route("/api/internal/getKey", methods=["GET"])
 def get_public_key():
     try:
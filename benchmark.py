@@ -0,0 +1,744 @@
+"""
+Benchmarks for the ProVe inference stages.
+
+Run on a worker host with the model checkpoints in place, e.g.
+
+    python benchmark.py padding --fixture fixture.json
+    python benchmark.py verbalisation --size 1024
+    python benchmark.py unk_replacer --fixture fixtures/unk_replacer_regression.json
+    python benchmark.py verbalisation_onnx --fixture triples.json
+    python benchmark.py entailment_results --size 5000
+    python benchmark.py entailment_cascade --fixture evidence.json
+    python benchmark.py premise_aggregation --fixture labelled_evidence.json
+    python benchmark.py quantisation --fixture fixture.json
+    python benchmark.py cross_encoders_onnx --fixture fixture.json
+    python benchmark.py attention --fixture fixture.json
+    python benchmark.py startup
+    python benchmark.py tokenisation --size 2000
+
+Pair fixtures are JSON lists of {"claim": ..., "sentence": ...} objects and triple fixtures
+JSON lists of {"subject": ..., "predicate": ..., "object": ...} objects. Without one, a synthetic
+set with a realistic spread of lengths is used.
+"""
+import argparse
+import json
+import multiprocessing
+import random
+import re
+import resource
+import time
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+import torch
+import yaml
+
+SEED = 42
+
+FIXTURE_CLAIMS = [
+    'Douglas Adams was born in Cambridge.',
+    'The Eiffel Tower is located in Paris.',
+    'Marie Curie received the Nobel Prize in Physics.',
+    'The Amazon river flows through Brazil.',
+]
+FIXTURE_WORDS = (
+    'the of and in to was a is for on as by with he she it at from his her that which were '
+    'born city river prize tower located award member country university published first'
+).split()
+
+
+def load_fixture(path: str = None, size: int = 512) -> List[Tuple[str, str]]:
+    """Load (claim, sentence) pairs from a JSON fixture, or build a synthetic one."""
+    if path:
+        with open(path, 'r') as file:
+            return [(item['claim'], item['sentence']) for item in json.load(file)]
+
+    rng = random.Random(SEED)
+    pairs = []
+    for _ in range(size):
+        # Most page sentences are short, a few are very long
+        n_words = min(int(rng.lognormvariate(3.0, 0.7)), 400)
+        sentence = ' '.join(rng.choice(FIXTURE_WORDS) for _ in range(max(n_words, 3))) + '.'
+        pairs.append((rng.choice(FIXTURE_CLAIMS), sentence))
+    return pairs
+
+
+def load_triples_fixture(path: str = None, size: int = 512) -> List[Dict[str, str]]:
+    """Load triples from a JSON fixture, or build a synthetic one with repeated triples."""
+    if path:
+        with open(path, 'r') as file:
+            return json.load(file)
+
+    rng = random.Random(SEED)
+    distinct = []
+    for _ in range(max(size // 4, 1)):
+        distinct.append({
+            'subject': ' '.join(rng.choice(FIXTURE_WORDS) for _ in range(rng.randint(1, 4))).title(),
+            'predicate': ' '.join(rng.choice(FIXTURE_WORDS) for _ in range(rng.randint(1, 3))),
+            'object': ' '.join(rng.choice(FIXTURE_WORDS) for _ in range(rng.randint(1, 12))).title(),
+        })
+    # A claim is verbalised once per reference, so the same triple shows up several times
+    return [rng.choice(distinct) for _ in range(size)]
+
+
+def load_config(config_path: str = 'config.yaml') -> Dict:
+    with open(config_path, 'r') as file:
+        return yaml.safe_load(file)
+
+
+def timed(function: Callable, *args, **kwargs) -> Tuple[float, object]:
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def report(name: str, n_items: int, baseline: Tuple[float, np.ndarray], new: Tuple[float, np.ndarray]):
+    baseline_time, baseline_out = baseline
+    new_time, new_out = new
+    max_diff = float(np.max(np.abs(np.asarray(baseline_out) - np.asarray(new_out))))
+    print(f'{name}:')
+    print(f'  before: {baseline_time:.2f}s ({n_items / baseline_time:.1f} items/s)')
+    print(f'  after:  {new_time:.2f}s ({n_items / new_time:.1f} items/s)')
+    print(f'  speed-up: {baseline_time / new_time:.2f}x, max abs difference: {max_diff:.2e}')
+
+
+def _run_in_child(queue, function, args):
+    duration, result = timed(function, *args)
+    queue.put((duration, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, result))
+
+
+def timed_in_fork(function: Callable, *args) -> Tuple[float, float, object]:
+    """Run function in a forked child sharing the loaded models, returning (time, peak RSS MB, result)."""
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    process = context.Process(target=_run_in_child, args=(queue, function, args))
+    process.start()
+    output = queue.get()
+    process.join()
+    return output
+
+
+def retrieval_max_length_padding(module, pairs: List[Tuple[str, str]], batch_size: int) -> np.ndarray:
+    """Previous retrieval path: every batch padded to max_len, in input order."""
+    from utils.sentence_retrieval_module import ARGS, process_sent
+
+    module.model.eval()
+    scores = []
+    for i in range(0, len(pairs), batch_size):
+        batch = [(process_sent(a), process_sent(b)) for a, b in pairs[i:i + batch_size]]
+        encodings = module.tokenizer(
+            batch,
+            padding='max_length',
+            truncation='longest_first',
+            max_length=ARGS['max_len'],
+            return_token_type_ids=True,
+            return_attention_mask=True,
+            return_tensors='pt',
+        )
+        with torch.no_grad():
+            scores.extend(module.model(
+                encodings['input_ids'], encodings['attention_mask'], encodings['token_type_ids']
+            ).tolist())
+    return np.asarray(scores)
+
+
+def entailment_max_length_padding(module, pairs: List[Tuple[str, str]], batch_size: int) -> np.ndarray:
+    """Previous entailment path: every batch padded to MAX_LEN, in input order."""
+    from utils.textual_entailment_module import MAX_LEN
+
+    module.model.eval()
+    probs = []
+    for i in range(0, len(pairs), batch_size):
+        encodings = module.tokenizer(
+            pairs[i:i + batch_size],
+            max_length=MAX_LEN,
+            return_token_type_ids=False,
+            padding='max_length',
+            truncation=True,
+            return_tensors='pt',
+        )
+        with torch.no_grad():
+            logits = module.model(
+                input_ids=encodings['input_ids'],
+                attention_mask=encodings['attention_mask']
+            ).logits
+        probs.append(torch.softmax(logits, dim=1).numpy())
+    return np.concatenate(probs)
+
+
+def benchmark_padding(args: argparse.Namespace, config: Dict):
+    """Max-length padding against length-bucketed dynamic padding for both cross-encoders."""
+    pairs = load_fixture(args.fixture, args.size)
+    from utils.sentence_retrieval_module import SentenceRetrievalModule
+    from utils.textual_entailment_module import TextualEntailmentModule
+
+    batch_size = config['evidence_selection']['batch_size']
+    token_budget = config['evidence_selection'].get('token_size')
+    # The max-length baseline cannot hold large batches of 512-token pairs in memory
+    baseline_batch_size = min(batch_size, 32)
+
+    retrieval = SentenceRetrievalModule(max_len=512)
+    report(
+        'Sentence retrieval',
+        len(pairs),
+        timed(retrieval_max_length_padding, retrieval, pairs, baseline_batch_size),
+        timed(retrieval.score_sentence_pairs, pairs, batch_size=batch_size, token_budget=token_budget),
+    )
+    del retrieval
+
+    entailment = TextualEntailmentModule()
+    claims, sentences = zip(*pairs)
+    report(
+        'Textual entailment',
+        len(pairs),
+        timed(entailment_max_length_padding, entailment, pairs, baseline_batch_size),
+        timed(entailment.get_batch_scores, claims, sentences,
+              batch_size=batch_size, token_budget=token_budget),
+    )
+
+
+def benchmark_attention(args: argparse.Namespace, config: Dict):
+    """Explicit score-matrix attention against fused scaled_dot_product_attention in the retrieval BERT."""
+    from utils.bert_model import set_attention_implementation
+    from utils.sentence_retrieval_module import SentenceRetrievalModule
+
+    pairs = load_fixture(args.fixture, args.size)
+    batch_size = config['evidence_selection']['batch_size']
+    token_budget = config['evidence_selection'].get('token_size')
+    retrieval = SentenceRetrievalModule(max_len=512)
+
+    def scores(attention_implementation, function, *function_args, **kwargs):
+        set_attention_implementation(retrieval.model, attention_implementation)
+        return timed(function, *function_args, **kwargs)
+
+    report(
+        'Sentence retrieval, length-bucketed batches (eager -> sdpa)',
+        len(pairs),
+        scores('eager', retrieval.score_sentence_pairs, pairs, batch_size=batch_size, token_budget=token_budget),
+        scores('sdpa', retrieval.score_sentence_pairs, pairs, batch_size=batch_size, token_budget=token_budget),
+    )
+    # Full 512-token batches, where the explicit path holds (batch, heads, 512, 512) scores per layer
+    baseline_batch_size = min(batch_size, 32)
+    report(
+        'Sentence retrieval, 512-token batches (eager -> sdpa)',
+        len(pairs),
+        scores('eager', retrieval_max_length_padding, retrieval, pairs, baseline_batch_size),
+        scores('sdpa', retrieval_max_length_padding, retrieval, pairs, baseline_batch_size),
+    )
+
+
+def verbalisation_single_call(module, inputs: List[str]) -> List[str]:
+    """Previous verbalisation path: one generate call over every input, duplicates included."""
+    from utils.verbalisation_module import DEVICE, MAX_LENGTH
+
+    encodings = module.tokenizer(
+        inputs, truncation=True, max_length=MAX_LENGTH, padding='longest', return_tensors='pt'
+    ).to(DEVICE)
+    module.g2t_module.model.eval()
+    with torch.no_grad():
+        module.g2t_module.model.config.decoder_start_token_id = module.tokenizer.pad_token_id
+        gen_output = module.g2t_module.model.generate(
+            input_ids=encodings['input_ids'],
+            attention_mask=encodings['attention_mask'],
+            max_length=module.g2t_module.eval_max_length,
+            num_beams=module.g2t_module.eval_beams,
+            length_penalty=1.0,
+            early_stopping=True,
+        )
+    return module.tokenizer.batch_decode(gen_output, skip_special_tokens=True)
+
+
+def benchmark_verbalisation(args: argparse.Namespace, config: Dict):
+    """Single padded generate call against deduplicated, length-sorted chunked generation."""
+    from utils.verbalisation_module import VerbModule
+
+    triples = load_triples_fixture(args.fixture, args.size)
+    verbalisation_config = config.get('verbalisation', {})
+    module = VerbModule(
+        batch_size=verbalisation_config.get('batch_size', 32),
+        token_budget=verbalisation_config.get('token_size')
+    )
+    inputs = [
+        f'translate Graph to English: <H> {t["subject"]} <R> {t["predicate"]} <T> {t["object"]}'
+        for t in triples
+    ]
+
+    # Each path runs in its own child so that peak RSS is measured separately
+    baseline_time, baseline_rss, baseline_out = timed_in_fork(verbalisation_single_call, module, inputs)
+    new_time, new_rss, new_out = timed_in_fork(module.verbalise_batch, inputs)
+
+    n_differences = sum(
+        old.strip() != new.replace('<unk>', '').strip() for old, new in zip(baseline_out, new_out)
+    )
+    print(f'Verbalisation of {len(inputs)} inputs ({len(set(inputs))} distinct):')
+    print(f'  before: {baseline_time:.2f}s ({len(inputs) / baseline_time:.1f} items/s), peak RSS {baseline_rss:.0f} MB')
+    print(f'  after:  {new_time:.2f}s ({len(inputs) / new_time:.1f} items/s), peak RSS {new_rss:.0f} MB')
+    print(f'  speed-up: {baseline_time / new_time:.2f}x, differing outputs: {n_differences}')
+
+
+def benchmark_verbalisation_onnx(args: argparse.Namespace, config: Dict):
+    """Equivalence and speed of the ONNX Runtime verbaliser against the PyTorch one."""
+    from utils.verbalisation_module import VerbModule
+
+    triples = load_triples_fixture(args.fixture, args.size)
+    verbalisation_config = config.get('verbalisation', {})
+    batching = {
+        'batch_size': verbalisation_config.get('batch_size', 32),
+        'token_budget': verbalisation_config.get('token_size'),
+    }
+
+    pytorch_module = VerbModule(backend='pytorch', **batching)
+    baseline = timed(pytorch_module.verbalise_triples, triples)
+    del pytorch_module
+
+    onnx_module = VerbModule(
+        backend='onnx',
+        onnx_dir=verbalisation_config.get('onnx_dir'),
+        intra_op_threads=verbalisation_config.get('intra_op_threads', 0),
+        inter_op_threads=verbalisation_config.get('inter_op_threads', 0),
+        **batching
+    )
+    new = timed(onnx_module.verbalise_triples, triples)
+
+    (baseline_time, baseline_out), (new_time, new_out) = baseline, new
+    mismatches = [(old, onnx) for old, onnx in zip(baseline_out, new_out) if old != onnx]
+    for old, onnx in mismatches[:10]:
+        print(f'  MISMATCH: {old!r} / {onnx!r}')
+    print(f'Verbalisation of {len(triples)} triples:')
+    print(f'  pytorch: {baseline_time:.2f}s ({len(triples) / baseline_time:.1f} items/s)')
+    print(f'  onnx:    {new_time:.2f}s ({len(triples) / new_time:.1f} items/s)')
+    print(f'  speed-up: {baseline_time / new_time:.2f}x, identical outputs: {len(triples) - len(mismatches)}/{len(triples)}')
+
+
+def benchmark_quantisation(args: argparse.Namespace, config: Dict):
+    """Accuracy and latency of the dynamic int8 models against the fp32 ones, on CPU.
+
+    The fixture holds pairs for the two cross-encoders; the verbaliser runs on synthetic triples.
+    """
+    from utils.sentence_retrieval_module import SentenceRetrievalModule
+    from utils.textual_entailment_module import TextualEntailmentModule
+    from utils.verbalisation_module import VerbModule
+
+    pairs = load_fixture(args.fixture, args.size)
+    claims, sentences = zip(*pairs)
+    quantised_dir = config['quantisation']['dir']
+    batch_size = config['evidence_selection']['batch_size']
+    token_budget = config['evidence_selection'].get('token_size')
+
+    def retrieval_scores(quantised):
+        module = SentenceRetrievalModule(max_len=512, quantised_dir=quantised_dir if quantised else None)
+        module.cuda = False
+        module.model.cpu()
+        return timed(module.score_sentence_pairs, pairs, batch_size=batch_size, token_budget=token_budget)
+
+    report('Sentence retrieval (fp32 -> int8)', len(pairs), retrieval_scores(False), retrieval_scores(True))
+
+    def entailment_scores(quantised):
+        module = TextualEntailmentModule(quantised_dir=quantised_dir if quantised else None)
+        module.device = 'cpu'
+        module.model.cpu()
+        return timed(module.get_batch_scores, claims, sentences, batch_size=batch_size, token_budget=token_budget)
+
+    fp32_entailment, int8_entailment = entailment_scores(False), entailment_scores(True)
+    report('Textual entailment (fp32 -> int8)', len(pairs), fp32_entailment, int8_entailment)
+    label_agreement = np.mean(fp32_entailment[1].argmax(axis=1) == int8_entailment[1].argmax(axis=1))
+    print(f'  label agreement: {label_agreement:.3f}')
+
+    triples = load_triples_fixture(None, max(args.size // 4, 1))
+    verbalisation_config = config.get('verbalisation', {})
+    batching = {
+        'batch_size': verbalisation_config.get('batch_size', 32),
+        'token_budget': verbalisation_config.get('token_size'),
+    }
+
+    def verbalisations(quantised):
+        module = VerbModule(quantised_dir=quantised_dir if quantised else None, **batching)
+        module.device = 'cpu'
+        module.model.cpu()
+        return timed(module.verbalise_triples, triples)
+
+    (fp32_time, fp32_out), (int8_time, int8_out) = verbalisations(False), verbalisations(True)
+    n_identical = sum(old == new for old, new in zip(fp32_out, int8_out))
+    print('Verbalisation (fp32 -> int8):')
+    print(f'  before: {fp32_time:.2f}s ({len(triples) / fp32_time:.1f} items/s)')
+    print(f'  after:  {int8_time:.2f}s ({len(triples) / int8_time:.1f} items/s)')
+    print(f'  speed-up: {fp32_time / int8_time:.2f}x, identical outputs: {n_identical}/{len(triples)}')
+
+
+def benchmark_cross_encoders_onnx(args: argparse.Namespace, config: Dict):
+    """Numerical equivalence and speed of the ONNX Runtime cross-encoders against PyTorch."""
+    from utils.onnx_cross_encoders import TOLERANCE
+    from utils.sentence_retrieval_module import SentenceRetrievalModule
+    from utils.textual_entailment_module import TextualEntailmentModule
+
+    pairs = load_fixture(args.fixture, args.size)
+    claims, sentences = zip(*pairs)
+    batch_size = config['evidence_selection']['batch_size']
+    token_budget = config['evidence_selection'].get('token_size')
+    cross_encoders_config = config.get('cross_encoders', {})
+    onnx_backend = {
+        'backend': 'onnx',
+        'onnx_dir': cross_encoders_config.get('onnx_dir'),
+        'intra_op_threads': cross_encoders_config.get('intra_op_threads', 0),
+        'inter_op_threads': cross_encoders_config.get('inter_op_threads', 0),
+    }
+
+    def retrieval_scores(backend):
+        module = SentenceRetrievalModule(max_len=512, **backend)
+        return timed(module.score_sentence_pairs, pairs, batch_size=batch_size, token_budget=token_budget)
+
+    pytorch_retrieval, onnx_retrieval = retrieval_scores({}), retrieval_scores(onnx_backend)
+    report('Sentence retrieval (pytorch -> onnx)', len(pairs), pytorch_retrieval, onnx_retrieval)
+
+    def entailment_scores(backend):
+        module = TextualEntailmentModule(**backend)
+        return timed(module.get_batch_scores, claims, sentences, batch_size=batch_size, token_budget=token_budget)
+
+    pytorch_entailment, onnx_entailment = entailment_scores({}), entailment_scores(onnx_backend)
+    report('Textual entailment (pytorch -> onnx)', len(pairs), pytorch_entailment, onnx_entailment)
+
+    equivalent = all(
+        np.max(np.abs(np.asarray(pytorch[1]) - np.asarray(onnx[1]))) <= TOLERANCE
+        for pytorch, onnx in ((pytorch_retrieval, onnx_retrieval), (pytorch_entailment, onnx_entailment))
+    )
+    print(f'Equivalent within {TOLERANCE:.0e}: {equivalent}')
+
+
+def benchmark_tokenisation(args: argparse.Namespace, config: Dict):
+    """Slow BertTokenizer pair encoding against pair encodings assembled from cached token ids.
+
+    Every claim of the fixture is paired with every sentence, as in evidence selection.
+    """
+    from transformers import BertTokenizer
+
+    from utils.pair_encoding import PairEncoder
+    from utils.sentence_retrieval_module import ARGS, process_sent
+
+    sentences = [sentence for _, sentence in load_fixture(args.fixture, args.size)]
+    claims = list(dict.fromkeys(claim for claim, _ in load_fixture(args.fixture, args.size)))
+    pairs = [(claim, sentence) for claim in claims for sentence in sentences]
+    max_length = 512
+
+    slow_tokenizer = BertTokenizer.from_pretrained(ARGS['bert_pretrain'], do_lower_case=False)
+
+    def slow_encodings():
+        processed = [(process_sent(claim), process_sent(sentence)) for claim, sentence in pairs]
+        return slow_tokenizer(
+            processed, truncation='longest_first', max_length=max_length,
+            return_token_type_ids=True, return_attention_mask=True
+        )['input_ids']
+
+    def fast_encodings():
+        from transformers import BertTokenizerFast
+
+        encoder = PairEncoder(
+            BertTokenizerFast.from_pretrained(ARGS['bert_pretrain'], do_lower_case=False), preprocess=process_sent
+        )
+        return encoder.encode(pairs, max_length)['input_ids']
+
+    (slow_time, slow_ids), (fast_time, fast_ids) = timed(slow_encodings), timed(fast_encodings)
+    print(f'Pair encoding ({len(claims)} claims x {len(sentences)} sentences):')
+    print(f'  before: {slow_time:.2f}s ({len(pairs) / slow_time:.0f} pairs/s)')
+    print(f'  after:  {fast_time:.2f}s ({len(pairs) / fast_time:.0f} pairs/s)')
+    print(f'  speed-up: {slow_time / fast_time:.2f}x, identical encodings: {slow_ids == fast_ids}')
+
+
+def benchmark_startup(args: argparse.Namespace, config: Dict):
+    """Startup time and memory of each model loaded from its checkpoint and from safetensors.
+
+    Every load runs in a fresh forked child and is followed by a few inputs, so that all weights
+    are paged in. Private memory is what a worker cannot share with the other workers of the host.
+    """
+    from utils.process_memory import process_memory
+    from utils.sentence_retrieval_module import SentenceRetrievalModule
+    from utils.textual_entailment_module import TextualEntailmentModule
+    from utils.verbalisation_module import VerbModule
+
+    safetensors_dir = config['safetensors']['dir']
+    pairs = load_fixture(args.fixture, 8)
+    claims, sentences = zip(*pairs)
+    triples = load_triples_fixture(None, 4)
+
+    def load_and_run(load, run):
+        duration, module = timed(load)
+        return duration, process_memory(), run(module)
+
+    models = {
+        'Sentence retrieval': (
+            lambda directory: SentenceRetrievalModule(max_len=512, safetensors_dir=directory),
+            lambda module: module.score_sentence_pairs(pairs),
+        ),
+        'Textual entailment': (
+            lambda directory: TextualEntailmentModule(safetensors_dir=directory),
+            lambda module: module.get_batch_scores(claims, sentences),
+        ),
+        'Verbalisation': (
+            lambda directory: VerbModule(safetensors_dir=directory),
+            lambda module: module.verbalise_triples(triples),
+        ),
+    }
+    for name, (load, run) in models.items():
+        print(f'{name} (checkpoint -> safetensors):')
+        outputs = []
+        for label, directory in (('before', None), ('after', safetensors_dir)):
+            _, peak_rss, (duration, memory, output) = timed_in_fork(load_and_run, lambda: load(directory), run)
+            outputs.append(output)
+            print(
+                f'  {label + ":":7s} {duration:.2f}s to load, RSS {memory["rss"]:.0f} MB (peak {peak_rss:.0f} MB), '
+                f'private {memory["private_dirty"]:.0f} MB'
+            )
+        print(f'  identical outputs: {np.array_equal(np.asarray(outputs[0]), np.asarray(outputs[1]))}')
+
+
+def legacy_format_results(evidence_df: pd.DataFrame) -> pd.DataFrame:
+    """Previous result formatting: one nested DataFrame per row, grown with pd.concat."""
+    all_result = pd.DataFrame()
+    for _, row in evidence_df.iterrows():
+        aResult = pd.DataFrame({
+            'sentence': [row['sentence']],
+            'Relevance_score': [row['similarity_score']],
+            'TextEntailment': [row['evidence_TE_labels'][0]],
+            'Entailment_score': [max(row['evidence_TE_prob'][0])]
+        })
+        aBox = pd.DataFrame({
+            'reference_id': [row.get('reference_id', '')],
+            'text_entailment_score': [max(row['evidence_TE_prob'][0])],
+            'similarity_score': [row['similarity_score']],
+            'processed_timestamp': [row.get('processed_timestamp')],
+            'Results': [aResult]
+        })
+        all_result = pd.concat([all_result, aBox], axis=0)
+    return all_result.reset_index(drop=True)
+
+
+def legacy_get_final_verdict(aggregated_result: pd.DataFrame) -> pd.DataFrame:
+    """Previous verdict aggregation, iterating the nested DataFrames."""
+    results = []
+    for _, row in aggregated_result.iterrows():
+        temp = row.Results
+        if 'SUPPORTS' in temp.TextEntailment.values:
+            result = 'SUPPORTS'
+        else:
+            result = temp.TextEntailment.mode()[0]
+        results.append({
+            'result': result,
+            'result_sentence': temp[temp['TextEntailment'] == result]['sentence'].iloc[0]
+        })
+    return pd.DataFrame(results, index=aggregated_result.index)
+
+
+def benchmark_entailment_results(args: argparse.Namespace, config: Dict):
+    """Result formatting and verdict aggregation on an entity with many evidence rows."""
+    from claim_entailment import ClaimEntailmentChecker
+    from utils.textual_entailment_module import TextualEntailmentModule
+
+    rng = np.random.RandomState(SEED)
+    pairs = load_fixture(args.fixture, args.size)
+    evidence_df = pd.DataFrame({
+        'claim': [claim for claim, _ in pairs],
+        'sentence': [sentence for _, sentence in pairs],
+        'similarity_score': rng.uniform(-1, 1, len(pairs)),
+        'reference_id': rng.randint(0, max(len(pairs) // 5, 1), len(pairs)),
+    })
+    probs = rng.dirichlet(np.ones(3), len(pairs)).astype(np.float32)
+
+    # Only the label helpers of the entailment module are used, so its weights are not loaded
+    checker = ClaimEntailmentChecker(
+        config_path=args.config, text_entailment=TextualEntailmentModule.__new__(TextualEntailmentModule)
+    )
+    entailment_results = checker.check_entailment(evidence_df, probs)
+
+    def legacy():
+        aggregated = legacy_format_results(entailment_results)
+        return pd.concat([aggregated, legacy_get_final_verdict(aggregated)], axis=1)
+
+    def columnar():
+        aggregated = checker.format_results(entailment_results, probs)
+        return pd.concat([aggregated, checker.get_final_verdict(aggregated)], axis=1)
+
+    baseline_time, baseline_out = timed(legacy)
+    new_time, new_out = timed(columnar)
+    columns = ['reference_id', 'text_entailment_score', 'similarity_score', 'result', 'result_sentence']
+    identical = baseline_out[columns].reset_index(drop=True).equals(new_out[columns].reset_index(drop=True))
+    print(f'Formatting and verdicts of {len(pairs)} evidence rows:')
+    print(f'  before: {baseline_time:.2f}s ({len(pairs) / baseline_time:.0f} items/s)')
+    print(f'  after:  {new_time:.3f}s ({len(pairs) / new_time:.0f} items/s)')
+    print(f'  speed-up: {baseline_time / new_time:.1f}x, identical results: {identical}')
+
+
+def load_evidence_fixture(path: str = None, size: int = 512) -> pd.DataFrame:
+    """Evidence rows {claim, sentence, similarity_score, reference_id} from a JSON fixture, or synthetic ones."""
+    if path:
+        with open(path, 'r') as file:
+            return pd.DataFrame(json.load(file))
+
+    rng = np.random.RandomState(SEED)
+    pairs = load_fixture(None, size)
+    return pd.DataFrame({
+        'claim': [claim for claim, _ in pairs],
+        'sentence': [sentence for _, sentence in pairs],
+        'similarity_score': rng.uniform(-1, 1, len(pairs)),
+        'reference_id': rng.randint(0, max(len(pairs) // 5, 1), len(pairs)),
+    })
+
+
+def benchmark_entailment_cascade(args: argparse.Namespace, config: Dict):
+    """Forward passes saved by the early-exit cascade and the claim/reference verdicts it changes."""
+    from claim_entailment import ClaimEntailmentChecker
+
+    evidence_df = load_evidence_fixture(args.fixture, args.size)
+    checker = ClaimEntailmentChecker(config_path=args.config)
+
+    forward_passes = []
+    checker.te_module.model.register_forward_hook(lambda module, inputs, output: forward_passes.append(1))
+
+    def verdicts(probs: np.ndarray, rows: np.ndarray) -> pd.Series:
+        kept = evidence_df[rows].reset_index(drop=True)
+        aggregated = checker.format_results(kept, probs[rows], checker.claim_reference_groups(kept))
+        verdict = checker.get_final_verdict(aggregated)['result']
+        return verdict.groupby([kept['claim'], kept['reference_id']]).first()
+
+    # Full scoring of every row, as without the cascade: pairs the cascade drops count as differences
+    all_rows = np.ones(len(evidence_df), dtype=bool)
+    full_time, full_probs = timed(checker.score_entailment, evidence_df)
+    full_passes, full_pairs = len(forward_passes), len(evidence_df)
+    full_verdicts = verdicts(full_probs, all_rows)
+
+    forward_passes.clear()
+    cascade_time, (cascade_probs, scored) = timed(checker.score_entailment_cascade, evidence_df)
+    # Rows kept by process_entailment in cascade mode
+    fallback = checker.unscored_pair_rows(evidence_df, scored)
+    cascade_probs[fallback] = [0, 1, 0]
+    cascade_verdicts = verdicts(cascade_probs, scored | fallback)
+
+    differences = (full_verdicts != cascade_verdicts.reindex(full_verdicts.index)).sum()
+    print(f'Entailment of {len(evidence_df)} evidence rows, {len(full_verdicts)} claim/reference pairs:')
+    print(f'  full:    {full_time:.2f}s, {full_pairs} pairs, {full_passes} forward passes')
+    print(f'  cascade: {cascade_time:.2f}s, {int(scored.sum())} pairs, {len(forward_passes)} forward passes, '
+          f'{int(fallback.sum())} claim/reference pairs without evidence above the threshold')
+    print(f'  saved forward passes: {full_passes - len(forward_passes)}, verdict differences: {differences}')
+
+
+def benchmark_premise_aggregation(args: argparse.Namespace, config: Dict):
+    """Accuracy and latency of per-sentence entailment against one concatenated premise per claim/reference.
+
+    The fixture holds evidence rows as for entailment_cascade, with the gold verdict of their
+    claim/reference pair in a "label" column. Without labels only the agreement between the two
+    modes is reported.
+    """
+    from claim_entailment import ClaimEntailmentChecker
+
+    evidence_df = load_evidence_fixture(args.fixture, args.size)
+    checker = ClaimEntailmentChecker(config_path=args.config)
+    keys = ['claim', 'reference_id']
+
+    forward_passes = []
+    checker.te_module.model.register_forward_hook(lambda module, inputs, output: forward_passes.append(1))
+
+    def per_sentence():
+        probs = checker.score_entailment(evidence_df)
+        aggregated = checker.format_results(evidence_df, probs, checker.claim_reference_groups(evidence_df))
+        verdict = checker.get_final_verdict(aggregated)['result']
+        return verdict.groupby([evidence_df['claim'], evidence_df['reference_id']]).first()
+
+    def concatenated():
+        premise_df = checker.build_premises(evidence_df)
+        probs = checker.score_entailment(premise_df)
+        return pd.Series(checker.te_module.get_labels_from_scores(probs), index=pd.MultiIndex.from_frame(premise_df[keys]))
+
+    sentence_time, sentence_verdicts = timed(per_sentence)
+    sentence_passes = len(forward_passes)
+    forward_passes.clear()
+    concatenated_time, concatenated_verdicts = timed(concatenated)
+    concatenated_verdicts = concatenated_verdicts.reindex(sentence_verdicts.index)
+
+    print(f'Entailment of {len(evidence_df)} evidence rows, {len(sentence_verdicts)} claim/reference pairs:')
+    if 'label' in evidence_df.columns:
+        gold = evidence_df.groupby(keys)['label'].first().reindex(sentence_verdicts.index)
+        sentence_accuracy = f', accuracy {(sentence_verdicts == gold).mean():.3f}'
+        concatenated_accuracy = f', accuracy {(concatenated_verdicts == gold).mean():.3f}'
+    else:
+        sentence_accuracy = concatenated_accuracy = ''
+    print(f'  per sentence: {sentence_time:.2f}s, {sentence_passes} forward passes{sentence_accuracy}')
+    print(f'  concatenated: {concatenated_time:.2f}s, {len(forward_passes)} forward passes{concatenated_accuracy}')
+    print(f'  verdict agreement: {(sentence_verdicts == concatenated_verdicts).mean():.3f}')
+
+
+def legacy_replace_unks(unknowns_list: List[Dict[str, str]], sentence: str, loop_n: int = 3) -> str:
+    """Previous <unk> replacement: one str.replace per key and label, in label order."""
+    while '<unk>' in sentence and loop_n > 0:
+        loop_n -= 1
+        for unknowns in unknowns_list:
+            for k, v in unknowns.items():
+                if k == '<unk>' and loop_n > 0:
+                    continue
+                if not k in sentence and k[0] == k[0].lower() and k[0].upper() == sentence[0]:
+                    k = k[0].upper() + k[1:]
+                    v = v[0].upper() + v[1:]
+                elif not k in sentence and len(re.findall(r'\s{2,}', k)) > 0:
+                    k = re.sub(r'\s+', ' ', k)
+                sentence = sentence.replace(k.strip(), v.strip(), 1)
+        sentence = re.sub(r'\s+', ' ', sentence).strip()
+        sentence = re.sub(r'\s([?.!",](?:\s|$))', r'\1', sentence)
+    return sentence
+
+
+def benchmark_unk_replacer(args: argparse.Namespace, config: Dict):
+    """Regression check and timing of the precompiled <unk> replacer against the previous one.
+
+    The fixture is a JSON list of {"unknowns": [...], "sentence": ..., "expected": ...} objects,
+    where unknowns holds the replacing keys of each label of a request.
+    """
+    from utils.verbalisation_module import UnkReplacer
+
+    with open(args.fixture or 'fixtures/unk_replacer_regression.json', 'r') as file:
+        cases = json.load(file)
+
+    mismatches = [
+        case for case in cases
+        if UnkReplacer.from_unknowns(case['unknowns']).replace(case['sentence']) != case['expected']
+    ]
+    for case in mismatches:
+        print(f'  MISMATCH: {case["sentence"]!r} expected {case["expected"]!r}')
+    print(f'Regression fixture: {len(cases) - len(mismatches)}/{len(cases)} cases identical')
+
+    # Whole requests: every label of the fixture in one replacer, every sentence through it
+    unknowns = [label_unknowns for case in cases for label_unknowns in case['unknowns']]
+    sentences = [case['sentence'] for case in cases] * max(args.size // len(cases), 1)
+    replacer = UnkReplacer.from_unknowns(unknowns)
+    baseline_time, baseline_out = timed(lambda: [legacy_replace_unks(unknowns, s) for s in sentences])
+    new_time, new_out = timed(lambda: [replacer.replace(s) for s in sentences])
+    n_differences = sum(old != new for old, new in zip(baseline_out, new_out))
+    print(f'Replacing over {len(sentences)} sentences with {len(unknowns)} labels:')
+    print(f'  before: {baseline_time:.3f}s ({len(sentences) / baseline_time:.0f} items/s)')
+    print(f'  after:  {new_time:.3f}s ({len(sentences) / new_time:.0f} items/s)')
+    print(f'  speed-up: {baseline_time / new_time:.2f}x, differing outputs: {n_differences}')
+
+
+BENCHMARKS = {
+    'padding': benchmark_padding,
+    'attention': benchmark_attention,
+    'verbalisation': benchmark_verbalisation,
+    'verbalisation_onnx': benchmark_verbalisation_onnx,
+    'unk_replacer': benchmark_unk_replacer,
+    'entailment_results': benchmark_entailment_results,
+    'entailment_cascade': benchmark_entailment_cascade,
+    'premise_aggregation': benchmark_premise_aggregation,
+    'quantisation': benchmark_quantisation,
+    'cross_encoders_onnx': benchmark_cross_encoders_onnx,
+    'startup': benchmark_startup,
+    'tokenisation': benchmark_tokenisation,
+}
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='ProVe inference benchmarks')
+    arg_parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    arg_parser.add_argument('--fixture', default=None, help='JSON fixture of pairs or triples')
+    arg_parser.add_argument('--size', type=int, default=512, help='Size of the synthetic fixture')
+    arg_parser.add_argument('--config', default='config.yaml')
+    args = arg_parser.parse_args()
+
+    torch.manual_seed(SEED)
+    BENCHMARKS[args.benchmark](args, load_config(args.config))
@@ -3,8 +3,7 @@ import numpy as np
 from typing import Dict, List, Tuple
 import logging
 import yaml
-from utils.textual_entailment_module import TextualEntailmentModule
-from tqdm import tqdm
+from utils.textual_entailment_module import TextualEntailmentModule, CLASSES, MAX_LEN
 from datetime import datetime
 
 from utils.logger import logger
@@ -21,129 +20,263 @@ class ClaimEntailmentChecker:
         with open(config_path, 'r') as file:
             return yaml.safe_load(file)
 
-    def check_entailment(self, evidence_df: pd.DataFrame) -> pd.DataFrame:
+    def score_entailment(self, evidence_df: pd.DataFrame) -> np.ndarray:
         """
-        Perform textual entailment checking on evidence sentences
+        Score all claim/sentence pairs together, in batches of entailment.batch_size.
+
+        Returns:
+            np.ndarray: (N, 3) probabilities in CLASSES order, one row per evidence row.
+        """
+        entailment_config = self.config.get('entailment', {})
+        return np.asarray(
+            self.te_module.get_batch_scores(
+                claims=evidence_df['claim'].tolist(),
+                evidence=evidence_df['sentence'].tolist(),
+                batch_size=entailment_config.get('batch_size', 32),
+                token_budget=entailment_config.get('token_size')
+            ),
+            dtype=np.float32
+        ).reshape(evidence_df.shape[0], len(CLASSES))
+
+    @staticmethod
+    def claim_reference_groups(evidence_df: pd.DataFrame) -> np.ndarray:
+        """Group id of every evidence row, one group per claim/reference pair."""
+        if evidence_df.empty:
+            return np.zeros(0, dtype=int)
+        return evidence_df.groupby(['claim', 'reference_id'], sort=False).ngroup().to_numpy()
+
+    def score_entailment_cascade(self, evidence_df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Score evidence with early exit per claim/reference pair.
+
+        Pairs at or below evidence_selection.score_threshold are never scored. The remaining
+        sentences are scored in rounds, best similarity first, the n-th sentence of every open
+        group sharing one batched call; a group closes as soon as a sentence is SUPPORTS with a
+        probability of at least entailment.supports_confidence.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: (N, 3) probabilities, NaN for the rows that were not
+                scored, and the boolean mask of the scored rows.
+        """
+        SCORE_THRESHOLD = self.config['evidence_selection']['score_threshold']
+        entailment_config = self.config.get('entailment', {})
+        supports_confidence = entailment_config.get('supports_confidence', 0.9)
+
+        n_rows = evidence_df.shape[0]
+        probs = np.full((n_rows, len(CLASSES)), np.nan, dtype=np.float32)
+        scored = np.zeros(n_rows, dtype=bool)
+        if n_rows == 0:
+            return probs, scored
+
+        similarity_scores = evidence_df['similarity_score'].to_numpy(dtype=float)
+        groups = self.claim_reference_groups(evidence_df)
+        candidates = np.flatnonzero(similarity_scores > SCORE_THRESHOLD)
+        # Rank of every candidate within its group, by descending similarity
+        order = candidates[np.lexsort((-similarity_scores[candidates], groups[candidates]))]
+        ranks = np.zeros(n_rows, dtype=int)
+        if len(order):
+            group_starts = np.flatnonzero(np.r_[True, groups[order][1:] != groups[order][:-1]])
+            group_sizes = np.diff(np.r_[group_starts, len(order)])
+            ranks[order] = np.arange(len(order)) - np.repeat(group_starts, group_sizes)
+
+        open_groups = np.ones(groups.max() + 1, dtype=bool)
+        claims = evidence_df['claim'].to_numpy()
+        sentences = evidence_df['sentence'].to_numpy()
+        for rank in range(ranks[order].max() + 1 if len(order) else 0):
+            round_rows = order[(ranks[order] == rank) & open_groups[groups[order]]]
+            if len(round_rows) == 0:
+                break
+            probs[round_rows] = np.asarray(
+                self.te_module.get_batch_scores(
+                    claims=claims[round_rows].tolist(),
+                    evidence=sentences[round_rows].tolist(),
+                    batch_size=entailment_config.get('batch_size', 32),
+                    token_budget=entailment_config.get('token_size')
+                ),
+                dtype=np.float32
+            ).reshape(len(round_rows), len(CLASSES))
+            scored[round_rows] = True
+
+            round_probs = probs[round_rows]
+            supported = (round_probs.argmax(axis=1) == 0) & (round_probs[:, 0] >= supports_confidence)
+            open_groups[groups[round_rows[supported]]] = False
+
+        return probs, scored
+
+    def unscored_pair_rows(self, evidence_df: pd.DataFrame, scored: np.ndarray) -> np.ndarray:
+        """
+        Mask of the best row, by similarity, of every claim/reference pair with no scored row,
+        i.e. whose evidence is all at or below evidence_selection.score_threshold in the cascade.
+        """
+        fallback = np.zeros(len(evidence_df), dtype=bool)
+        if evidence_df.empty:
+            return fallback
+        groups = self.claim_reference_groups(evidence_df)
+        unscored = np.bincount(groups, weights=scored, minlength=groups.max() + 1)[groups] == 0
+        similarity_scores = evidence_df['similarity_score'].to_numpy(dtype=float)
+        order = np.lexsort((-similarity_scores, groups))
+        best = order[np.r_[True, groups[order][1:] != groups[order][:-1]]]
+        fallback[best] = True
+        return fallback & unscored
+
+    def build_premises(self, evidence_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Concatenate the evidence of every claim/reference pair into a single premise.
+
+        Sentences are joined best similarity first and kept while the claim and the premise fit
+        in MAX_LEN tokens. Sentences at or below evidence_selection.score_threshold are only used
+        when they are the best of their pair.
+
+        Returns:
+            pd.DataFrame: One row per claim/reference pair, with the metadata and similarity_score
+                of its best sentence, the premise as sentence and the number of sentences it
+                joins as n_premise_sentences.
+        """
+        SCORE_THRESHOLD = self.config['evidence_selection']['score_threshold']
+        if evidence_df.empty:
+            return evidence_df.assign(n_premise_sentences=0)
+
+        similarity_scores = evidence_df['similarity_score'].to_numpy(dtype=float)
+        groups = self.claim_reference_groups(evidence_df)
+        order = np.lexsort((-similarity_scores, groups))
+        ordered = evidence_df.iloc[order].reset_index(drop=True)
+        ordered_groups = groups[order]
+        best = np.r_[True, ordered_groups[1:] != ordered_groups[:-1]]
+
+        sentences = ordered['sentence'].astype(str)
+        claims = ordered['claim'].astype(str)
+        unique_claims = claims.unique()
+        claim_tokens = dict(zip(unique_claims, self.te_module.count_tokens(unique_claims)))
+        # [CLS] claim [SEP] premise [SEP]
+        budgets = MAX_LEN - 3 - claims.map(claim_tokens).to_numpy()
+
+        eligible = best | (similarity_scores[order] > SCORE_THRESHOLD)
+        sentence_tokens = np.where(eligible, self.te_module.count_tokens(sentences), 0)
+        premise_tokens = pd.Series(sentence_tokens).groupby(ordered_groups).cumsum().to_numpy()
+        # The running length only grows, so the kept sentences are a prefix of each pair's ranking;
+        # a best sentence longer than the budget is truncated by the tokenizer instead
+        keep = best | (eligible & (premise_tokens <= budgets))
+
+        premises = ordered.assign(sentence=sentences)[keep].groupby(ordered_groups[keep])['sentence'].agg(' '.join)
+        premise_df = ordered[best].reset_index(drop=True)
+        premise_df['sentence'] = premises.to_numpy()
+        premise_df['n_premise_sentences'] = np.bincount(ordered_groups[keep])
+        return premise_df
+
+    def check_entailment(self, evidence_df: pd.DataFrame, probs: np.ndarray = None) -> pd.DataFrame:
+        """
+        Perform textual entailment checking on evidence sentences.
+
+        The weighted-sum and MALON labels are computed over the (N, 3) probability matrix returned
+        by score_entailment, which is computed here unless given.
         """
         SCORE_THRESHOLD = self.config['evidence_selection']['score_threshold']
         textual_entailment_df = evidence_df.copy()
-        
-        # Initialize columns for results
-        te_columns = {
-            'evidence_TE_prob': [],
-            'evidence_TE_prob_weighted': [],
-            'evidence_TE_labels': [],
-            'claim_TE_prob_weighted_sum': [],
-            'claim_TE_label_weighted_sum': [],
-            'claim_TE_label_malon': [],
-            'processed_timestamp': []
-        }
-
-        for _, row in tqdm(textual_entailment_df.iterrows(), total=textual_entailment_df.shape[0]):
-            start_time = datetime.now()
-            
-            claim = row['claim']
-            evidence = [{
-                'sentence': row['sentence'],
-                'score': row['similarity_score']
-            }]
-            evidence_size = len(evidence)
-            
-            # Get textual entailment probabilities
-            evidence_TE_prob = self.te_module.get_batch_scores(
-                claims=[claim] * evidence_size,
-                evidence=[e['sentence'] for e in evidence]
-            )
-            
-            # Get labels from probabilities
-            evidence_TE_labels = [self.te_module.get_label_from_scores(s) for s in evidence_TE_prob]
-            
-            # Weight probabilities by similarity scores
-            evidence_TE_prob_weighted = [
-                probs * ev['score'] for probs, ev in zip(evidence_TE_prob, evidence)
-                if ev['score'] > SCORE_THRESHOLD
-            ]
-            
-            if not evidence_TE_prob_weighted:
-                evidence_TE_prob_weighted = [[0, 1, 0]]
-            
-            # Calculate weighted sum probabilities
-            claim_TE_prob_weighted_sum = np.sum(evidence_TE_prob_weighted, axis=0)
-            
-            # Get final labels
-            claim_TE_label_weighted_sum = self.te_module.get_label_from_scores(claim_TE_prob_weighted_sum)
-            claim_TE_label_malon = self.te_module.get_label_malon(evidence_TE_prob)
-            
-            # Store results
-            te_columns['evidence_TE_prob'].append(evidence_TE_prob)
-            te_columns['evidence_TE_prob_weighted'].append(evidence_TE_prob_weighted)
-            te_columns['evidence_TE_labels'].append(evidence_TE_labels)
-            te_columns['claim_TE_prob_weighted_sum'].append(claim_TE_prob_weighted_sum.tolist())
-            te_columns['claim_TE_label_weighted_sum'].append(claim_TE_label_weighted_sum)
-            te_columns['claim_TE_label_malon'].append(claim_TE_label_malon)
-            te_columns['processed_timestamp'].append(datetime.now().isoformat())
-
-        # Add results to DataFrame
-        for col, values in te_columns.items():
-            textual_entailment_df[col] = values
+
+        if probs is None:
+            probs = self.score_entailment(textual_entailment_df)
+        similarity_scores = textual_entailment_df['similarity_score'].to_numpy(dtype=float)
+        processed_timestamp = datetime.now().isoformat()
+
+        # Weight probabilities by similarity scores, evidence below the threshold counts as [0, 1, 0]
+        above_threshold = similarity_scores > SCORE_THRESHOLD
+        prob_weighted = probs * similarity_scores[:, None]
+        prob_weighted_sum = np.where(
+            above_threshold[:, None], prob_weighted, np.array([0, 1, 0], dtype=float)
+        )
+
+        labels = self.te_module.get_labels_from_scores(probs)
+        # Each row holds one evidence sentence, so its MALON set is that sentence's label
+        labels_malon = self.te_module.get_labels_malon(probs[:, None, :])
+
+        textual_entailment_df['evidence_TE_prob'] = list(probs[:, None, :])
+        textual_entailment_df['evidence_TE_prob_weighted'] = [
+            [weighted] if keep else [[0, 1, 0]]
+            for weighted, keep in zip(prob_weighted, above_threshold)
+        ]
+        textual_entailment_df['evidence_TE_labels'] = [[label] for label in labels]
+        textual_entailment_df['claim_TE_prob_weighted_sum'] = prob_weighted_sum.tolist()
+        textual_entailment_df['claim_TE_label_weighted_sum'] = self.te_module.get_labels_from_scores(prob_weighted_sum)
+        textual_entailment_df['claim_TE_label_malon'] = labels_malon
+        textual_entailment_df['processed_timestamp'] = processed_timestamp
 
         return textual_entailment_df
 
-    def format_results(self, evidence_df: pd.DataFrame) -> pd.DataFrame:
+    def format_results(
+        self, evidence_df: pd.DataFrame, probs: np.ndarray = None, verdict_groups: np.ndarray = None
+    ) -> pd.DataFrame:
         """
-        Format results into a readable table with all required columns
+        Format results into a flat table with one row per evidence sentence.
+
+        Args:
+            evidence_df: Output of check_entailment.
+            probs: (N, 3) entailment probabilities of the rows, read from evidence_TE_prob if not given.
+            verdict_groups: Group of every row for get_final_verdict, one group per row if not given.
+
+        Returns:
+            DataFrame with the metadata, scores, label and verdict group of every evidence row.
         """
-        results = evidence_df.copy()
-        
-        all_result = pd.DataFrame()
-        for idx, row in results.iterrows():
-            aResult = pd.DataFrame({
-                'sentence': [row['sentence']],
-                'Relevance_score': [row['similarity_score']],
-                'TextEntailment': [row['evidence_TE_labels'][0]],
-                'Entailment_score': [max(row['evidence_TE_prob'][0])]
-            })
+        if probs is None:
+            probs = np.asarray(
+                [np.asarray(p, dtype=np.float32).reshape(-1) for p in evidence_df['evidence_TE_prob']],
+                dtype=np.float32
+            ).reshape(-1, len(CLASSES))
 
-            aBox = pd.DataFrame({
-                'qid': [row.get('qid', '')],
-                'property_id': [row.get('property_id', '')],
-                'object_id': [row.get('object_id', '')],
-                'entity_label': [row.get('entity_label', '')],
-                'property_label': [row.get('property_label', '')],
-                'object_label': [row.get('object_label', '')],
-                'reference_id': [row.get('reference_id', '')],
-                'url': [row.get('url', '')],
-                'text_entailment_score': [max(row['evidence_TE_prob'][0])],
-                'similarity_score': [row['similarity_score']],
-                'processed_timestamp': [row.get('processed_timestamp')],
-                'Results': [aResult]
-            })
-            
-            all_result = pd.concat([all_result, aBox], axis=0)
+        def column(name):
+            return evidence_df[name].to_numpy() if name in evidence_df.columns else [''] * len(evidence_df)
 
-        return all_result.reset_index(drop=True)
+        entailment_scores = probs.max(axis=1) if len(probs) else np.zeros(0, dtype=np.float32)
+        return pd.DataFrame({
+            'qid': column('qid'),
+            'property_id': column('property_id'),
+            'object_id': column('object_id'),
+            'entity_label': column('entity_label'),
+            'property_label': column('property_label'),
+            'object_label': column('object_label'),
+            'reference_id': column('reference_id'),
+            'url': column('url'),
+            'text_entailment_score': entailment_scores,
+            'similarity_score': evidence_df['similarity_score'].to_numpy(),
+            'processed_timestamp': (
+                evidence_df['processed_timestamp'].to_numpy()
+                if 'processed_timestamp' in evidence_df.columns else [None] * len(evidence_df)
+            ),
+            'sentence': evidence_df['sentence'].to_numpy(),
+            'TextEntailment': self.te_module.get_labels_from_scores(probs),
+            'verdict_group': np.arange(len(evidence_df)) if verdict_groups is None else verdict_groups,
+        })
 
-    def get_final_verdict(self, aggregated_result: pd.DataFrame) -> pd.DataFrame:
+    def get_final_verdict(self, aggregated_result: pd.DataFrame, group_column: str = 'verdict_group') -> pd.DataFrame:
         """
-        Get final verdict for each claim based on TextEntailment results
+        Get final verdict for each group of evidence rows: SUPPORTS if any sentence supports the
+        claim, else the most frequent label (alphabetically first on ties), along with the first
+        sentence carrying that verdict.
         """
-        results = []
-        for idx, row in aggregated_result.iterrows():
-            temp = row.Results
-            if 'SUPPORTS' in temp.TextEntailment.values:
-                result_sentence = temp[temp['TextEntailment']=='SUPPORTS']['sentence'].iloc[0]
-                results.append({
-                    'result': 'SUPPORTS',
-                    'result_sentence': result_sentence
-                })
-            else:
-                result = temp.TextEntailment.mode()[0]
-                result_sentence = temp[temp['TextEntailment']==result]['sentence'].iloc[0]
-                results.append({
-                    'result': result,
-                    'result_sentence': result_sentence
-                })
-        return pd.DataFrame(results, index=aggregated_result.index)
+        if aggregated_result.empty:
+            return pd.DataFrame(columns=['result', 'result_sentence'], index=aggregated_result.index)
+
+        groups = aggregated_result[group_column].to_numpy()
+        counts = pd.crosstab(groups, aggregated_result['TextEntailment'].to_numpy())
+        verdicts = counts.idxmax(axis=1)
+        if 'SUPPORTS' in counts.columns:
+            verdicts = verdicts.where(counts['SUPPORTS'] == 0, 'SUPPORTS')
+
+        first_sentences = (
+            pd.DataFrame({
+                'group': groups,
+                'label': aggregated_result['TextEntailment'].to_numpy(),
+                'sentence': aggregated_result['sentence'].to_numpy(),
+            })
+            .groupby(['group', 'label'], sort=False)['sentence']
+            .first()
+        )
+        row_verdicts = verdicts.reindex(groups).to_numpy()
+        return pd.DataFrame({
+            'result': row_verdicts,
+            'result_sentence': first_sentences.reindex(
+                pd.MultiIndex.from_arrays([groups, row_verdicts])
+            ).to_numpy(),
+        }, index=aggregated_result.index)
 
     def process_evidence(self, sentences_df: pd.DataFrame, parser_result: Dict) -> pd.DataFrame:
         """
@@ -197,30 +330,44 @@ class ClaimEntailmentChecker:
             how='left'
         )
         
-        # Check entailment and keep original probabilities
-        entailment_results = self.check_entailment(evidence_df)
-        probabilities = entailment_results['evidence_TE_prob'].copy()
+        # Check entailment, keeping the (N, 3) probabilities as a flat array
+        entailment_config = self.config.get('entailment', {})
+        if entailment_config.get('premise', 'sentence') == 'concatenated':
+            # One pass per claim/reference pair over its concatenated evidence
+            evidence_df = self.build_premises(evidence_df)
+            probabilities = self.score_entailment(evidence_df)
+            verdict_groups = None
+        elif entailment_config.get('cascade', False):
+            # Only the scored rows are kept, with one verdict per claim/reference pair; pairs
+            # with nothing above the threshold keep their best row with the [0, 1, 0] fallback
+            probabilities, scored = self.score_entailment_cascade(evidence_df)
+            fallback = self.unscored_pair_rows(evidence_df, scored)
+            probabilities[fallback] = [0, 1, 0]
+            kept = scored | fallback
+            evidence_df = evidence_df[kept].reset_index(drop=True)
+            probabilities = probabilities[kept]
+            verdict_groups = self.claim_reference_groups(evidence_df)
+        else:
+            probabilities = self.score_entailment(evidence_df)
+            verdict_groups = None
+        entailment_results = self.check_entailment(evidence_df, probabilities)
         
         # Format results
-        aggregated_results = self.format_results(entailment_results)
+        aggregated_results = self.format_results(entailment_results, probabilities, verdict_groups)
         
         # Get final verdict
         final_verdict = self.get_final_verdict(aggregated_results)
         aggregated_results = pd.concat([aggregated_results, final_verdict], axis=1)
         
-        # Keep only necessary columns and drop 'Results'
+        # Keep only necessary columns
         final_results = aggregated_results[['text_entailment_score', 'similarity_score',
                                           'processed_timestamp', 'result',
-                                          'result_sentence', 'reference_id']]
+                                          'result_sentence', 'reference_id']].copy()
         
-        # Add label probabilities using the saved probabilities
-        final_results['label_probabilities'] = probabilities.apply(
-            lambda x: {
-                'SUPPORTS': float(x[0][0]),
-                'REFUTES': float(x[0][1]),
-                'NOT ENOUGH INFO': float(x[0][2])
-            }
-        )
+        # Add label probabilities
+        final_results['label_probabilities'] = [
+            dict(zip(CLASSES, row)) for row in probabilities.astype(float).tolist()
+        ]
         
         return final_results
 
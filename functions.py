@@ -2,8 +2,10 @@ from datetime import datetime
 from functools import partial
 from collections import defaultdict
 from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
 import json
 import sqlite3
+from threading import Lock
 from urllib.parse import urlparse
 import uuid
 from typing import Dict, Any, List
@@ -681,72 +683,138 @@ def generation_worklist_pagePile():
     data_dict = df.to_dict(orient='records')
     return json.dumps(data_dict, ensure_ascii=False, indent=4)
 
-def process_reference(url: str, claim: str) -> Dict[str, Any]:
-    import nltk
+class ReferenceModels:
+    """
+    Models of the processReference endpoints, loaded once per API process on first use and
+    warmed up, instead of once per request.
+
+    Inference runs under a lock so that concurrent requests never use the models at the same
+    time; fetching and parsing the pages happens outside of it.
+    """
+    _models = None
+    _load_lock = Lock()
+    inference_lock = Lock()
+
+    @classmethod
+    def get(cls) -> tuple:
+        if cls._models is None:
+            with cls._load_lock:
+                if cls._models is None:
+                    cls._models = cls._load()
+        return cls._models
+
+    @staticmethod
+    def _load() -> tuple:
+        import nltk
+        import ProVe_main_process
+
+        nltk.data.path.append('/home/ubuntu/nltk_data/')
+        logger.info("Loading the processReference models")
+        text_entailment, sentence_retrieval, verb_module = ProVe_main_process.initialize_models()
+
+        # One tiny pass through each cross-encoder, so the first request does not pay for it
+        warm_up = 'ProVe warm-up sentence.'
+        sentence_retrieval.compute_sentence_pair_scores([(warm_up, warm_up)])
+        text_entailment.compute_batch_scores([(warm_up, warm_up)])
+        logger.info("processReference models loaded and warmed up")
+        return text_entailment, sentence_retrieval, verb_module
+
+
+def fetch_reference_html(urls: List[str]) -> pd.DataFrame:
+    """Fetch the pages of the references concurrently, one row per URL with its reference_id."""
     import requests
-    import pandas as pd
-    import ProVe_main_process
     from refs_html_collection import HTMLFetcher
+
+    fetcher = HTMLFetcher(config_path="/home/ubuntu/RQV/config.yaml")
+
+    def fetch(url):
+        try:
+            response = requests.get(url, timeout=fetcher.timeout, headers=fetcher.headers)
+            return response.status_code, response.text
+        except requests.RequestException as e:
+            logger.error(f"Error fetching {url}: {e}")
+            # Skipped by HTMLSentenceProcessor like the failed fetches of HTMLFetcher
+            return None, f"Error: {e}"
+
+    with ThreadPoolExecutor(max_workers=min(max(len(urls), 1), 8)) as executor:
+        pages = list(executor.map(fetch, urls))
+
+    return pd.DataFrame({
+        "status": [status for status, _ in pages],
+        "html": [html for _, html in pages],
+        "url": urls,
+        "reference_id": [f"ref_{idx}" for idx in range(len(urls))],
+    })
+
+
+def best_reference_result(df: pd.DataFrame) -> Dict[str, Any]:
+    """Verdict of one reference: the best scoring sentence of its strongest verdict."""
+    results = df["result"].to_list()
+    if "SUPPORTS" in results:
+        label = "SUPPORTS"
+    elif "NOT ENOUGH INFO" in results:
+        label = "NOT ENOUGH INFO"
+    else:
+        label = "REFUTES"
+    rows = df.loc[df['result'] == label]
+    best = rows.loc[rows['text_entailment_score'] == rows['text_entailment_score'].max()].iloc[0]
+    return {
+        "score": float(best["text_entailment_score"]),
+        "sentence": best["result_sentence"],
+        "similarity": float(best["similarity_score"]),
+        "result": best["result"],
+    }
+
+
+def process_references(pairs: List[Dict[str, str]]) -> List[Dict[str, Any]]:
+    """
+    Check many (url, claim) pairs together: the pages are fetched concurrently, then the
+    sentences of every page are scored in one batched pass of each model.
+
+    Args:
+        pairs (List[Dict[str, str]]): Objects with "url" and "sentence" (the claim).
+
+    Returns:
+        List[Dict[str, Any]]: Per pair, in order, the score, sentence, similarity and result of
+            process_reference, or an "error" message.
+    """
     from refs_html_to_evidences import HTMLSentenceProcessor, EvidenceSelector
     from claim_entailment import ClaimEntailmentChecker
 
-    nltk.data.path.append('/home/ubuntu/nltk_data/')
+    text_entailment, sentence_retrieval, verb_module = ReferenceModels.get()
 
-    model = ProVe_main_process.initialize_models()
-    text_entailment, sentence_retrieval, verb_module = model
+    urls = [pair["url"] for pair in pairs]
+    html_df = fetch_reference_html(urls)
+    source_df = pd.DataFrame({
+        "verbalisation_unks_replaced_then_dropped": [pair["sentence"] for pair in pairs],
+        "claims_refs": urls,
+        "reference_id": html_df["reference_id"],
+    })
 
-    selector = EvidenceSelector(
-        sentence_retrieval=sentence_retrieval,
-        verb_module=verb_module,
-    )
+    sentence_df = HTMLSentenceProcessor().process_html_to_sentences(html_df)
+
+    selector = EvidenceSelector(sentence_retrieval=sentence_retrieval, verb_module=verb_module)
     checker = ClaimEntailmentChecker(text_entailment=text_entailment)
+    with ReferenceModels.inference_lock:
+        evidence_df = selector.select_relevant_sentences(source_df, sentence_df)
+        df = checker.process_entailment(evidence_df, html_df, "Q42")
+
+    results = []
+    for reference_id, url in zip(html_df["reference_id"], urls):
+        reference_df = df.loc[df["reference_id"] == reference_id] if not df.empty else df
+        if reference_df.empty:
+            results.append({"error": f"No evidence could be extracted from {url}"})
+        else:
+            results.append(best_reference_result(reference_df))
+    return results
 
-    fetcher = HTMLFetcher(config_path="/home/ubuntu/RQV/config.yaml")
-    html_result = requests.get(url, timeout=fetcher.timeout, headers=fetcher.headers)
-    result = {
-        "status": [html_result.status_code],
-        "html": [html_result.text],
-        "url": [url],
-        "reference_id": ["Q42"],
-    }
-    source = {
-        "verbalisation_unks_replaced_then_dropped": [claim],
-        "claims_refs": [url],
-        "reference_id": ["Q42"],
-    }
-    source_df = pd.DataFrame.from_dict(source)
-    html_df = pd.DataFrame.from_dict(result)
-
-    processor = HTMLSentenceProcessor()
-    sentence_df = processor.process_html_to_sentences(html_df)
-
-    evidence_df = selector.select_relevant_sentences(source_df, sentence_df)
-
-    df = checker.process_entailment(evidence_df, html_df, "Q42")
-
-    if "SUPPORTS" in df["result"].to_list():
-        result = df.loc[
-            (df['result'] == 'SUPPORTS') &
-            (df['text_entailment_score'] == df.loc[df['result'] == 'SUPPORTS', 'text_entailment_score'].max())
-        ]
-    elif "NOT ENOUGH INFO" in df["result"].to_list():
-        result = df.loc[
-            (df['result'] == 'NOT ENOUGH INFO') &
-            (df['text_entailment_score'] == df.loc[df['result'] == 'NOT ENOUGH INFO', 'text_entailment_score'].max())
-        ]
-    else:
-        result = df.loc[
-            (df['result'] == 'REFUTES') &
-            (df['text_entailment_score'] == df.loc[df['result'] == 'REFUTES', 'text_entailment_score'].max())
-        ]
 
-    result = result.reset_index(drop=True).to_dict()
-    return {
-        "score": result["text_entailment_score"][0],
-        "sentence": result["result_sentence"][0],
-        "similarity": result["similarity_score"][0],
-        "result": result["result"][0],
-    }
+def process_reference(url: str, claim: str) -> Dict[str, Any]:
+    result = process_references([{"url": url, "sentence": claim}])[0]
+    if "error" in result:
+        raise ValueError(result["error"])
+    return result
+
 
 def plot_status():
     def extract_hour(x):
@@ -834,74 +902,6 @@ def get_config_as_json():
         return None
 
 
-def process_reference(url: str, claim: str):
-    import nltk
-    import requests
-    import pandas as pd
-    import ProVe_main_process
-    from refs_html_collection import HTMLFetcher
-    from refs_html_to_evidences import HTMLSentenceProcessor, EvidenceSelector
-    from claim_entailment import ClaimEntailmentChecker
-
-    nltk.data.path.append('/home/ubuntu/nltk_data/')
-
-    model = ProVe_main_process.initialize_models()
-    text_entailment, sentence_retrieval, verb_module = model
-
-    selector = EvidenceSelector(
-        sentence_retrieval=sentence_retrieval,
-        verb_module=verb_module,
-    )
-    checker = ClaimEntailmentChecker(text_entailment=text_entailment)
-
-    fetcher = HTMLFetcher(config_path="/home/ubuntu/RQV/config.yaml")
-    html_result = requests.get(url, timeout=fetcher.timeout, headers=fetcher.headers)
-    result = {
-        "status": [html_result.status_code],
-        "html": [html_result.text],
-        "url": [url],
-        "reference_id": ["Q42"],
-    }
-    source = {
-        "verbalisation_unks_replaced_then_dropped": [claim],
-        "claims_refs": [url],
-        "reference_id": ["Q42"],
-    }
-    source_df = pd.DataFrame.from_dict(source)
-    html_df = pd.DataFrame.from_dict(result)
-
-    processor = HTMLSentenceProcessor()
-    sentence_df = processor.process_html_to_sentences(html_df)
-
-    evidence_df = selector.select_relevant_sentences(source_df, sentence_df)
-
-    df = checker.process_entailment(evidence_df, html_df, "Q42")
-
-    if "SUPPORTS" in df["result"].to_list():
-        result = df.loc[
-            (df['result'] == 'SUPPORTS') &
-            (df['text_entailment_score'] == df.loc[df['result'] == 'SUPPORTS', 'text_entailment_score'].max())
-        ]
-    elif "NOT ENOUGH INFO" in df["result"].to_list():
-        result = df.loc[
-            (df['result'] == 'NOT ENOUGH INFO') &
-            (df['text_entailment_score'] == df.loc[df['result'] == 'NOT ENOUGH INFO', 'text_entailment_score'].max())
-        ]
-    else:
-        result = df.loc[
-            (df['result'] == 'REFUTES') &
-            (df['text_entailment_score'] == df.loc[df['result'] == 'REFUTES', 'text_entailment_score'].max())
-        ]
-
-    result = result.reset_index(drop=True).to_dict()
-    return {
-        "score": result["text_entailment_score"][0],
-        "sentence": result["result_sentence"][0],
-        "similarity": result["similarity_score"][0],
-        "result": result["result"][0],
-    }
-
-
 if __name__ == "__main__":
     #requestItemProcessing('Q44')
     process_reference("https://discovering.beer/what-beer-is-made-from/hops/", "beer no part(s) hops")
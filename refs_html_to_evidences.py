@@ -2,9 +2,11 @@ import pandas as pd
 import nltk
 import html2text
 import requests
+import yaml
 from typing import Dict, List, Tuple, Optional
 from utils.verbalisation_module import VerbModule
 from utils.sentence_retrieval_module import SentenceRetrievalModule
+from utils.mention_windows import claim_surface_forms, find_mention_windows
 import numpy as np
 
 from utils.logger import logger
@@ -47,16 +49,54 @@ class HTMLSentenceProcessor:
         return valid_html_df[['reference_id', 'url', 'nlp_sentences', 'nlp_sentences_slide_2']]
 
 class EvidenceSelector:
-    def __init__(self, sentence_retrieval=None, verb_module=None):
+    def __init__(self, sentence_retrieval=None, verb_module=None, config_path: str = 'config.yaml', load_models: bool = True):
         self.logger = logger
+        self.config = self.load_config(config_path)
         self.endpoint_url = "https://query.wikidata.org/sparql"
         self.headers = {
             'User-Agent': 'Mozilla/5.0 (compatible; MyBot/1.0; mailto:your@email.com)'
         }
-        # Use provided models or create new ones
-        self.verb_module = verb_module or VerbModule()
-        self.sentence_retrieval = sentence_retrieval or SentenceRetrievalModule(max_len=512)
-        self.top_k = 5
+        # Use provided models or create new ones, unless the caller sets them per stage
+        self.verb_module = verb_module or (VerbModule() if load_models else None)
+        self.sentence_retrieval = sentence_retrieval or (SentenceRetrievalModule(max_len=512) if load_models else None)
+
+        selection_config = self.config.get('evidence_selection', {})
+        self.top_k = selection_config.get('n_top_sentences', 5)
+        self.batch_size = selection_config.get('batch_size', 32)
+        self.token_budget = selection_config.get('token_size')
+        # Distinct pairs scored by the last select_relevant_sentences call
+        self.scored_pairs = 0
+
+        slide_config = self.config.get('text_processing', {}).get('sentence_slide', {})
+        self.mention_windows_enabled = slide_config.get('enabled', False)
+        self.mention_window_size = slide_config.get('window_size', 2)
+
+    @staticmethod
+    def load_config(config_path: str) -> Dict:
+        try:
+            with open(config_path, 'r') as file:
+                return yaml.safe_load(file) or {}
+        except FileNotFoundError:
+            logger.error(f"Config file not found: {config_path}")
+            return {}
+
+    def get_candidate_indices(self, claim_row: pd.Series, ref_sentences: List[str]) -> List[int]:
+        """
+        Indices of the sentences worth scoring for a claim: windows of ±window_size sentences
+        around mentions of the entity label, object label or claim date. Falls back to all
+        sentences when anchoring is disabled or nothing is mentioned.
+        """
+        all_indices = list(range(len(ref_sentences)))
+        if not self.mention_windows_enabled:
+            return all_indices
+
+        surface_forms = claim_surface_forms(
+            entity_label=claim_row.get('entity_label'),
+            object_label=claim_row.get('object_label'),
+            datavalue=claim_row.get('datavalue')
+        )
+        window_indices = find_mention_windows(ref_sentences, surface_forms, self.mention_window_size)
+        return window_indices or all_indices
 
     def get_labels_from_sparql(self, property_ids: List[str], entity_ids: List[str]) -> Tuple[Dict[str, str], Dict[str, str]]:
         """
@@ -162,43 +202,96 @@ class EvidenceSelector:
         
         # Add verbalization columns
         relevant_claims['verbalisation'] = self.verb_module.verbalise_triples(triples)
+        # Replacer owned by this request, so the module can be shared between concurrent requests
+        unk_replacer = self.verb_module.new_unk_replacer()
         relevant_claims['verbalisation_unks_replaced'] = relevant_claims['verbalisation'].apply(
-            self.verb_module.replace_unks_on_sentence
+            unk_replacer.replace
         )
         relevant_claims['verbalisation_unks_replaced_then_dropped'] = relevant_claims['verbalisation'].apply(
-            lambda x: self.verb_module.replace_unks_on_sentence(x, empty_after=True)
+            unk_replacer.replace
         )
         
         return relevant_claims
 
     def select_relevant_sentences(self, relevant_claims: pd.DataFrame, sentences_df: pd.DataFrame) -> pd.DataFrame:
         """
-        Select most relevant sentences for each claim using semantic similarity
+        Select most relevant sentences for each claim using semantic similarity.
+
+        All (claim, sentence) pairs of the entity are built up front, deduplicated and scored
+        in a single stream of batches; the top k sentences are then picked per claim/reference.
         """
-        results = []
-        
+        # Indexed lookup from reference to its sentences
+        ref_sentences_lookup = (
+            sentences_df.drop_duplicates('reference_id')
+            .set_index('reference_id')['nlp_sentences']
+            .to_dict()
+        )
+
+        # Embed every claim once for the optional bi-encoder pre-ranking stage
+        pre_ranker = getattr(self.sentence_retrieval, 'pre_ranker', None)
+        claim_embeddings = {}
+        if pre_ranker is not None and not relevant_claims.empty:
+            claim_texts = relevant_claims['verbalisation_unks_replaced_then_dropped'].unique().tolist()
+            claim_embeddings = dict(zip(claim_texts, pre_ranker.encode_claims(claim_texts)))
+
+        pair_index = {}
+        unique_pairs = []
+        groups = []
+
         for _, claim_row in relevant_claims.iterrows():
             claim_text = claim_row['verbalisation_unks_replaced_then_dropped']
             ref_id = claim_row['reference_id']
             
             # Get sentences for the matching reference_id
-            ref_sentences = sentences_df[sentences_df['reference_id'] == ref_id]['nlp_sentences'].iloc[0]
+            ref_sentences = ref_sentences_lookup.get(ref_id)
             
             if not ref_sentences or ref_sentences == ["No TEXT"]:
                 continue
                 
-            # Create sentence pairs for scoring
-            sentence_pairs = [(claim_text, sentence) for sentence in ref_sentences]
-            
-            # Get similarity scores using score_sentence_pairs
-            similarities = self.sentence_retrieval.score_sentence_pairs(sentence_pairs)
+            # Only score the windows around entity/object/date mentions
+            candidate_indices = self.get_candidate_indices(claim_row, ref_sentences)
+            if pre_ranker is not None:
+                candidate_indices = pre_ranker.select(
+                    claim_embeddings[claim_text], ref_sentences, candidate_indices
+                )
+
+            # Register sentence pairs, scoring each distinct pair only once
+            pair_ids = []
+            for idx in candidate_indices:
+                pair = (claim_text, ref_sentences[idx])
+                if pair not in pair_index:
+                    pair_index[pair] = len(unique_pairs)
+                    unique_pairs.append(pair)
+                pair_ids.append(pair_index[pair])
+
+            groups.append((claim_row, claim_text, ref_id, ref_sentences, candidate_indices, pair_ids))
+
+        self.scored_pairs = len(unique_pairs)
+        if not unique_pairs:
+            return pd.DataFrame()
+
+        # Get similarity scores for the whole entity using score_sentence_pairs
+        all_similarities = np.asarray(
+            self.sentence_retrieval.score_sentence_pairs(
+                unique_pairs, batch_size=self.batch_size, token_budget=self.token_budget
+            )
+        )
+
+        results = []
+        for claim_row, claim_text, ref_id, ref_sentences, candidate_indices, pair_ids in groups:
+            similarities = all_similarities[pair_ids]
             
             # Get top k most similar sentences
-            top_k_indices = np.argsort(similarities)[-self.top_k:][::-1]
+            if len(similarities) > self.top_k:
+                top_k_positions = np.argpartition(similarities, -self.top_k)[-self.top_k:]
+            else:
+                top_k_positions = np.arange(len(similarities))
+            top_k_positions = top_k_positions[np.argsort(similarities[top_k_positions])[::-1]]
             
             # Create results for this claim
-            for idx in top_k_indices:
-                score = float(similarities[idx])
+            for position in top_k_positions:
+                idx = candidate_indices[position]
+                score = float(similarities[position])
                 sentence = ref_sentences[idx]
                 try:
                     results.append({
@@ -0,0 +1,44 @@
+from typing import Iterator, List, Optional
+
+
+def length_bucketed_batches(
+    lengths: List[int],
+    batch_size: int,
+    token_budget: Optional[int] = None
+) -> Iterator[List[int]]:
+    """
+    Group item indices into batches of similar length, so each batch can be padded to its
+    longest item instead of the model maximum.
+
+    Items are sorted by decreasing length and a batch is closed once it holds batch_size items
+    or once padding it to its longest item would exceed token_budget tokens. A single item
+    longer than the budget still gets a batch of its own.
+
+    Args:
+        lengths (List[int]): Token length of each item.
+        batch_size (int): Maximum number of items per batch.
+        token_budget (Optional[int]): Maximum padded tokens (items x longest item) per batch.
+            Defaults to no budget.
+
+    Yields:
+        List[int]: Original indices of the items in each batch.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    batch_size = max(1, batch_size)
+
+    batch = []
+    longest = 0
+    for idx in order:
+        # Sorted descending, so the first item of a batch sets its padded length
+        padded_length = longest or lengths[idx]
+        too_many_items = len(batch) >= batch_size
+        over_budget = token_budget is not None and (len(batch) + 1) * padded_length > token_budget
+        if batch and (too_many_items or over_budget):
+            yield batch
+            batch = []
+            padded_length = lengths[idx]
+        batch.append(idx)
+        longest = padded_length
+
+    if batch:
+        yield batch
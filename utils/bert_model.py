@@ -45,6 +45,7 @@ PRETRAINED_MODEL_ARCHIVE_MAP = {
     'bert-base-multilingual-cased': "https://s3.amazonaws.com/models.huggingface.co/bert/bert-base-multilingual-cased.tar.gz",
     'bert-base-chinese': "https://s3.amazonaws.com/models.huggingface.co/bert/bert-base-chinese.tar.gz",
 }
+SDPA_AVAILABLE = hasattr(nn.functional, 'scaled_dot_product_attention')
 CONFIG_NAME = 'bert_config.json'
 WEIGHTS_NAME = 'pytorch_model.bin'
 TF_WEIGHTS_NAME = 'model.ckpt'
@@ -280,6 +281,9 @@ class BertSelfAttention(nn.Module):
         self.value = nn.Linear(config.hidden_size, self.all_head_size)
 
         self.dropout = nn.Dropout(config.attention_probs_dropout_prob)
+        # 'sdpa' runs inference through the fused scaled_dot_product_attention kernels, 'eager'
+        # always builds the explicit score matrices. Training always uses the explicit path.
+        self.attention_implementation = getattr(config, 'attention_implementation', 'sdpa')
 
     def transpose_for_scores(self, x):
         new_x_shape = x.size()[:-1] + (self.num_attention_heads, self.attention_head_size)
@@ -295,11 +299,23 @@ class BertSelfAttention(nn.Module):
         key_layer = self.transpose_for_scores(mixed_key_layer)
         value_layer = self.transpose_for_scores(mixed_value_layer)
 
+        # Modules pickled before the attribute existed default to the fused path
+        if not self.training and getattr(self, 'attention_implementation', 'sdpa') == 'sdpa' and SDPA_AVAILABLE:
+            # The additive mask broadcasts over heads and query positions; without one (no padding
+            # in the batch) the kernel can skip masking altogether
+            context_layer = nn.functional.scaled_dot_product_attention(
+                query_layer, key_layer, value_layer, attn_mask=attention_mask
+            )
+            context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
+            new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
+            return context_layer.view(*new_context_layer_shape)
+
         # Take the dot product between "query" and "key" to get the raw attention scores.
         attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
         attention_scores = attention_scores / math.sqrt(self.attention_head_size)
         # Apply the attention mask is (precomputed for all layers in BertModel forward() function)
-        attention_scores = attention_scores + attention_mask
+        if attention_mask is not None:
+            attention_scores = attention_scores + attention_mask
 
         # Normalize the attention scores to probabilities.
         attention_probs = nn.Softmax(dim=-1)(attention_scores)
@@ -329,6 +345,16 @@ class BertSelfOutput(nn.Module):
         return hidden_states
 
 
+def set_attention_implementation(model, attention_implementation):
+    """Switch every BertSelfAttention of a model to 'sdpa' or 'eager' attention."""
+    if attention_implementation not in ('sdpa', 'eager'):
+        raise ValueError("attention_implementation must be 'sdpa' or 'eager'")
+    for module in model.modules():
+        if isinstance(module, BertSelfAttention):
+            module.attention_implementation = attention_implementation
+    return model
+
+
 class BertAttention(nn.Module):
     def __init__(self, config):
         super(BertAttention, self).__init__()
@@ -707,6 +733,10 @@ class BertModel(BertPreTrainedModel):
         # effectively the same as removing these entirely.
         extended_attention_mask = extended_attention_mask.to(dtype=next(self.parameters()).dtype) # fp16 compatibility
         extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
+        # An unpadded batch needs no mask at all, which lets the fused attention kernels run
+        # unmasked. Traced graphs keep the mask, as the check would be frozen into them.
+        if not self.training and not torch.jit.is_tracing() and bool(attention_mask.all()):
+            extended_attention_mask = None
 
         embedding_output = self.embeddings(input_ids, token_type_ids)
         encoded_layers = self.encoder(embedding_output,
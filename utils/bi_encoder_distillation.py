@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+"""
+Distil the sentence retrieval cross-encoder into a bi-encoder used as a pre-ranker.
+
+1. Label (claim, sentence) pairs with the cross-encoder teacher:
+
+    python -m utils.bi_encoder_distillation --label_pairs pairs.json --data_dir data/bi_encoder \
+        --output_dir out --model_name_or_path /home/ubuntu/RQV/base/bert_base
+
+2. Train the student on the labelled pairs:
+
+    python -m utils.bi_encoder_distillation --do_train --data_dir data/bi_encoder \
+        --output_dir /home/ubuntu/RQV/base/bi_encoder --model_name_or_path /home/ubuntu/RQV/base/bert_base \
+        --num_train_epochs 3 --accelerator gpu --devices 1
+
+The student is saved with save_pretrained under ``<output_dir>/best_tfmr``.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+from pathlib import Path
+from typing import Dict, List
+
+import pytorch_lightning as pl
+import torch
+from pytorch_lightning.callbacks import LearningRateMonitor, ModelCheckpoint
+from torch.utils.data import DataLoader, Dataset
+from transformers import AutoTokenizer
+
+from utils.bi_encoder_module import mean_pool
+
+# need the parent dir module
+sys.path.insert(2, str(Path(__file__).resolve().parents[1]))
+from utils.lightning_base import BaseTransformer, add_generic_args  # noqa
+
+
+class DistillationPairsDataset(Dataset):
+    """(claim, sentence, teacher score) triples stored as JSON lines in ``<data_dir>/<type_path>.jsonl``."""
+
+    def __init__(self, tokenizer, data_dir: str, type_path: str, max_length: int, n_obs: int = None):
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        with open(os.path.join(data_dir, f"{type_path}.jsonl"), 'r') as file:
+            self.examples = [json.loads(line) for line in file if line.strip()]
+        if n_obs is not None and n_obs >= 0:
+            self.examples = self.examples[:n_obs]
+
+    def __len__(self):
+        return len(self.examples)
+
+    def __getitem__(self, index) -> Dict:
+        return self.examples[index]
+
+    def collate_fn(self, batch: List[Dict]) -> Dict[str, torch.Tensor]:
+        claims = self.tokenizer(
+            [example['claim'] for example in batch],
+            truncation=True, max_length=self.max_length, padding='longest', return_tensors='pt'
+        )
+        sentences = self.tokenizer(
+            [example['sentence'] for example in batch],
+            truncation=True, max_length=self.max_length, padding='longest', return_tensors='pt'
+        )
+        return {
+            'claim_input_ids': claims['input_ids'],
+            'claim_attention_mask': claims['attention_mask'],
+            'sentence_input_ids': sentences['input_ids'],
+            'sentence_attention_mask': sentences['attention_mask'],
+            'scores': torch.tensor([float(example['score']) for example in batch]),
+        }
+
+
+class BiEncoderDistillationModule(BaseTransformer):
+    """
+    Trains a bi-encoder whose cosine similarity between the claim and sentence embeddings
+    regresses the tanh score of the sentence retrieval cross-encoder.
+    """
+    mode = "base"
+    loss_names = ["loss"]
+    val_metric = "loss"
+
+    def __init__(self, hparams, **kwargs):
+        if type(hparams) == dict:
+            hparams = argparse.Namespace(**hparams)
+        # Plain BERT tokenizer, without the graph2text special tokens BaseTransformer adds
+        tokenizer = AutoTokenizer.from_pretrained(
+            hparams.tokenizer_name if hparams.tokenizer_name else hparams.model_name_or_path
+        )
+        super().__init__(hparams, num_labels=None, mode=self.mode, tokenizer=tokenizer, **kwargs)
+        self.num_workers = hparams.num_workers
+
+    def setup(self, stage: str = None):
+        # Called with a stage keyword by pytorch_lightning 2
+        self.train_loader = self.get_dataloader("train", self.hparams.train_batch_size, shuffle=True)
+
+    @property
+    def total_steps(self) -> int:
+        """Optimizer steps of the whole fit, for the lr scheduler, from the trainer devices and accumulation."""
+        return self.trainer.estimated_stepping_batches
+
+    def embed(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        output = self.model(input_ids=input_ids, attention_mask=attention_mask)
+        return mean_pool(output.last_hidden_state, attention_mask)
+
+    def _step(self, batch: dict) -> torch.Tensor:
+        claims = self.embed(batch['claim_input_ids'], batch['claim_attention_mask'])
+        sentences = self.embed(batch['sentence_input_ids'], batch['sentence_attention_mask'])
+        similarities = (claims * sentences).sum(dim=-1)
+        return torch.nn.functional.mse_loss(similarities, batch['scores'])
+
+    def training_step(self, batch, batch_idx) -> Dict:
+        loss = self._step(batch)
+        self.log('loss', loss, prog_bar=True)
+        return {'loss': loss}
+
+    def validation_step(self, batch, batch_idx) -> Dict:
+        loss = self._step(batch)
+        self.log('val_loss', loss, prog_bar=True)
+        self.log('val_avg_loss', loss)
+        return {'val_loss': loss}
+
+    def get_dataloader(self, type_path: str, batch_size: int, shuffle: bool = False) -> DataLoader:
+        dataset = DistillationPairsDataset(
+            self.tokenizer,
+            self.hparams.data_dir,
+            type_path,
+            self.hparams.max_seq_length,
+            n_obs=self.hparams.n_train if type_path == 'train' else self.hparams.n_val,
+        )
+        return DataLoader(
+            dataset,
+            batch_size=batch_size,
+            collate_fn=dataset.collate_fn,
+            shuffle=shuffle,
+            num_workers=self.num_workers,
+        )
+
+    @staticmethod
+    def add_model_specific_args(parser, root_dir):
+        BaseTransformer.add_model_specific_args(parser, root_dir)
+        add_generic_args(parser, root_dir)
+        parser.add_argument("--max_seq_length", default=128, type=int,
+                            help="Maximum tokens per claim or sentence.")
+        parser.add_argument("--n_train", type=int, default=-1, required=False, help="# examples. -1 means use all.")
+        parser.add_argument("--n_val", type=int, default=-1, required=False, help="# examples. -1 means use all.")
+        parser.add_argument("--save_top_k", type=int, default=1, required=False, help="How many checkpoints to save")
+        parser.add_argument("--label_pairs", type=str, default=None,
+                            help="JSON list of {claim, sentence} to label with the cross-encoder teacher.")
+        parser.add_argument("--dev_fraction", type=float, default=0.05,
+                            help="Fraction of the labelled pairs kept for validation.")
+        # Trainer options, pytorch_lightning 2 no longer derives them from the Trainer signature
+        parser.add_argument("--accelerator", type=str, default="auto", help="'cpu', 'gpu' or 'auto'.")
+        parser.add_argument("--devices", type=device_count, default="auto",
+                            help="Number of devices, or 'auto'.")
+        parser.add_argument("--val_check_interval", type=float, default=1.0,
+                            help="Fraction of a training epoch between two validations.")
+        return parser
+
+
+def device_count(value: str):
+    """--devices value: an integer or 'auto'."""
+    return value if value == "auto" else int(value)
+
+
+def label_pairs_with_teacher(pairs_path: str, data_dir: str, dev_fraction: float = 0.05, seed: int = 42) -> None:
+    """
+    Score (claim, sentence) pairs with the sentence retrieval cross-encoder and write the
+    train/dev splits used by DistillationPairsDataset.
+
+    Args:
+        pairs_path (str): JSON list of {"claim": ..., "sentence": ...} objects.
+        data_dir (str): Directory receiving train.jsonl and dev.jsonl.
+        dev_fraction (float): Fraction of the pairs kept for validation. Defaults to 0.05.
+        seed (int): Seed of the train/dev shuffle. Defaults to 42.
+    """
+    from utils.sentence_retrieval_module import SentenceRetrievalModule
+
+    with open(pairs_path, 'r') as file:
+        pairs = [(item['claim'], item['sentence']) for item in json.load(file)]
+
+    teacher = SentenceRetrievalModule(max_len=512)
+    scores = teacher.score_sentence_pairs(pairs)
+
+    examples = [
+        {'claim': claim, 'sentence': sentence, 'score': score}
+        for (claim, sentence), score in zip(pairs, scores)
+    ]
+    random.Random(seed).shuffle(examples)
+    n_dev = int(len(examples) * dev_fraction)
+
+    Path(data_dir).mkdir(parents=True, exist_ok=True)
+    for type_path, split in (('dev', examples[:n_dev]), ('train', examples[n_dev:])):
+        with open(os.path.join(data_dir, f"{type_path}.jsonl"), 'w') as file:
+            for example in split:
+                file.write(json.dumps(example) + '\n')
+
+
+def main(args, model=None) -> BiEncoderDistillationModule:
+    if args.label_pairs:
+        label_pairs_with_teacher(args.label_pairs, args.data_dir, args.dev_fraction, args.seed)
+        if not args.do_train:
+            return None
+
+    pl.seed_everything(args.seed)
+    Path(args.output_dir).mkdir(exist_ok=True)
+    if model is None:
+        model = BiEncoderDistillationModule(args)
+
+    # The best student is also saved with save_pretrained in <output_dir>/best_tfmr by on_save_checkpoint
+    checkpoint_callback = ModelCheckpoint(
+        dirpath=args.output_dir,
+        filename="{val_avg_loss:.4f}-{step}",
+        monitor="val_loss",
+        mode="min",
+        save_top_k=args.save_top_k,
+    )
+    trainer = pl.Trainer(
+        max_epochs=args.max_epochs,
+        accelerator=args.accelerator,
+        devices=args.devices,
+        gradient_clip_val=args.gradient_clip_val,
+        accumulate_grad_batches=args.accumulate_grad_batches,
+        precision="16-mixed" if args.fp16 else "32-true",
+        val_check_interval=args.val_check_interval,
+        num_sanity_val_steps=4,
+        default_root_dir=args.output_dir,
+        callbacks=[checkpoint_callback, LearningRateMonitor(logging_interval='step')],
+    )
+    if args.do_train:
+        trainer.fit(model)
+    return model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser = BiEncoderDistillationModule.add_model_specific_args(parser, os.getcwd())
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,166 @@
+import hashlib
+import os
+import tempfile
+from typing import List
+
+import numpy as np
+import torch
+from transformers import AutoModel, AutoTokenizer
+
+from utils.batching import length_bucketed_batches
+from utils.logger import logger
+
+DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+MAX_LEN = 128
+
+
+def mean_pool(last_hidden_state: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+    """Average the token embeddings of each sequence, ignoring padding, and L2-normalise them."""
+    mask = attention_mask.unsqueeze(-1).to(last_hidden_state.dtype)
+    summed = (last_hidden_state * mask).sum(dim=1)
+    pooled = summed / mask.sum(dim=1).clamp(min=1e-9)
+    return torch.nn.functional.normalize(pooled, p=2, dim=-1)
+
+
+class BiEncoderModule():
+    """
+    Bi-encoder distilled from the sentence retrieval cross-encoder (see
+    utils/bi_encoder_distillation.py). Claims and sentences are embedded independently, so page
+    sentence embeddings can be computed once and reused for every claim citing the page.
+
+    Args:
+        model_path (str): Directory written by the distillation run (``best_tfmr``).
+        max_len (int): Maximum tokens per text. Defaults to MAX_LEN.
+        batch_size (int): Maximum texts per forward pass. Defaults to 64.
+    """
+    def __init__(self, model_path: str, max_len: int = MAX_LEN, batch_size: int = 64):
+        self.max_len = max_len
+        self.batch_size = batch_size
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        self.model = AutoModel.from_pretrained(model_path)
+        self.model.to(DEVICE)
+        self.model.eval()
+        self.dim = self.model.config.hidden_size
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """
+        Embed texts into L2-normalised float32 vectors, in input order.
+
+        Args:
+            texts (List[str]): Claims or sentences.
+
+        Returns:
+            np.ndarray: Array of shape (len(texts), dim).
+        """
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        if not texts:
+            return embeddings
+
+        encodings = self.tokenizer(list(texts), truncation=True, max_length=self.max_len)
+        lengths = [len(input_ids) for input_ids in encodings['input_ids']]
+        for batch_indices in length_bucketed_batches(lengths, self.batch_size):
+            batch = self.tokenizer.pad(
+                [
+                    {
+                        'input_ids': encodings['input_ids'][idx],
+                        'attention_mask': encodings['attention_mask'][idx]
+                    }
+                    for idx in batch_indices
+                ],
+                padding='longest',
+                return_tensors='pt',
+            ).to(DEVICE)
+            with torch.no_grad():
+                output = self.model(input_ids=batch['input_ids'], attention_mask=batch['attention_mask'])
+            embeddings[batch_indices] = mean_pool(
+                output.last_hidden_state, batch['attention_mask']
+            ).cpu().numpy()
+        return embeddings
+
+
+class SentenceEmbeddingIndex():
+    """
+    On-disk index of page sentence embeddings. Each page is stored once, under the hash of its
+    sentences, as a ``.npy`` file that is memory-mapped on read, so the embeddings are shared by
+    every worker on the host through the page cache.
+
+    Args:
+        index_dir (str): Directory holding the embedding files.
+        encoder (BiEncoderModule): Encoder used for pages that are not indexed yet.
+    """
+    def __init__(self, index_dir: str, encoder: BiEncoderModule):
+        self.index_dir = index_dir
+        self.encoder = encoder
+        os.makedirs(index_dir, exist_ok=True)
+
+    @staticmethod
+    def content_hash(sentences: List[str]) -> str:
+        return hashlib.sha1('\n'.join(sentences).encode('utf-8')).hexdigest()
+
+    def get_embeddings(self, sentences: List[str]) -> np.ndarray:
+        """
+        Embeddings of all the sentences of a page, computed on the first request only.
+
+        Args:
+            sentences (List[str]): Sentences of the page, in document order.
+
+        Returns:
+            np.ndarray: Read-only memory-mapped array of shape (len(sentences), dim).
+        """
+        path = os.path.join(self.index_dir, f"{self.content_hash(sentences)}.npy")
+        if os.path.exists(path):
+            try:
+                embeddings = np.load(path, mmap_mode='r')
+                if embeddings.shape[0] == len(sentences):
+                    return embeddings
+            except (ValueError, OSError) as e:
+                logger.error(f"Corrupted sentence embeddings {path}: {e}")
+
+        embeddings = self.encoder.encode(sentences)
+        # Write to a temporary file first so concurrent readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.index_dir, suffix='.npy.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            np.save(file, embeddings)
+        os.replace(tmp_path, path)
+        return np.load(path, mmap_mode='r')
+
+
+class BiEncoderPreRanker():
+    """
+    Cheap first stage of sentence retrieval: ranks the candidate sentences of a page by dot
+    product with the claim embedding and keeps the top_n for the cross-encoder to rerank.
+
+    Args:
+        model_path (str): Directory of the distilled bi-encoder.
+        index_dir (str): Directory of the sentence embedding index.
+        top_n (int): Number of candidates kept for the cross-encoder. Defaults to 30.
+        batch_size (int): Maximum texts per bi-encoder forward pass. Defaults to 64.
+    """
+    def __init__(self, model_path: str, index_dir: str, top_n: int = 30, batch_size: int = 64):
+        self.encoder = BiEncoderModule(model_path, batch_size=batch_size)
+        self.index = SentenceEmbeddingIndex(index_dir, self.encoder)
+        self.top_n = top_n
+
+    def encode_claims(self, claims: List[str]) -> np.ndarray:
+        return self.encoder.encode(claims)
+
+    def select(self, claim_embedding: np.ndarray, sentences: List[str], candidate_indices: List[int]) -> List[int]:
+        """
+        Keep the top_n candidates closest to the claim.
+
+        Args:
+            claim_embedding (np.ndarray): Embedding of the claim, shape (dim,).
+            sentences (List[str]): All sentences of the page.
+            candidate_indices (List[int]): Indices of the sentences still in the running.
+
+        Returns:
+            List[int]: Sorted indices of the retained sentences.
+        """
+        if len(candidate_indices) <= self.top_n:
+            return candidate_indices
+
+        embeddings = self.index.get_embeddings(sentences)
+        candidate_indices = np.asarray(candidate_indices)
+        scores = np.asarray(embeddings[candidate_indices]) @ claim_embedding
+        top_positions = np.argpartition(scores, -self.top_n)[-self.top_n:]
+        return sorted(candidate_indices[top_positions].tolist())
@@ -0,0 +1,275 @@
+"""
+CPU thread topology of the pipeline workers.
+
+Left alone, every worker of a host lets PyTorch start one intra-op thread per core, so several
+workers oversubscribe the CPUs. The ``threads`` section of config.yaml sets the intra-op and
+inter-op threads of each worker, with the OpenMP/MKL environment variables for the libraries
+initialised later. With ``pin_workers`` each worker is pinned to its own slice of the CPUs.
+
+With ``tune`` enabled, a self-benchmark run when the models are loaded picks the thread count and
+batch size of each model for the CPUs of one worker. The picks are stored in ``tuning_file`` and
+reused while the host, the CPU count and the models stay the same. The thread count is global to
+the process and the models may run concurrently (e.g. in the inference server), so it is applied
+once, as the largest of the picks, rather than switched around each forward pass.
+"""
+import json
+import os
+import socket
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import torch
+
+from utils.logger import logger
+
+TUNING_WORDS = (
+    'the of and in to was a is for on as by with he she it at from his her that which were '
+    'born city river prize tower located award member country university published first'
+).split()
+TUNING_BATCH_SIZES = [8, 16, 32, 64]
+
+# CPUs the process started with, before any pinning: forked workers inherit the pinning of the
+# process they come from, so their share is always taken from this list
+HOST_CPUS: List[int] = sorted(os.sched_getaffinity(0))
+
+# Intra-op threads picked by apply_tuning, kept by the workers forked after it
+tuned_threads: Optional[int] = None
+
+
+def worker_cpus(config: Dict, worker_index: int = 0) -> List[int]:
+    """
+    CPUs available to a worker: the configured ones or those the process started with, split
+    evenly between the forked workers when they are pinned.
+
+    Args:
+        config (Dict): Loaded config.yaml.
+        worker_index (int): Index of the worker among workers.processes. Defaults to 0.
+    """
+    threads_config = config.get('threads', {})
+    cpus = sorted(threads_config.get('cpus') or HOST_CPUS)
+    n_workers = max(1, config.get('workers', {}).get('processes', 1))
+    if not threads_config.get('pin_workers', False) or n_workers == 1:
+        return cpus
+    per_worker = max(1, len(cpus) // n_workers)
+    start = (worker_index * per_worker) % len(cpus)
+    return cpus[start:start + per_worker]
+
+
+def configure_threads(config: Dict, worker_index: int = 0) -> Optional[int]:
+    """
+    Apply the thread settings of config.yaml to this process.
+
+    Without an explicit threads.intra_op, the count picked by apply_tuning is used if any, then a
+    single unpinned worker keeps the PyTorch default and otherwise each worker gets one thread per
+    CPU of its share.
+
+    Args:
+        config (Dict): Loaded config.yaml.
+        worker_index (int): Index of the worker among workers.processes. Defaults to 0.
+
+    Returns:
+        Optional[int]: The intra-op thread count set, None if the default was kept.
+    """
+    threads_config = config.get('threads', {})
+    n_workers = max(1, config.get('workers', {}).get('processes', 1))
+    pinned = threads_config.get('pin_workers', False)
+    cpus = worker_cpus(config, worker_index)
+    if pinned or threads_config.get('cpus'):
+        os.sched_setaffinity(0, cpus)
+
+    intra_op = threads_config.get('intra_op', 0) or tuned_threads
+    if not intra_op and (pinned or n_workers > 1):
+        intra_op = max(1, len(cpus) // (1 if pinned else n_workers))
+    if intra_op:
+        set_intra_op_threads(intra_op)
+
+    inter_op = threads_config.get('inter_op', 0)
+    if inter_op and inter_op != torch.get_num_interop_threads():
+        try:
+            torch.set_num_interop_threads(inter_op)
+        except RuntimeError as e:
+            # Only possible before the first inter-op parallel work of the process
+            logger.warning(f"Could not set {inter_op} inter-op threads: {e}")
+
+    logger.info(f"Worker {worker_index}: CPUs {cpus}, {torch.get_num_threads()} intra-op threads")
+    return intra_op or None
+
+
+def set_intra_op_threads(num_threads: int) -> None:
+    """Set the intra-op threads of the process."""
+    # Read by OpenMP/MKL when they are first initialised, e.g. in the ONNX Runtime sessions
+    os.environ['OMP_NUM_THREADS'] = str(num_threads)
+    os.environ['MKL_NUM_THREADS'] = str(num_threads)
+    torch.set_num_threads(num_threads)
+
+
+@contextmanager
+def intra_op_threads(num_threads: Optional[int]):
+    """Run the body with num_threads PyTorch intra-op threads, or unchanged when None. Only for the
+    tuning runs, which run one model at a time."""
+    if not num_threads:
+        yield
+        return
+    previous = torch.get_num_threads()
+    torch.set_num_threads(num_threads)
+    try:
+        yield
+    finally:
+        torch.set_num_threads(previous)
+
+
+def _tuning_pairs(size: int) -> List[tuple]:
+    # Deterministic claim/sentence pairs of a few dozen words, like the bulk of page sentences
+    words = TUNING_WORDS
+    return [
+        (
+            ' '.join(words[(i + j) % len(words)] for j in range(8)) + '.',
+            ' '.join(words[(i * 7 + j) % len(words)] for j in range(12 + i % 40)) + '.',
+        )
+        for i in range(size)
+    ]
+
+
+def _tuning_runs(name: str, module) -> Optional[tuple]:
+    # Input builder and batch function of each tunable model, without its cache
+    if getattr(module, 'model', None) is None:
+        return None
+    if name == 'retrieval':
+        return _tuning_pairs(256), lambda pairs, batch_size: module.compute_sentence_pair_scores(pairs, batch_size)
+    if name == 'entailment':
+        return _tuning_pairs(256), lambda pairs, batch_size: module.compute_batch_scores(pairs, batch_size)
+
+    def verbalise(inputs, batch_size):
+        previous, module.batch_size = module.batch_size, batch_size
+        try:
+            return module.verbalise_batch(inputs)
+        finally:
+            module.batch_size = previous
+
+    inputs = [
+        f'translate Graph to English: <H> {subject} <R> located in <T> {sentence}'
+        for subject, sentence in _tuning_pairs(64)
+    ]
+    return inputs, verbalise
+
+
+def _throughput(function, inputs: List, batch_size: int, num_threads: int) -> float:
+    with intra_op_threads(num_threads):
+        # The first pass warms up the thread pool and the allocator
+        function(inputs[:batch_size], batch_size)
+        start = time.perf_counter()
+        function(inputs, batch_size)
+    return len(inputs) / (time.perf_counter() - start)
+
+
+def tune_model(name: str, module, cpus: List[int], batch_size: int) -> Optional[Dict]:
+    """
+    Pick the thread count, then the batch size, with the best throughput for one model.
+
+    Args:
+        name (str): 'retrieval', 'entailment' or 'verbalisation'.
+        module: The pipeline module of the model.
+        cpus (List[int]): CPUs of one worker.
+        batch_size (int): Configured batch size, used while the thread counts are compared.
+
+    Returns:
+        Optional[Dict]: num_threads, batch_size and items_per_second, None for models without
+            a PyTorch model in this process.
+    """
+    runs = _tuning_runs(name, module)
+    if runs is None:
+        return None
+    inputs, function = runs
+
+    thread_counts = sorted({min(2 ** power, len(cpus)) for power in range(len(cpus).bit_length())} | {len(cpus)})
+    best_threads = max(thread_counts, key=lambda n: _throughput(function, inputs, batch_size, n))
+    throughputs = {size: _throughput(function, inputs, size, best_threads) for size in TUNING_BATCH_SIZES}
+    best_batch_size = max(throughputs, key=throughputs.get)
+    result = {
+        'num_threads': best_threads,
+        'batch_size': best_batch_size,
+        'items_per_second': round(throughputs[best_batch_size], 1),
+    }
+    logger.info(f"Tuned {name} model on {len(cpus)} CPUs: {result}")
+    return result
+
+
+def tune_models(models: tuple, config: Dict) -> Dict[str, Dict]:
+    """
+    Tune the models of ProVe_main_process.load_models for the CPUs of one worker, reusing the
+    results stored in threads.tuning_file while the host and the models are unchanged.
+
+    Args:
+        models (tuple): (text_entailment, sentence_retrieval, verb_module).
+        config (Dict): Loaded config.yaml.
+
+    Returns:
+        Dict[str, Dict]: Tuning result per model name.
+    """
+    text_entailment, sentence_retrieval, verb_module = models
+    modules = {'retrieval': sentence_retrieval, 'entailment': text_entailment, 'verbalisation': verb_module}
+    batch_sizes = {
+        'retrieval': config.get('evidence_selection', {}).get('batch_size', 32),
+        'entailment': config.get('entailment', {}).get('batch_size', 32),
+        'verbalisation': config.get('verbalisation', {}).get('batch_size', 32),
+    }
+    tuning_file = config.get('threads', {}).get('tuning_file', 'thread_tuning.json')
+    stored = {}
+    if os.path.exists(tuning_file):
+        with open(tuning_file, 'r') as file:
+            stored = json.load(file)
+
+    cpus = worker_cpus(config)
+    if not config.get('threads', {}).get('pin_workers', False):
+        # Unpinned workers share all the CPUs, each with its part of them
+        cpus = cpus[:max(1, len(cpus) // max(1, config.get('workers', {}).get('processes', 1)))]
+    previous_affinity = os.sched_getaffinity(0)
+    tuning = {}
+    try:
+        os.sched_setaffinity(0, cpus)
+        for name, module in modules.items():
+            key = f"{socket.gethostname()}-{len(cpus)}-{getattr(module, 'model_id', '')}"
+            if stored.get(name, {}).get('key') == key:
+                tuning[name] = stored[name]
+                continue
+            with torch.no_grad():
+                result = tune_model(name, module, cpus, batch_sizes[name])
+            if result is not None:
+                tuning[name] = {'key': key, **result}
+    finally:
+        os.sched_setaffinity(0, previous_affinity)
+
+    with open(tuning_file, 'w') as file:
+        json.dump({**stored, **tuning}, file, indent=2)
+    return tuning
+
+
+def apply_tuning(models: tuple, tuning: Dict[str, Dict], config: Dict) -> Optional[int]:
+    """
+    Set the tuned batch size on each module, it overrides the configured one, and the tuned
+    intra-op threads on the process, unless threads.intra_op sets them explicitly.
+
+    The thread count cannot differ per model without switching the global setting around every
+    forward pass, which goes wrong when the models run concurrently, so the largest pick is used.
+
+    Args:
+        models (tuple): (text_entailment, sentence_retrieval, verb_module).
+        tuning (Dict[str, Dict]): From tune_models.
+        config (Dict): Loaded config.yaml.
+
+    Returns:
+        Optional[int]: The intra-op thread count set, None if it was left unchanged.
+    """
+    global tuned_threads
+    text_entailment, sentence_retrieval, verb_module = models
+    modules = {'retrieval': sentence_retrieval, 'entailment': text_entailment, 'verbalisation': verb_module}
+    for name, result in tuning.items():
+        modules[name].batch_size = result['batch_size']
+
+    if not tuning or config.get('threads', {}).get('intra_op', 0):
+        return None
+    tuned_threads = max(result['num_threads'] for result in tuning.values())
+    set_intra_op_threads(tuned_threads)
+    logger.info(f"Tuned models use {tuned_threads} intra-op threads")
+    return tuned_threads
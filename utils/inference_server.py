@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+"""
+Shared-model inference server for the pipeline workers of a host.
+
+1. Start one server per host, which loads the models once:
+
+    python -m utils.inference_server --config config.yaml
+
+2. Set ``inference_server.enabled`` to true in config.yaml. ``ProVe_main_process.initialize_models``
+   then returns remote modules instead of loading the models in every worker.
+
+Workers talk to the server over a Unix socket with length-prefixed JSON frames. Requests for
+the same model that arrive within ``max_wait_ms`` of each other, from any worker, are merged into
+one micro-batch of at most ``max_batch_items`` inputs, run through the usual length-bucketed
+batching and split back per request. The score and verbalisation caches live in the server.
+The bi-encoder pre-ranker and its sentence index stay in the workers, which share the
+memory-mapped index through the page cache.
+"""
+import argparse
+import json
+import os
+import queue
+import socket
+import socketserver
+import struct
+import time
+from concurrent.futures import Future
+from threading import Lock, Thread
+from typing import Any, Callable, Dict, List, Tuple
+
+import numpy as np
+
+from utils.logger import logger
+from utils.sentence_retrieval_module import SentenceRetrievalModule
+from utils.textual_entailment_module import TextualEntailmentModule
+from utils.verbalisation_module import UnkReplacer, VerbModule
+
+FRAME_HEADER = struct.Struct('>I')
+
+
+def send_frame(connection: socket.socket, message: Dict) -> None:
+    payload = json.dumps(message).encode('utf-8')
+    connection.sendall(FRAME_HEADER.pack(len(payload)) + payload)
+
+
+def _receive_exactly(connection: socket.socket, size: int) -> bytes:
+    chunks = []
+    while size:
+        chunk = connection.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ConnectionError('Inference server connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def receive_frame(connection: socket.socket) -> Dict:
+    (size,) = FRAME_HEADER.unpack(_receive_exactly(connection, FRAME_HEADER.size))
+    return json.loads(_receive_exactly(connection, size).decode('utf-8'))
+
+
+class MicroBatcher():
+    """
+    Merges the inputs of concurrent requests into one call of a batch function.
+
+    A background thread takes the first waiting request, then keeps collecting requests until
+    max_wait seconds have passed or max_items inputs are gathered, and runs them together.
+
+    Args:
+        function (Callable): Maps a list of inputs to one result per input, in order.
+        max_wait (float): Seconds a request may wait for others to join its batch.
+        max_items (int): Inputs beyond which no more requests join the batch.
+
+    Attributes:
+        stats (Dict[str, int]): Number of requests, batches and inputs processed.
+    """
+    def __init__(self, function: Callable[[List], List], max_wait: float, max_items: int):
+        self.function = function
+        self.max_wait = max_wait
+        self.max_items = max_items
+        self.requests: queue.Queue = queue.Queue()
+        self.stats = {'requests': 0, 'batches': 0, 'items': 0}
+        # Set when the batch thread died, later requests fail instead of waiting forever
+        self.error = None
+        self.lock = Lock()
+        Thread(target=self._run, daemon=True).start()
+
+    def submit(self, items: List) -> List:
+        """Run items in the next micro-batch and wait for their results."""
+        if not items:
+            return []
+        future = Future()
+        with self.lock:
+            if self.error is not None:
+                raise RuntimeError(f"Inference batch thread stopped: {self.error!r}") from self.error
+            self.requests.put((items, future))
+        return future.result()
+
+    def _collect(self) -> List[Tuple[List, Future]]:
+        batch = [self.requests.get()]
+        n_items = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while n_items < self.max_items:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(request)
+            n_items += len(request[0])
+        return batch
+
+    def _run_batch(self, batch: List[Tuple[List, Future]]) -> None:
+        items = [item for request_items, _ in batch for item in request_items]
+        try:
+            results = self.function(items)
+        except Exception as e:
+            logger.error(f"Inference batch of {len(items)} inputs failed: {e}")
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            # Run every request on its own, so only those whose own inputs fail get an error
+            for request_items, future in batch:
+                try:
+                    future.set_result(self.function(request_items))
+                except Exception as request_error:
+                    future.set_exception(request_error)
+            self.stats['requests'] += len(batch)
+            self.stats['batches'] += len(batch)
+            self.stats['items'] += len(items)
+            return
+
+        self.stats['requests'] += len(batch)
+        self.stats['batches'] += 1
+        self.stats['items'] += len(items)
+        offset = 0
+        for request_items, future in batch:
+            future.set_result(results[offset:offset + len(request_items)])
+            offset += len(request_items)
+
+    def _run(self) -> None:
+        batch = []
+        try:
+            while True:
+                batch = self._collect()
+                self._run_batch(batch)
+        except BaseException as e:
+            logger.fatal(f"Inference batch thread stopped: {e!r}")
+            with self.lock:
+                self.error = e
+                pending = [future for _, future in batch]
+                while not self.requests.empty():
+                    pending.append(self.requests.get_nowait()[1])
+            for future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            raise
+
+
+class InferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves the models of one process to the pipeline workers of the host.
+
+    Args:
+        socket_path (str): Path of the Unix socket.
+        models (tuple): (text_entailment, sentence_retrieval, verb_module) as returned by
+            ProVe_main_process.load_models.
+        config (Dict): Loaded config.yaml, for the batching settings.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, models: tuple, config: Dict):
+        self.text_entailment, self.sentence_retrieval, self.verb_module = models
+        server_config = config.get('inference_server', {})
+        max_wait = server_config.get('max_wait_ms', 10) / 1000
+        max_items = server_config.get('max_batch_items', 1024)
+        selection_config = config.get('evidence_selection', {})
+        entailment_config = config.get('entailment', {})
+
+        self.batchers = {
+            'retrieval': MicroBatcher(
+                lambda pairs: np.asarray(self.sentence_retrieval.score_sentence_pairs(
+                    [tuple(pair) for pair in pairs],
+                    batch_size=selection_config.get('batch_size', 32),
+                    token_budget=selection_config.get('token_size')
+                ), dtype=float).tolist(),
+                max_wait, max_items
+            ),
+            'entailment': MicroBatcher(
+                lambda pairs: np.asarray(self.text_entailment.get_batch_scores(
+                    claims=[claim for claim, _ in pairs],
+                    evidence=[sentence for _, sentence in pairs],
+                    batch_size=entailment_config.get('batch_size', 32),
+                    token_budget=entailment_config.get('token_size')
+                ), dtype=float).tolist(),
+                max_wait, max_items
+            ),
+            'verbalisation': MicroBatcher(self.verb_module.verbalise_inputs, max_wait, max_items),
+        }
+        self.methods: Dict[str, Callable[..., Any]] = {
+            'count_tokens': lambda texts: self.text_entailment.count_tokens(texts),
+            'unknowns': lambda labels: self.verb_module.new_unk_replacer(labels).unknowns,
+            'cache_metrics': self.cache_metrics,
+            'stats': lambda: {name: dict(batcher.stats) for name, batcher in self.batchers.items()},
+        }
+
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, InferenceRequestHandler)
+
+    def cache_metrics(self, cache: str) -> Dict:
+        store = self.text_entailment.score_cache if cache == 'score_cache' else self.verb_module.verbalisation_cache
+        return store.metrics() if store is not None else {}
+
+    def dispatch(self, request: Dict) -> Any:
+        method, args = request['method'], request.get('args', {})
+        if method in self.batchers:
+            return self.batchers[method].submit(args['items'])
+        if method in self.methods:
+            return self.methods[method](**args)
+        raise ValueError(f"Unknown inference method: {method}")
+
+
+class InferenceRequestHandler(socketserver.BaseRequestHandler):
+    """Answers the requests of one worker connection until it closes."""
+    def handle(self):
+        while True:
+            try:
+                request = receive_frame(self.request)
+            except (ConnectionError, OSError):
+                return
+            try:
+                response = {'result': self.server.dispatch(request)}
+            except Exception as e:
+                response = {'error': f"{type(e).__name__}: {e}"}
+            send_frame(self.request, response)
+
+
+class InferenceClient():
+    """
+    Connection of a worker to the inference server, shared by its remote modules.
+
+    Args:
+        socket_path (str): Path of the server's Unix socket.
+        connect_timeout (float): Seconds to wait for the server to come up. Defaults to 60.
+    """
+    def __init__(self, socket_path: str, connect_timeout: float = 60):
+        self.socket_path = socket_path
+        self.lock = Lock()
+        deadline = time.monotonic() + connect_timeout
+        while True:
+            try:
+                self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.connection.connect(socket_path)
+                break
+            except OSError:
+                self.connection.close()
+                if time.monotonic() > deadline:
+                    raise ConnectionError(f"No inference server listening on {socket_path}")
+                time.sleep(1)
+
+    def call(self, method: str, **args) -> Any:
+        with self.lock:
+            send_frame(self.connection, {'method': method, 'args': args})
+            response = receive_frame(self.connection)
+        if 'error' in response:
+            raise RuntimeError(f"Inference server {method} failed: {response['error']}")
+        return response['result']
+
+
+class RemoteCacheMetrics():
+    """Stands in for a cache of the server where only its metrics are read."""
+    def __init__(self, client: InferenceClient, cache: str):
+        self.client = client
+        self.cache = cache
+
+    def metrics(self) -> Dict:
+        return self.client.call('cache_metrics', cache=self.cache)
+
+
+class RemoteSentenceRetrievalModule(SentenceRetrievalModule):
+    """SentenceRetrievalModule scoring on the inference server."""
+    def __init__(self, client: InferenceClient, pre_ranker=None):
+        self.client = client
+        self.score_cache = None
+        self.pre_ranker = pre_ranker
+
+    def score_sentence_pairs(self, inputs, batch_size=32, token_budget=None):
+        return self.client.call('retrieval', items=[list(pair) for pair in inputs])
+
+    def compute_sentence_pair_scores(self, inputs, batch_size=32, token_budget=None):
+        return self.score_sentence_pairs(inputs, batch_size, token_budget)
+
+
+class RemoteTextualEntailmentModule(TextualEntailmentModule):
+    """TextualEntailmentModule scoring on the inference server; the label helpers run locally."""
+    def __init__(self, client: InferenceClient):
+        self.client = client
+        self.score_cache = RemoteCacheMetrics(client, 'score_cache')
+
+    def get_batch_scores(self, claims, evidence, batch_size=32, token_budget=None):
+        pairs = [[claim, sentence] for claim, sentence in zip(claims, evidence)]
+        return np.asarray(self.client.call('entailment', items=pairs), dtype=np.float32).reshape(-1, 3)
+
+    def compute_batch_scores(self, inputs, batch_size=32, token_budget=None):
+        claims, evidence = zip(*inputs) if inputs else ((), ())
+        return self.get_batch_scores(claims, evidence, batch_size, token_budget)
+
+    def count_tokens(self, texts):
+        return self.client.call('count_tokens', texts=list(texts))
+
+
+class RemoteVerbModule(VerbModule):
+    """VerbModule generating on the inference server; <unk> replacement runs locally."""
+    def __init__(self, client: InferenceClient):
+        self.client = client
+        self.verbalisation_cache = RemoteCacheMetrics(client, 'verbalisation_cache')
+
+    def verbalise_inputs(self, inputs: List[str]) -> List[str]:
+        return self.client.call('verbalisation', items=list(inputs))
+
+    def new_unk_replacer(self, labels: List[str] = ()) -> UnkReplacer:
+        # Labels are analysed with the server's tokenizer
+        return UnkReplacer.from_unknowns(self.client.call('unknowns', labels=list(labels)))
+
+
+def connect_models(config: Dict) -> tuple:
+    """
+    Remote stand-ins for the models of ProVe_main_process.load_models.
+
+    Args:
+        config (Dict): Loaded config.yaml.
+
+    Returns:
+        tuple: (text_entailment, sentence_retrieval, verb_module) backed by the inference server.
+    """
+    from ProVe_main_process import initialize_pre_ranker
+
+    server_config = config.get('inference_server', {})
+    client = InferenceClient(
+        server_config.get('socket_path', '/tmp/prove_inference.sock'),
+        server_config.get('connect_timeout', 60)
+    )
+    return (
+        RemoteTextualEntailmentModule(client),
+        RemoteSentenceRetrievalModule(client, pre_ranker=initialize_pre_ranker(config)),
+        RemoteVerbModule(client),
+    )
+
+
+if __name__ == '__main__':
+    import ProVe_main_process
+
+    parser = argparse.ArgumentParser(description='Serve the ProVe models to the pipeline workers of this host')
+    parser.add_argument('--config', default='config.yaml')
+    args = parser.parse_args()
+
+    config = ProVe_main_process.load_config(args.config)
+    socket_path = config.get('inference_server', {}).get('socket_path', '/tmp/prove_inference.sock')
+    server = InferenceServer(socket_path, ProVe_main_process.load_models(config), config)
+    logger.info(f"Inference server listening on {socket_path}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
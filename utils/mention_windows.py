@@ -0,0 +1,174 @@
+import ast
+import calendar
+import re
+import unicodedata
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+MONTH_NAMES = list(calendar.month_name)
+MONTH_ABBREVIATIONS = list(calendar.month_abbr)
+
+# Wikidata time precisions (https://www.wikidata.org/wiki/Help:Dates#Precision)
+PRECISION_YEAR = 9
+PRECISION_MONTH = 10
+PRECISION_DAY = 11
+
+MIN_SURFACE_FORM_LENGTH = 2
+
+
+def normalise_text(text: str) -> str:
+    """
+    Case-fold a string and strip its diacritics so that 'Zürich' and 'zurich' compare equal.
+
+    Args:
+        text (str): Text to normalise.
+
+    Returns:
+        str: Normalised text with collapsed whitespace.
+    """
+    decomposed = unicodedata.normalize('NFKD', text.casefold())
+    stripped = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return re.sub(r'\s+', ' ', stripped).strip()
+
+
+def parse_datavalue(datavalue: Any) -> Optional[Dict[str, Any]]:
+    """
+    Parse the stringified Wikidata datavalue stored by the parser.
+
+    Args:
+        datavalue (Any): Datavalue as stored in the claims DataFrame, usually the ``str`` of a dict.
+
+    Returns:
+        Optional[Dict[str, Any]]: The parsed datavalue or None if it cannot be parsed.
+    """
+    if isinstance(datavalue, dict):
+        return datavalue
+    if not isinstance(datavalue, str):
+        return None
+    try:
+        parsed = ast.literal_eval(datavalue)
+    except (ValueError, SyntaxError):
+        return None
+    return parsed if isinstance(parsed, dict) else None
+
+
+def date_surface_forms(time_value: Dict[str, Any]) -> Set[str]:
+    """
+    Build the usual textual renderings of a Wikidata time value, honouring its precision.
+
+    Args:
+        time_value (Dict[str, Any]): The ``value`` of a time datavalue, with 'time' and 'precision'.
+
+    Returns:
+        Set[str]: Date variants such as '1952', 'march 1952', '11 march 1952' or '1952-03-11'.
+    """
+    match = re.match(r'^([+-])0*(\d+)-(\d{2})-(\d{2})', time_value.get('time', ''))
+    if not match or match.group(1) == '-':
+        return set()
+
+    year, month, day = int(match.group(2)), int(match.group(3)), int(match.group(4))
+    precision = time_value.get('precision', PRECISION_DAY)
+    if precision < PRECISION_YEAR:
+        return set()
+
+    forms = {str(year)}
+    if precision >= PRECISION_MONTH and 1 <= month <= 12:
+        for name in (MONTH_NAMES[month], MONTH_ABBREVIATIONS[month]):
+            forms.add(f'{name} {year}')
+        forms.add(f'{year}-{month:02d}')
+    if precision >= PRECISION_DAY and 1 <= month <= 12 and 1 <= day <= 31:
+        for name in (MONTH_NAMES[month], MONTH_ABBREVIATIONS[month]):
+            forms.update({
+                f'{day} {name} {year}',
+                f'{name} {day}, {year}',
+                f'{name} {day} {year}',
+            })
+        forms.update({
+            f'{year}-{month:02d}-{day:02d}',
+            f'{day:02d}/{month:02d}/{year}',
+            f'{month:02d}/{day:02d}/{year}',
+            f'{day}.{month}.{year}',
+            f'{day:02d}.{month:02d}.{year}',
+        })
+    return {normalise_text(form) for form in forms}
+
+
+def claim_surface_forms(
+    entity_label: Optional[str] = None,
+    object_label: Optional[str] = None,
+    datavalue: Any = None
+) -> Set[str]:
+    """
+    Collect the normalised surface forms a supporting sentence is expected to mention.
+
+    Args:
+        entity_label (Optional[str]): Label of the subject entity.
+        object_label (Optional[str]): Label of the object entity, if the claim has one.
+        datavalue (Any): Raw claim datavalue, used for dates and literal string objects.
+
+    Returns:
+        Set[str]: Normalised surface forms, empty when nothing usable is available.
+    """
+    forms = set()
+    for label in (entity_label, object_label):
+        if isinstance(label, str) and not label.startswith('No label'):
+            forms.add(normalise_text(label))
+
+    parsed = parse_datavalue(datavalue)
+    if parsed:
+        value = parsed.get('value')
+        if parsed.get('type') == 'time' and isinstance(value, dict):
+            forms.update(date_surface_forms(value))
+        elif parsed.get('type') == 'string' and isinstance(value, str):
+            forms.add(normalise_text(value))
+        elif parsed.get('type') == 'monolingualtext' and isinstance(value, dict):
+            forms.add(normalise_text(value.get('text', '')))
+
+    return {form for form in forms if len(form) >= MIN_SURFACE_FORM_LENGTH}
+
+
+def compile_mention_pattern(surface_forms: Iterable[str]) -> Optional[re.Pattern]:
+    """
+    Compile surface forms into one alternation matching whole words only.
+
+    Args:
+        surface_forms (Iterable[str]): Normalised surface forms.
+
+    Returns:
+        Optional[re.Pattern]: Compiled pattern, or None when there are no surface forms.
+    """
+    # Longest first, so that '11 march 1952' wins over '1952' at the same position
+    forms = sorted(set(surface_forms), key=len, reverse=True)
+    if not forms:
+        return None
+    alternation = '|'.join(re.escape(form) for form in forms)
+    return re.compile(rf'(?<!\w)(?:{alternation})(?!\w)')
+
+
+def find_mention_windows(
+    sentences: List[str],
+    surface_forms: Iterable[str],
+    window_size: int
+) -> List[int]:
+    """
+    Find the sentences mentioning any surface form and expand them into ±window_size windows.
+
+    Args:
+        sentences (List[str]): Sentences of a reference, in document order.
+        surface_forms (Iterable[str]): Normalised surface forms to look for.
+        window_size (int): Number of sentences kept on each side of a mention.
+
+    Returns:
+        List[int]: Sorted indices of the sentences inside any window, empty if nothing matches.
+    """
+    pattern = compile_mention_pattern(surface_forms)
+    if pattern is None:
+        return []
+
+    window_size = max(0, int(window_size))
+    selected = set()
+    for idx, sentence in enumerate(sentences):
+        if pattern.search(normalise_text(sentence)):
+            start = max(0, idx - window_size)
+            end = min(len(sentences), idx + window_size + 1)
+            selected.update(range(start, end))
+    return sorted(selected)
@@ -248,6 +248,7 @@ class MongoDBHandler:
                 - task_id: Identifier for the task associated with the entity.
                 - parsing_start_timestamp: Timestamp when parsing started.
                 - save_timestamp: Timestamp when the stats were saved.
+                - stages: Seconds, counts and bytes of every pipeline stage of the task.
         
         Raises:
             RuntimeError: If there is an error while saving parser statistics to MongoDB.
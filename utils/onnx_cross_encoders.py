@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""
+ONNX Runtime backend for the sentence retrieval and textual entailment cross-encoders.
+
+1. Export the checkpoints once per host:
+
+    python -m utils.onnx_cross_encoders --output_dir /home/ubuntu/RQV/base/cross_encoders_onnx
+
+2. Set ``cross_encoders.backend`` to 'onnx' and ``cross_encoders.onnx_dir`` to the output directory
+   in config.yaml.
+
+Both graphs have dynamic batch and sequence axes, so the length-bucketed batches of
+SentenceRetrievalModule and TextualEntailmentModule run unchanged. After each export the graph is
+run on a few pairs and compared with PyTorch, and the export fails if they disagree.
+"""
+import argparse
+import inspect
+import os
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+import torch
+
+from utils.logger import logger
+
+RETRIEVAL_FILE = 'retrieval.onnx'
+ENTAILMENT_FILE = 'entailment.onnx'
+OPSET = 14
+TOLERANCE = 1e-4
+
+VERIFICATION_PAIRS = [
+    ('Douglas Adams was born in Cambridge.', 'Adams was born in Cambridge, England, on 11 March 1952.'),
+    ('The Eiffel Tower is located in Paris.', 'It is named after the engineer Gustave Eiffel.'),
+    ('Marie Curie received the Nobel Prize in Physics.', 'She shared the 1903 prize with Pierre Curie and Henri Becquerel.'),
+]
+
+
+class EntailmentWrapper(torch.nn.Module):
+    """BertForSequenceClassification returning its logits only."""
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask, return_dict=True).logits
+
+
+def create_session(path: str, intra_op_threads: int = 0, inter_op_threads: int = 0):
+    """
+    Open an ONNX Runtime session on the best available provider.
+
+    Args:
+        path (str): The ONNX graph.
+        intra_op_threads (int): Threads used inside an operator, 0 lets ONNX Runtime decide.
+        inter_op_threads (int): Threads used across operators, 0 lets ONNX Runtime decide.
+    """
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = intra_op_threads
+    options.inter_op_num_threads = inter_op_threads
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    providers = [
+        provider for provider in ('CUDAExecutionProvider', 'CPUExecutionProvider')
+        if provider in ort.get_available_providers()
+    ]
+    return ort.InferenceSession(path, options, providers=providers)
+
+
+class OnnxCrossEncoder():
+    """
+    Runs an exported cross-encoder graph, feeding only the inputs the graph declares.
+
+    Args:
+        path (str): Graph written by export_retrieval or export_entailment.
+        intra_op_threads (int): Threads used inside an operator, 0 lets ONNX Runtime decide.
+        inter_op_threads (int): Threads used across operators, 0 lets ONNX Runtime decide.
+    """
+    def __init__(self, path: str, intra_op_threads: int = 0, inter_op_threads: int = 0):
+        self.path = path
+        self.session = create_session(path, intra_op_threads, inter_op_threads)
+        self.input_names = [graph_input.name for graph_input in self.session.get_inputs()]
+
+    def run(self, batch: Dict[str, np.ndarray]) -> np.ndarray:
+        """
+        Run one padded batch.
+
+        Args:
+            batch (Dict[str, np.ndarray]): Tokenizer output with input_ids, attention_mask and,
+                for the retrieval model, token_type_ids.
+
+        Returns:
+            np.ndarray: The first output of the graph.
+        """
+        feeds = {name: np.asarray(batch[name], dtype=np.int64) for name in self.input_names}
+        return self.session.run(None, feeds)[0]
+
+
+def _export(model: torch.nn.Module, inputs: Tuple[torch.Tensor, ...], input_names: List[str], path: str, opset: int) -> None:
+    # Prefer the TorchScript exporter, as for the verbaliser graphs
+    export_kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            inputs,
+            path,
+            input_names=input_names,
+            output_names=['output'],
+            dynamic_axes={
+                **{name: {0: 'batch', 1: 'sequence'} for name in input_names},
+                'output': {0: 'batch'},
+            },
+            opset_version=opset,
+            **export_kwargs
+        )
+
+
+def _verify(name: str, expected: np.ndarray, path: str, batch: Dict[str, np.ndarray]) -> float:
+    actual = OnnxCrossEncoder(path).run(batch)
+    max_diff = float(np.max(np.abs(expected - actual)))
+    if max_diff > TOLERANCE:
+        raise ValueError(f"Exported {name} graph {path} differs from PyTorch by {max_diff:.2e}")
+    logger.info(f"Exported {name} graph to {path}, max abs difference to PyTorch {max_diff:.2e}")
+    return max_diff
+
+
+def export_retrieval(model, tokenizer, output_dir: str, max_len: int = 512, opset: int = OPSET) -> float:
+    """
+    Export the sentence retrieval model and check it against PyTorch.
+
+    Args:
+        model: The sentence_retrieval_model.
+        tokenizer: Its BertTokenizer.
+        output_dir (str): Directory receiving the graph.
+        max_len (int): Maximum tokens per pair used for the check. Defaults to 512.
+        opset (int): ONNX opset version. Defaults to OPSET.
+
+    Returns:
+        float: Maximum absolute difference between the ONNX and PyTorch scores.
+    """
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    model = model.cpu().eval()
+    batch = tokenizer(
+        VERIFICATION_PAIRS, truncation='longest_first', max_length=max_len, padding='longest',
+        return_token_type_ids=True, return_attention_mask=True, return_tensors='pt'
+    )
+    inputs = (batch['input_ids'], batch['attention_mask'], batch['token_type_ids'])
+    path = os.path.join(output_dir, RETRIEVAL_FILE)
+    _export(model, inputs, ['input_ids', 'attention_mask', 'token_type_ids'], path, opset)
+
+    with torch.no_grad():
+        expected = model(*inputs).numpy()
+    return _verify('sentence retrieval', expected, path, {key: value.numpy() for key, value in batch.items()})
+
+
+def export_entailment(model, tokenizer, output_dir: str, max_len: int = 512, opset: int = OPSET) -> float:
+    """
+    Export the textual entailment model and check it against PyTorch.
+
+    Args:
+        model: The BertForSequenceClassification model.
+        tokenizer: Its BertTokenizer.
+        output_dir (str): Directory receiving the graph.
+        max_len (int): Maximum tokens per pair used for the check. Defaults to 512.
+        opset (int): ONNX opset version. Defaults to OPSET.
+
+    Returns:
+        float: Maximum absolute difference between the ONNX and PyTorch logits.
+    """
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    wrapper = EntailmentWrapper(model.cpu()).eval()
+    batch = tokenizer(
+        VERIFICATION_PAIRS, truncation=True, max_length=max_len, padding='longest',
+        return_token_type_ids=False, return_tensors='pt'
+    )
+    inputs = (batch['input_ids'], batch['attention_mask'])
+    path = os.path.join(output_dir, ENTAILMENT_FILE)
+    _export(wrapper, inputs, ['input_ids', 'attention_mask'], path, opset)
+
+    with torch.no_grad():
+        expected = wrapper(*inputs).numpy()
+    return _verify('textual entailment', expected, path, {key: value.numpy() for key, value in batch.items()})
+
+
+def export_checkpoints(output_dir: str, opset: int = OPSET) -> None:
+    """Export the configured checkpoints of both cross-encoders into output_dir."""
+    from transformers import BertTokenizer, BertForSequenceClassification
+
+    from utils.sentence_retrieval_model import sentence_retrieval_model
+    from utils.textual_entailment_module import MODEL_PATH, TOKENIZER_PATH
+    import utils.sentence_retrieval_module as sentence_retrieval_module
+
+    args = sentence_retrieval_module.ARGS
+    retrieval = sentence_retrieval_model(args)
+    retrieval.load_state_dict(torch.load(args['checkpoint'], map_location=torch.device('cpu'))['model'])
+    export_retrieval(
+        retrieval, BertTokenizer.from_pretrained(args['bert_pretrain'], do_lower_case=False), output_dir, opset=opset
+    )
+
+    export_entailment(
+        BertForSequenceClassification.from_pretrained(MODEL_PATH),
+        BertTokenizer.from_pretrained(TOKENIZER_PATH),
+        output_dir,
+        opset=opset
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export the retrieval and entailment cross-encoders to ONNX')
+    parser.add_argument('--output_dir', required=True)
+    parser.add_argument('--opset', type=int, default=OPSET)
+    args = parser.parse_args()
+
+    export_checkpoints(args.output_dir, args.opset)
@@ -0,0 +1,461 @@
+#!/usr/bin/env python
+"""
+ONNX Runtime backend for the T5 graph-to-text verbaliser.
+
+1. Export the checkpoint once per host:
+
+    python -m utils.onnx_verbalisation --output_dir /home/ubuntu/RQV/base/t5_onnx
+
+2. Set ``verbalisation.backend`` to 'onnx' and ``verbalisation.onnx_dir`` to the output directory
+   in config.yaml.
+
+The export writes an encoder graph, a first-step decoder graph returning the self- and
+cross-attention keys/values, and a decoder-with-past graph fed one token per step with the cached
+keys/values, along with the tokenizer and the generation settings of the checkpoint. Beam and greedy
+search follow the semantics of ``transformers`` ``generate`` with ``length_penalty`` and
+``early_stopping=True``, so both backends produce the same verbalisations up to float rounding.
+"""
+import argparse
+import inspect
+import json
+import os
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+import torch
+
+from utils.logger import logger
+
+ENCODER_FILE = 'encoder.onnx'
+DECODER_FILE = 'decoder.onnx'
+DECODER_WITH_PAST_FILE = 'decoder_with_past.onnx'
+GENERATION_FILE = 'generation.json'
+OPSET = 14
+
+
+def past_names(prefix: str, num_layers: int, cross: bool = True) -> List[str]:
+    """Names of the flattened per-layer key/value tensors, e.g. ``past.0.self.key``."""
+    kinds = ('self', 'cross') if cross else ('self',)
+    return [
+        f"{prefix}.{layer}.{kind}.{tensor}"
+        for layer in range(num_layers)
+        for kind in kinds
+        for tensor in ('key', 'value')
+    ]
+
+
+class T5EncoderWrapper(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.encoder = model.get_encoder()
+
+    def forward(self, input_ids, attention_mask):
+        return self.encoder(input_ids=input_ids, attention_mask=attention_mask, return_dict=True).last_hidden_state
+
+
+class T5DecoderWrapper(torch.nn.Module):
+    """
+    One decoder step returning the logits of the last position and the updated key/value cache.
+    Without past, the whole cache is returned; with past, only the self-attention part changes.
+    """
+    def __init__(self, model, with_past: bool):
+        super().__init__()
+        self.decoder = model.get_decoder()
+        self.lm_head = model.lm_head
+        self.scale = model.model_dim ** -0.5 if model.config.tie_word_embeddings else 1.0
+        self.num_layers = model.config.num_decoder_layers
+        self.with_past = with_past
+
+    def forward(self, decoder_input_ids, encoder_attention_mask, encoder_hidden_states, *past):
+        past_key_values = None
+        if self.with_past:
+            past_key_values = tuple(tuple(past[4 * layer:4 * layer + 4]) for layer in range(self.num_layers))
+        output = self.decoder(
+            input_ids=decoder_input_ids,
+            encoder_hidden_states=encoder_hidden_states,
+            encoder_attention_mask=encoder_attention_mask,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=True,
+        )
+        logits = self.lm_head(output.last_hidden_state[:, -1, :] * self.scale)
+        present = output.past_key_values
+        if hasattr(present, 'to_legacy_cache'):
+            present = present.to_legacy_cache()
+        if self.with_past:
+            flat = [tensor for layer in present for tensor in layer[:2]]
+        else:
+            flat = [tensor for layer in present for tensor in layer[:4]]
+        return (logits, *flat)
+
+
+def export_t5(model, tokenizer, output_dir: str, eval_beams: int, eval_max_length: int, opset: int = OPSET) -> None:
+    """
+    Export a T5ForConditionalGeneration model to ONNX graphs and save the tokenizer and the
+    generation settings next to them.
+
+    Args:
+        model: The T5 model.
+        tokenizer: Its tokenizer.
+        output_dir (str): Directory receiving the graphs.
+        eval_beams (int): Number of beams used by the checkpoint.
+        eval_max_length (int): Maximum generated length used by the checkpoint.
+        opset (int): ONNX opset version. Defaults to OPSET.
+    """
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    model = model.cpu().eval()
+    config = model.config
+    num_layers = config.num_decoder_layers
+
+    # Prefer the TorchScript exporter, which handles the legacy tuple cache of transformers 4.46
+    export_kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+
+    input_ids = torch.tensor([[13, 14, 15, 16, 1], [13, 14, 1, 0, 0]], dtype=torch.long)
+    attention_mask = (input_ids != config.pad_token_id).long()
+    attention_mask[:, 0] = 1
+
+    encoder = T5EncoderWrapper(model).eval()
+    with torch.no_grad():
+        encoder_hidden_states = encoder(input_ids, attention_mask)
+        torch.onnx.export(
+            encoder,
+            (input_ids, attention_mask),
+            os.path.join(output_dir, ENCODER_FILE),
+            input_names=['input_ids', 'attention_mask'],
+            output_names=['last_hidden_state'],
+            dynamic_axes={
+                'input_ids': {0: 'batch', 1: 'source'},
+                'attention_mask': {0: 'batch', 1: 'source'},
+                'last_hidden_state': {0: 'batch', 1: 'source'},
+            },
+            opset_version=opset,
+            **export_kwargs
+        )
+
+    decoder_input_ids = torch.full((2, 1), config.decoder_start_token_id, dtype=torch.long)
+    decoder = T5DecoderWrapper(model, with_past=False).eval()
+    present_names = past_names('present', num_layers)
+    with torch.no_grad():
+        _, *present = decoder(decoder_input_ids, attention_mask, encoder_hidden_states)
+        torch.onnx.export(
+            decoder,
+            (decoder_input_ids, attention_mask, encoder_hidden_states),
+            os.path.join(output_dir, DECODER_FILE),
+            input_names=['decoder_input_ids', 'encoder_attention_mask', 'encoder_hidden_states'],
+            output_names=['logits'] + present_names,
+            dynamic_axes={
+                'decoder_input_ids': {0: 'batch'},
+                'encoder_attention_mask': {0: 'batch', 1: 'source'},
+                'encoder_hidden_states': {0: 'batch', 1: 'source'},
+                'logits': {0: 'batch'},
+                **{
+                    name: {0: 'batch', 2: 'source' if '.cross.' in name else 'target'}
+                    for name in present_names
+                },
+            },
+            opset_version=opset,
+            **export_kwargs
+        )
+
+    decoder_with_past = T5DecoderWrapper(model, with_past=True).eval()
+    input_past_names = past_names('past', num_layers)
+    output_present_names = past_names('present', num_layers, cross=False)
+    next_input_ids = torch.tensor([[21], [22]], dtype=torch.long)
+    with torch.no_grad():
+        torch.onnx.export(
+            decoder_with_past,
+            (next_input_ids, attention_mask, encoder_hidden_states, *present),
+            os.path.join(output_dir, DECODER_WITH_PAST_FILE),
+            input_names=['decoder_input_ids', 'encoder_attention_mask', 'encoder_hidden_states'] + input_past_names,
+            output_names=['logits'] + output_present_names,
+            dynamic_axes={
+                'decoder_input_ids': {0: 'batch'},
+                'encoder_attention_mask': {0: 'batch', 1: 'source'},
+                'encoder_hidden_states': {0: 'batch', 1: 'source'},
+                'logits': {0: 'batch'},
+                **{
+                    name: {0: 'batch', 2: 'source' if '.cross.' in name else 'past'}
+                    for name in input_past_names
+                },
+                **{name: {0: 'batch', 2: 'target'} for name in output_present_names},
+            },
+            opset_version=opset,
+            **export_kwargs
+        )
+
+    tokenizer.save_pretrained(output_dir)
+    with open(os.path.join(output_dir, GENERATION_FILE), 'w') as file:
+        json.dump({
+            'num_layers': num_layers,
+            'decoder_start_token_id': config.decoder_start_token_id,
+            'eos_token_id': config.eos_token_id,
+            'pad_token_id': config.pad_token_id,
+            'eval_beams': eval_beams,
+            'eval_max_length': eval_max_length,
+        }, file, indent=2)
+    logger.info(f"Exported T5 verbaliser to {output_dir}")
+
+
+def export_checkpoint(checkpoint: str, output_dir: str, opset: int = OPSET) -> None:
+    """Export the Graph2TextModule checkpoint used by VerbModule."""
+    from utils.finetune import Graph2TextModule
+
+    g2t_module = Graph2TextModule.load_from_checkpoint(checkpoint, strict=False, map_location='cpu')
+    # VerbModule starts decoding from the pad token, whatever the checkpoint config says
+    g2t_module.model.config.decoder_start_token_id = g2t_module.tokenizer.pad_token_id
+    export_t5(
+        g2t_module.model,
+        g2t_module.tokenizer,
+        output_dir,
+        eval_beams=g2t_module.eval_beams,
+        eval_max_length=g2t_module.eval_max_length,
+        opset=opset,
+    )
+
+
+def log_softmax(logits: np.ndarray) -> np.ndarray:
+    logits = logits.astype(np.float32)
+    shifted = logits - logits.max(axis=-1, keepdims=True)
+    return shifted - np.log(np.exp(shifted).sum(axis=-1, keepdims=True))
+
+
+class BeamHypotheses():
+    """Finished hypotheses of one input, keeping the num_beams best by length-penalised score."""
+    def __init__(self, num_beams: int, length_penalty: float):
+        self.num_beams = num_beams
+        self.length_penalty = length_penalty
+        self.beams: List[Tuple[float, List[int]]] = []
+        self.worst_score = 1e9
+
+    def __len__(self):
+        return len(self.beams)
+
+    def add(self, tokens: List[int], sum_logprobs: float, generated_len: int) -> None:
+        score = sum_logprobs / (generated_len ** self.length_penalty)
+        if len(self) < self.num_beams or score > self.worst_score:
+            self.beams.append((score, tokens))
+            if len(self) > self.num_beams:
+                sorted_scores = sorted([(s, idx) for idx, (s, _) in enumerate(self.beams)])
+                del self.beams[sorted_scores[0][1]]
+                self.worst_score = sorted_scores[1][0]
+            else:
+                self.worst_score = min(score, self.worst_score)
+
+    def best(self) -> List[int]:
+        return max(self.beams, key=lambda beam: beam[0])[1]
+
+
+class OnnxT5Generator():
+    """
+    Runs T5 generation on ONNX Runtime, reusing the decoder keys/values between steps.
+
+    Args:
+        model_dir (str): Directory written by export_t5.
+        intra_op_threads (int): Threads used inside an operator, 0 lets ONNX Runtime decide.
+        inter_op_threads (int): Threads used across operators, 0 lets ONNX Runtime decide.
+    """
+    def __init__(self, model_dir: str, intra_op_threads: int = 0, inter_op_threads: int = 0):
+        import onnxruntime as ort
+
+        with open(os.path.join(model_dir, GENERATION_FILE), 'r') as file:
+            self.generation_config: Dict = json.load(file)
+        self.num_layers = self.generation_config['num_layers']
+        self.decoder_start_token_id = self.generation_config['decoder_start_token_id']
+        self.eos_token_id = self.generation_config['eos_token_id']
+        self.pad_token_id = self.generation_config['pad_token_id']
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        providers = [
+            provider for provider in ('CUDAExecutionProvider', 'CPUExecutionProvider')
+            if provider in ort.get_available_providers()
+        ]
+        self.encoder = ort.InferenceSession(os.path.join(model_dir, ENCODER_FILE), options, providers=providers)
+        self.decoder = ort.InferenceSession(os.path.join(model_dir, DECODER_FILE), options, providers=providers)
+        self.decoder_with_past = ort.InferenceSession(
+            os.path.join(model_dir, DECODER_WITH_PAST_FILE), options, providers=providers
+        )
+        self.present_names = past_names('present', self.num_layers)
+        self.past_names = past_names('past', self.num_layers)
+        self.self_present_names = past_names('present', self.num_layers, cross=False)
+        # The exporter drops the encoder states from the decoder-with-past graph when it only needs the cache
+        self.decoder_with_past_inputs = {graph_input.name for graph_input in self.decoder_with_past.get_inputs()}
+
+    def _first_step(self, encoder_attention_mask: np.ndarray, encoder_hidden_states: np.ndarray):
+        decoder_input_ids = np.full((encoder_hidden_states.shape[0], 1), self.decoder_start_token_id, dtype=np.int64)
+        logits, *present = self.decoder.run(None, {
+            'decoder_input_ids': decoder_input_ids,
+            'encoder_attention_mask': encoder_attention_mask,
+            'encoder_hidden_states': encoder_hidden_states,
+        })
+        return logits, dict(zip(self.past_names, present))
+
+    def _next_step(
+        self,
+        tokens: np.ndarray,
+        encoder_attention_mask: np.ndarray,
+        encoder_hidden_states: np.ndarray,
+        past: Dict[str, np.ndarray]
+    ):
+        inputs = {
+            'decoder_input_ids': tokens.reshape(-1, 1).astype(np.int64),
+            'encoder_attention_mask': encoder_attention_mask,
+            'encoder_hidden_states': encoder_hidden_states,
+            **past,
+        }
+        logits, *present = self.decoder_with_past.run(
+            None, {name: value for name, value in inputs.items() if name in self.decoder_with_past_inputs}
+        )
+        # Only the self-attention keys/values grow, the cross-attention ones are reused as they are
+        past.update(zip([name.replace('present', 'past', 1) for name in self.self_present_names], present))
+        return logits
+
+    def generate(
+        self,
+        input_ids: np.ndarray,
+        attention_mask: np.ndarray,
+        max_length: int,
+        num_beams: int = 1,
+        length_penalty: float = 1.0
+    ) -> List[List[int]]:
+        """
+        Generate the output token ids of a batch of encoded inputs.
+
+        Args:
+            input_ids (np.ndarray): Source token ids, shape (batch, source).
+            attention_mask (np.ndarray): Source attention mask, shape (batch, source).
+            max_length (int): Maximum output length, decoder start token included.
+            num_beams (int): Beam width, 1 for greedy search. Defaults to 1.
+            length_penalty (float): Exponent of the length normalising beam scores. Defaults to 1.0.
+
+        Returns:
+            List[List[int]]: Output token ids of every input, starting with the decoder start token.
+        """
+        input_ids = np.asarray(input_ids, dtype=np.int64)
+        attention_mask = np.asarray(attention_mask, dtype=np.int64)
+        encoder_hidden_states = self.encoder.run(None, {
+            'input_ids': input_ids,
+            'attention_mask': attention_mask,
+        })[0]
+        if num_beams <= 1:
+            return self._greedy_search(attention_mask, encoder_hidden_states, max_length)
+        return self._beam_search(attention_mask, encoder_hidden_states, max_length, num_beams, length_penalty)
+
+    def _greedy_search(
+        self, attention_mask: np.ndarray, encoder_hidden_states: np.ndarray, max_length: int
+    ) -> List[List[int]]:
+        batch_size = attention_mask.shape[0]
+        sequences = np.full((batch_size, 1), self.decoder_start_token_id, dtype=np.int64)
+        unfinished = np.ones(batch_size, dtype=bool)
+
+        logits, past = self._first_step(attention_mask, encoder_hidden_states)
+        while True:
+            next_tokens = np.where(unfinished, logits.argmax(axis=-1), self.pad_token_id)
+            sequences = np.concatenate([sequences, next_tokens[:, None]], axis=1)
+            unfinished &= next_tokens != self.eos_token_id
+            if not unfinished.any() or sequences.shape[1] >= max_length:
+                break
+            logits = self._next_step(next_tokens, attention_mask, encoder_hidden_states, past)
+
+        return [
+            row[:np.argmax(row == self.eos_token_id) + 1].tolist() if (row == self.eos_token_id).any() else row.tolist()
+            for row in sequences
+        ]
+
+    def _beam_search(
+        self,
+        attention_mask: np.ndarray,
+        encoder_hidden_states: np.ndarray,
+        max_length: int,
+        num_beams: int,
+        length_penalty: float
+    ) -> List[List[int]]:
+        batch_size = attention_mask.shape[0]
+        attention_mask = np.repeat(attention_mask, num_beams, axis=0)
+        encoder_hidden_states = np.repeat(encoder_hidden_states, num_beams, axis=0)
+
+        hypotheses = [BeamHypotheses(num_beams, length_penalty) for _ in range(batch_size)]
+        done = np.zeros(batch_size, dtype=bool)
+        # Only the first beam is live at the start, so the beams do not all pick the same tokens
+        beam_scores = np.zeros((batch_size, num_beams), dtype=np.float32)
+        beam_scores[:, 1:] = -1e9
+        beam_scores = beam_scores.reshape(-1)
+        sequences = np.full((batch_size * num_beams, 1), self.decoder_start_token_id, dtype=np.int64)
+
+        logits, past = self._first_step(attention_mask, encoder_hidden_states)
+        while True:
+            scores = log_softmax(logits) + beam_scores[:, None]
+            vocab_size = scores.shape[-1]
+            scores = scores.reshape(batch_size, num_beams * vocab_size)
+
+            n_candidates = 2 * num_beams
+            candidates = np.argpartition(-scores, n_candidates - 1, axis=1)[:, :n_candidates]
+            candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+            order = np.argsort(-candidate_scores, axis=1, kind='stable')
+            candidates = np.take_along_axis(candidates, order, axis=1)
+            candidate_scores = np.take_along_axis(candidate_scores, order, axis=1)
+
+            cur_len = sequences.shape[1] + 1
+            next_scores = np.zeros((batch_size, num_beams), dtype=np.float32)
+            next_tokens = np.full((batch_size, num_beams), self.pad_token_id, dtype=np.int64)
+            next_indices = np.zeros((batch_size, num_beams), dtype=np.int64)
+            for batch_idx in range(batch_size):
+                if done[batch_idx]:
+                    continue
+                beam_idx = 0
+                for rank, (candidate, score) in enumerate(zip(candidates[batch_idx], candidate_scores[batch_idx])):
+                    source_beam = batch_idx * num_beams + candidate // vocab_size
+                    token = candidate % vocab_size
+                    if token == self.eos_token_id:
+                        # An end of sentence outside the top num_beams candidates is not a hypothesis
+                        if rank >= num_beams:
+                            continue
+                        hypotheses[batch_idx].add(sequences[source_beam].tolist(), float(score), cur_len - 1)
+                    else:
+                        next_scores[batch_idx, beam_idx] = score
+                        next_tokens[batch_idx, beam_idx] = token
+                        next_indices[batch_idx, beam_idx] = source_beam
+                        beam_idx += 1
+                    if beam_idx == num_beams:
+                        break
+                # early_stopping=True: done as soon as there are num_beams finished hypotheses
+                done[batch_idx] = len(hypotheses[batch_idx]) >= num_beams
+
+            beam_scores = next_scores.reshape(-1)
+            beam_index = next_indices.reshape(-1)
+            next_tokens = next_tokens.reshape(-1)
+            sequences = np.concatenate([sequences[beam_index], next_tokens[:, None]], axis=1)
+            if done.all() or sequences.shape[1] >= max_length:
+                break
+
+            for name in past:
+                if '.self.' in name:
+                    past[name] = past[name][beam_index]
+            logits = self._next_step(next_tokens, attention_mask, encoder_hidden_states, past)
+
+        outputs = []
+        for batch_idx in range(batch_size):
+            if not done[batch_idx]:
+                for beam in range(num_beams):
+                    row = batch_idx * num_beams + beam
+                    hypotheses[batch_idx].add(sequences[row].tolist(), float(beam_scores[row]), sequences.shape[1] - 1)
+            best = hypotheses[batch_idx].best()
+            if len(best) < max_length:
+                best = best + [self.eos_token_id]
+            outputs.append(best)
+        return outputs
+
+
+if __name__ == "__main__":
+    from utils.verbalisation_module import CHECKPOINT
+
+    parser = argparse.ArgumentParser(description='Export the T5 verbaliser to ONNX')
+    parser.add_argument('--checkpoint', default=CHECKPOINT)
+    parser.add_argument('--output_dir', required=True)
+    parser.add_argument('--opset', type=int, default=OPSET)
+    args = parser.parse_args()
+
+    export_checkpoint(args.checkpoint, args.output_dir, args.opset)
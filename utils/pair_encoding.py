@@ -0,0 +1,113 @@
+"""
+Pair encodings for the BERT cross-encoders, assembled from cached token ids.
+
+The cross-encoders score every claim against every sentence of its references, so the same texts
+come back for many pairs. PairEncoder tokenises each distinct text once with the fast (Rust)
+tokenizer, keeps its word-piece ids in a bounded LRU, and builds the [CLS] a [SEP] b [SEP]
+encodings of the pairs from them, truncated exactly like the tokenizer's 'longest_first' strategy.
+"""
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+class PairEncoder():
+    """
+    Encodes text pairs from per-text token ids computed once.
+
+    Args:
+        tokenizer: A fast BERT tokenizer.
+        preprocess (Optional[Callable[[str], str]]): Applied to a text before it is tokenised,
+            e.g. process_sent. Defaults to None.
+        max_items (int): Texts whose token ids are kept. Defaults to 100000.
+
+    Attributes:
+        stats (Dict[str, int]): Texts found in and missing from the token id cache.
+    """
+    def __init__(self, tokenizer, preprocess: Optional[Callable[[str], str]] = None, max_items: int = 100000):
+        self.tokenizer = tokenizer
+        self.preprocess = preprocess
+        self.max_items = max_items
+        self.cache: OrderedDict = OrderedDict()
+        self.lock = Lock()
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def token_ids(self, texts: Sequence[str]) -> List[List[int]]:
+        """Word-piece ids of every text, without special tokens, tokenising only the texts not cached."""
+        with self.lock:
+            found = {text: self.cache[text] for text in dict.fromkeys(texts) if text in self.cache}
+            for text in found:
+                self.cache.move_to_end(text)
+        missing = [text for text in dict.fromkeys(texts) if text not in found]
+        computed = []
+        if missing:
+            tokenised = missing if self.preprocess is None else [self.preprocess(text) for text in missing]
+            computed = self.tokenizer(
+                tokenised, add_special_tokens=False, return_attention_mask=False, return_token_type_ids=False
+            )['input_ids']
+            found.update(zip(missing, computed))
+        with self.lock:
+            for text, ids in zip(missing, computed):
+                self.cache[text] = ids
+            while len(self.cache) > self.max_items:
+                self.cache.popitem(last=False)
+            self.stats['hits'] += len(texts) - len(missing)
+            self.stats['misses'] += len(missing)
+        return [found[text] for text in texts]
+
+    @staticmethod
+    def truncate(first: List[int], second: List[int], max_tokens: int) -> Tuple[List[int], List[int]]:
+        # 'longest_first': tokens come off the longer sequence, off the second one on ties
+        excess = len(first) + len(second) - max_tokens
+        if excess <= 0:
+            return first, second
+        difference = min(excess, abs(len(first) - len(second)))
+        rest = excess - difference
+        if len(first) > len(second):
+            first_removed, second_removed = difference + rest // 2, rest - rest // 2
+        else:
+            first_removed, second_removed = rest // 2, difference + rest - rest // 2
+        return first[:len(first) - first_removed], second[:len(second) - second_removed]
+
+    def encode(self, pairs: Sequence[Tuple[str, str]], max_length: int, return_token_type_ids: bool = True) -> Dict[str, List[List[int]]]:
+        """
+        Encode pairs as the tokenizer would with truncation='longest_first' and max_length.
+
+        Args:
+            pairs (Sequence[Tuple[str, str]]): (first, second) text pairs.
+            max_length (int): Maximum tokens per pair, special tokens included.
+            return_token_type_ids (bool): Also return the segment ids. Defaults to True.
+
+        Returns:
+            Dict[str, List[List[int]]]: input_ids, attention_mask and optionally token_type_ids,
+                one unpadded list per pair.
+        """
+        ids = self.token_ids([text for pair in pairs for text in pair])
+        cls_id, sep_id = self.tokenizer.cls_token_id, self.tokenizer.sep_token_id
+        encodings = {'input_ids': [], 'attention_mask': []}
+        if return_token_type_ids:
+            encodings['token_type_ids'] = []
+
+        for first, second in zip(ids[0::2], ids[1::2]):
+            first, second = self.truncate(first, second, max_length - 3)
+            input_ids = [cls_id, *first, sep_id, *second, sep_id]
+            encodings['input_ids'].append(input_ids)
+            encodings['attention_mask'].append([1] * len(input_ids))
+            if return_token_type_ids:
+                encodings['token_type_ids'].append([0] * (len(first) + 2) + [1] * (len(second) + 1))
+        return encodings
+
+    def pad(self, encodings: Dict[str, List[List[int]]], indices: Sequence[int]) -> Dict[str, np.ndarray]:
+        """Pad the encodings at indices to their longest one, as int64 arrays."""
+        indices = list(indices)
+        longest = max(len(encodings['input_ids'][idx]) for idx in indices)
+        batch = {}
+        for key, values in encodings.items():
+            fill = self.tokenizer.pad_token_id if key == 'input_ids' else 0
+            array = np.full((len(indices), longest), fill, dtype=np.int64)
+            for row, idx in enumerate(indices):
+                array[row, :len(values[idx])] = values[idx]
+            batch[key] = array
+        return batch
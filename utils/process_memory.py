@@ -0,0 +1,63 @@
+"""
+Memory of a process split into what it shares with others and what is its own.
+
+Read from /proc/<pid>/smaps_rollup, so Linux only. The weights of memory-mapped or inherited models
+show up as shared (or private clean while a single process maps them), and everything a process
+allocated or wrote to as private dirty. The peak RSS of the calling process comes from
+/proc/self/status and can be reset to measure the peak of one part of the work.
+"""
+from typing import Dict, Union
+
+SMAPS_FIELDS = {
+    'Rss': 'rss',
+    'Pss': 'pss',
+    'Shared_Clean': 'shared_clean',
+    'Shared_Dirty': 'shared_dirty',
+    'Private_Clean': 'private_clean',
+    'Private_Dirty': 'private_dirty',
+}
+
+
+def process_memory(pid: Union[int, str] = 'self') -> Dict[str, float]:
+    """
+    Memory of a process in MB.
+
+    Args:
+        pid (Union[int, str]): Process id. Defaults to the calling process.
+
+    Returns:
+        Dict[str, float]: rss, pss, shared_clean, shared_dirty, private_clean and private_dirty,
+            empty if the process is gone or smaps_rollup is not available.
+    """
+    memory = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup', 'r') as file:
+            for line in file:
+                field, _, value = line.partition(':')
+                if field in SMAPS_FIELDS:
+                    memory[SMAPS_FIELDS[field]] = int(value.split()[0]) / 1024
+    except OSError:
+        return {}
+    return memory
+
+
+def peak_rss() -> float:
+    """Peak RSS of the calling process in MB since it started or since reset_peak_rss, 0 if unknown."""
+    try:
+        with open('/proc/self/status', 'r') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+def reset_peak_rss() -> bool:
+    """Reset the peak RSS of the calling process to its current RSS, False where it is not supported."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
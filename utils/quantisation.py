@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""
+Dynamic int8 quantisation of the CPU inference models.
+
+1. Quantise the checkpoints once per host:
+
+    python -m utils.quantisation --output_dir /home/ubuntu/RQV/base/quantised
+
+2. Set ``quantisation.enabled`` to true and ``quantisation.dir`` to the output directory in
+   config.yaml.
+
+The linear layers of the sentence retrieval BERT, the entailment BERT and the T5 verbaliser are
+replaced with dynamically quantised int8 layers, and each quantised model is saved whole so that
+workers load it directly instead of loading the fp32 checkpoint and quantising it at startup.
+The manifest records the fp32 checkpoint each artifact was made from, and loading an artifact
+whose checkpoint has since changed logs a warning.
+"""
+import argparse
+import json
+import os
+from pathlib import Path
+from typing import Dict, Optional
+
+import torch
+
+from utils.logger import logger
+from utils.score_cache import checkpoint_identity
+
+QUANTISED_FILES = {
+    'retrieval': 'retrieval.pt',
+    'entailment': 'entailment.pt',
+    'verbalisation': 'verbalisation.pt',
+}
+VERBALISATION_TOKENIZER_DIR = 'verbalisation_tokenizer'
+MANIFEST_FILE = 'quantisation.json'
+
+
+def quantise_linear_layers(model: torch.nn.Module) -> torch.nn.Module:
+    """Replace the linear layers of a model with dynamically quantised int8 ones, on CPU."""
+    from torch.ao.quantization import quantize_dynamic
+
+    model = model.to('cpu').eval()
+    return quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def read_manifest(quantised_dir: str) -> Dict:
+    path = os.path.join(quantised_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+def save_quantised(model: torch.nn.Module, quantised_dir: str, name: str, source_identity: str, **settings) -> None:
+    """
+    Save a quantised model and record it in the manifest of the directory.
+
+    Args:
+        model (torch.nn.Module): Model returned by quantise_linear_layers.
+        quantised_dir (str): Directory of the quantised artifacts.
+        name (str): One of the QUANTISED_FILES names.
+        source_identity (str): checkpoint_identity of the fp32 checkpoint.
+        **settings: Extra settings stored with the artifact, e.g. the generation settings.
+    """
+    Path(quantised_dir).mkdir(parents=True, exist_ok=True)
+    torch.save(model, os.path.join(quantised_dir, QUANTISED_FILES[name]))
+
+    manifest = read_manifest(quantised_dir)
+    manifest[name] = {'source_identity': source_identity, **settings}
+    with open(os.path.join(quantised_dir, MANIFEST_FILE), 'w') as file:
+        json.dump(manifest, file, indent=2)
+
+
+def load_quantised(quantised_dir: str, name: str, source_identity: Optional[str] = None) -> torch.nn.Module:
+    """
+    Load a quantised model saved by save_quantised, in eval mode on CPU.
+
+    Args:
+        quantised_dir (str): Directory of the quantised artifacts.
+        name (str): One of the QUANTISED_FILES names.
+        source_identity (Optional[str]): checkpoint_identity of the fp32 checkpoint currently
+            configured, checked against the one the artifact was made from.
+
+    Returns:
+        torch.nn.Module: The quantised model.
+    """
+    path = os.path.join(quantised_dir, QUANTISED_FILES[name])
+    recorded = read_manifest(quantised_dir).get(name, {}).get('source_identity')
+    if source_identity is not None and recorded != source_identity:
+        logger.warning(f"Quantised {name} model {path} was not made from the configured checkpoint, re-run utils.quantisation")
+    # The artifact is a pickled module written by this repository
+    model = torch.load(path, map_location='cpu', weights_only=False)
+    return model.eval()
+
+
+def quantised_identity(quantised_dir: str, name: str) -> str:
+    """checkpoint_identity of a quantised artifact, used in the cache model ids."""
+    return checkpoint_identity(os.path.join(quantised_dir, QUANTISED_FILES[name]))
+
+
+def quantise_checkpoints(output_dir: str) -> None:
+    """Quantise the configured fp32 checkpoints of the three models into output_dir."""
+    from transformers import BertForSequenceClassification
+
+    from utils.finetune import Graph2TextModule
+    from utils.sentence_retrieval_model import sentence_retrieval_model
+    from utils.textual_entailment_module import MODEL_PATH, TOKENIZER_PATH
+    from utils.verbalisation_module import CHECKPOINT
+    import utils.sentence_retrieval_module as sentence_retrieval_module
+
+    args = sentence_retrieval_module.ARGS
+    retrieval = sentence_retrieval_model(args)
+    retrieval.load_state_dict(torch.load(args['checkpoint'], map_location=torch.device('cpu'))['model'])
+    save_quantised(
+        quantise_linear_layers(retrieval), output_dir, 'retrieval', checkpoint_identity(args['checkpoint'])
+    )
+    logger.info(f"Quantised sentence retrieval model {args['checkpoint']}")
+
+    entailment = BertForSequenceClassification.from_pretrained(MODEL_PATH)
+    save_quantised(
+        quantise_linear_layers(entailment), output_dir, 'entailment', checkpoint_identity(MODEL_PATH, TOKENIZER_PATH)
+    )
+    logger.info(f"Quantised textual entailment model {MODEL_PATH}")
+
+    g2t_module = Graph2TextModule.load_from_checkpoint(CHECKPOINT, strict=False, map_location='cpu')
+    # VerbModule starts decoding from the pad token, whatever the checkpoint config says
+    g2t_module.model.config.decoder_start_token_id = g2t_module.tokenizer.pad_token_id
+    g2t_module.tokenizer.save_pretrained(os.path.join(output_dir, VERBALISATION_TOKENIZER_DIR))
+    save_quantised(
+        quantise_linear_layers(g2t_module.model), output_dir, 'verbalisation', checkpoint_identity(CHECKPOINT),
+        eval_beams=g2t_module.eval_beams, eval_max_length=g2t_module.eval_max_length,
+    )
+    logger.info(f"Quantised verbalisation model {CHECKPOINT}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Quantise the inference models to dynamic int8')
+    parser.add_argument('--output_dir', required=True, help='Directory receiving the quantised artifacts')
+    args = parser.parse_args()
+
+    quantise_checkpoints(args.output_dir)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""
+Inference-only safetensors checkpoints of the three models, loaded memory-mapped.
+
+1. Convert the checkpoints once per host:
+
+    python -m utils.safetensors_checkpoints --output_dir /home/ubuntu/RQV/base/safetensors
+
+2. Set ``safetensors.enabled`` to true and ``safetensors.dir`` to the output directory in
+   config.yaml.
+
+The pickled checkpoints are read whole into the heap of every worker: the sentence retrieval
+state dict on top of the pretrained BERT it overwrites, and the T5 Lightning checkpoint with its
+optimizer state and hyperparameters. The converted files hold the inference weights only. They
+are memory-mapped when loaded and the tensors are used in place, so the workers of a host share
+the same page-cache pages. The weights are identical to the source checkpoints, and the cache
+model ids stay those of the source checkpoints recorded in the manifest.
+"""
+import argparse
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import torch
+
+from utils.logger import logger
+from utils.score_cache import checkpoint_identity
+
+RETRIEVAL_FILE = 'retrieval.safetensors'
+RETRIEVAL_CONFIG_FILE = 'retrieval_bert_config.json'
+ENTAILMENT_DIR = 'entailment'
+VERBALISATION_DIR = 'verbalisation'
+MANIFEST_FILE = 'safetensors.json'
+
+
+def read_manifest(safetensors_dir: str) -> Dict:
+    path = os.path.join(safetensors_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+def _record(safetensors_dir: str, name: str, source_identity: str, **settings) -> None:
+    manifest = read_manifest(safetensors_dir)
+    manifest[name] = {'source_identity': source_identity, **settings}
+    with open(os.path.join(safetensors_dir, MANIFEST_FILE), 'w') as file:
+        json.dump(manifest, file, indent=2)
+
+
+def source_identity(safetensors_dir: str, name: str, configured_identity: Optional[str] = None) -> str:
+    """
+    checkpoint_identity of the checkpoint a converted model was made from, used in the cache
+    model ids since the weights are the same.
+
+    Args:
+        safetensors_dir (str): Directory of the converted models.
+        name (str): 'retrieval', 'entailment' or 'verbalisation'.
+        configured_identity (Optional[str]): checkpoint_identity of the checkpoint currently
+            configured, checked against the recorded one.
+    """
+    recorded = read_manifest(safetensors_dir).get(name, {}).get('source_identity')
+    if configured_identity is not None and recorded != configured_identity:
+        logger.warning(
+            f"Safetensors {name} model in {safetensors_dir} was not made from the configured checkpoint, "
+            "re-run utils.safetensors_checkpoints"
+        )
+    return recorded or checkpoint_identity(safetensors_dir)
+
+
+def load_retrieval(safetensors_dir: str, args: Dict) -> torch.nn.Module:
+    """
+    Build the sentence retrieval model around its memory-mapped weights, in eval mode on CPU.
+
+    Args:
+        safetensors_dir (str): Directory of the converted models.
+        args (Dict): sentence_retrieval_module.ARGS.
+    """
+    from safetensors.torch import load_file
+
+    from utils.bert_model import BertConfig
+    from utils.sentence_retrieval_model import sentence_retrieval_model
+
+    bert_config = BertConfig.from_json_file(os.path.join(safetensors_dir, RETRIEVAL_CONFIG_FILE))
+    # No memory is allocated for the parameters, they are replaced by the mapped tensors
+    with torch.device('meta'):
+        model = sentence_retrieval_model(args, bert_config=bert_config)
+    model.load_state_dict(load_file(os.path.join(safetensors_dir, RETRIEVAL_FILE)), assign=True)
+    return model.eval()
+
+
+def load_entailment(safetensors_dir: str) -> torch.nn.Module:
+    """Load the textual entailment model, memory-mapped by transformers, in eval mode on CPU."""
+    from transformers import BertForSequenceClassification
+
+    return BertForSequenceClassification.from_pretrained(os.path.join(safetensors_dir, ENTAILMENT_DIR)).eval()
+
+
+def load_verbalisation(safetensors_dir: str) -> Tuple[torch.nn.Module, object, Dict]:
+    """
+    Load the T5 verbaliser, memory-mapped by transformers, in eval mode on CPU.
+
+    Returns:
+        Tuple[torch.nn.Module, object, Dict]: The model, its tokenizer and the generation
+            settings of the Lightning checkpoint.
+    """
+    from transformers import AutoTokenizer, T5ForConditionalGeneration
+
+    model_dir = os.path.join(safetensors_dir, VERBALISATION_DIR)
+    model = T5ForConditionalGeneration.from_pretrained(model_dir).eval()
+    return model, AutoTokenizer.from_pretrained(model_dir), read_manifest(safetensors_dir)['verbalisation']
+
+
+def convert_retrieval(checkpoint: str, bert_pretrain: str, output_dir: str) -> None:
+    """Write the model state of the retrieval checkpoint and its BERT config into output_dir."""
+    from safetensors.torch import save_file
+
+    from utils.bert_model import CONFIG_NAME
+
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    state_dict = torch.load(checkpoint, map_location=torch.device('cpu'))['model']
+    save_file(
+        {key: tensor.contiguous() for key, tensor in state_dict.items()},
+        os.path.join(output_dir, RETRIEVAL_FILE)
+    )
+    shutil.copyfile(os.path.join(bert_pretrain, CONFIG_NAME), os.path.join(output_dir, RETRIEVAL_CONFIG_FILE))
+    _record(output_dir, 'retrieval', checkpoint_identity(checkpoint))
+    logger.info(f"Converted sentence retrieval model {checkpoint}")
+
+
+def convert_entailment(model_path: str, tokenizer_path: str, output_dir: str) -> None:
+    """Write the textual entailment model as a safetensors transformers directory."""
+    from transformers import BertForSequenceClassification
+
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    BertForSequenceClassification.from_pretrained(model_path).save_pretrained(
+        os.path.join(output_dir, ENTAILMENT_DIR), safe_serialization=True
+    )
+    _record(output_dir, 'entailment', checkpoint_identity(model_path, tokenizer_path))
+    logger.info(f"Converted textual entailment model {model_path}")
+
+
+def convert_verbalisation(checkpoint: str, output_dir: str) -> None:
+    """Write the T5 of the Lightning checkpoint, its tokenizer and generation settings, without the optimizer state."""
+    from utils.finetune import Graph2TextModule
+
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    g2t_module = Graph2TextModule.load_from_checkpoint(checkpoint, strict=False, map_location='cpu')
+    # VerbModule starts decoding from the pad token, whatever the checkpoint config says
+    g2t_module.model.config.decoder_start_token_id = g2t_module.tokenizer.pad_token_id
+    model_dir = os.path.join(output_dir, VERBALISATION_DIR)
+    g2t_module.model.save_pretrained(model_dir, safe_serialization=True)
+    g2t_module.tokenizer.save_pretrained(model_dir)
+    _record(
+        output_dir, 'verbalisation', checkpoint_identity(checkpoint),
+        eval_beams=g2t_module.eval_beams, eval_max_length=g2t_module.eval_max_length,
+    )
+    logger.info(f"Converted verbalisation model {checkpoint}")
+
+
+def convert_checkpoints(output_dir: str) -> None:
+    """Convert the configured checkpoints of the three models into output_dir."""
+    from utils.textual_entailment_module import MODEL_PATH, TOKENIZER_PATH
+    from utils.verbalisation_module import CHECKPOINT
+    import utils.sentence_retrieval_module as sentence_retrieval_module
+
+    args = sentence_retrieval_module.ARGS
+    convert_retrieval(args['checkpoint'], args['bert_pretrain'], output_dir)
+    convert_entailment(MODEL_PATH, TOKENIZER_PATH, output_dir)
+    convert_verbalisation(CHECKPOINT, output_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert the inference models to memory-mapped safetensors')
+    parser.add_argument('--output_dir', required=True, help='Directory receiving the converted models')
+    args = parser.parse_args()
+
+    convert_checkpoints(args.output_dir)
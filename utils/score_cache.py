@@ -0,0 +1,331 @@
+from collections import OrderedDict
+import hashlib
+import os
+import re
+import sqlite3
+from threading import Lock
+from typing import Any, Callable, Dict, List, Tuple
+
+import numpy as np
+
+from utils.logger import logger
+
+SQLITE_MAX_VARIABLES = 900
+
+
+def checkpoint_identity(*paths: str) -> str:
+    """
+    Identify a model checkpoint by its path, size and modification time, so that replacing the
+    checkpoint invalidates the cached outputs computed with it. A directory is identified by the
+    relative name, size and modification time of every file under it, since its own stat does not
+    change when a file inside it is overwritten.
+
+    Args:
+        *paths (str): Files or directories making up the checkpoint.
+
+    Returns:
+        str: Short hexadecimal identity of the checkpoint.
+    """
+    parts = []
+    for path in paths:
+        if os.path.isdir(path):
+            parts.append(os.path.abspath(path))
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    file_path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(file_path)
+                    except OSError:
+                        continue
+                    parts.append(f"{os.path.relpath(file_path, path)}:{stat.st_size}:{stat.st_mtime_ns}")
+            continue
+        try:
+            stat = os.stat(path)
+            parts.append(f"{os.path.abspath(path)}:{stat.st_size}:{int(stat.st_mtime)}")
+        except OSError:
+            parts.append(str(path))
+    return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()[:16]
+
+
+def normalise_claim(text: str) -> str:
+    """Collapse whitespace, which the tokenisers ignore anyway."""
+    return re.sub(r'\s+', ' ', str(text)).strip()
+
+
+class PersistentLRUCache:
+    """
+    Key/value cache for model outputs with an in-memory LRU tier in front of a persistent SQLite
+    tier shared by every worker on the host. Subclasses choose the table and how values are
+    serialised.
+
+    Args:
+        path (str): Path of the SQLite database.
+        memory_items (int): Maximum number of entries in the LRU tier. Defaults to 100000.
+
+    Attributes:
+        stats (Dict[str, Dict[str, int]]): Hit and miss counters per model identity.
+    """
+    table = None
+    value_type = 'BLOB'
+
+    def __init__(self, path: str, memory_items: int = 100000) -> None:
+        self.path = path
+        self.memory_items = memory_items
+        self.memory: OrderedDict = OrderedDict()
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+        self.connect()
+
+    def connect(self) -> None:
+        """Open the SQLite connection, again in a process forked after the cache was opened."""
+        self.lock = Lock()
+        self.connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            f'CREATE TABLE IF NOT EXISTS {self.table} (key TEXT PRIMARY KEY, value {self.value_type} NOT NULL)'
+        )
+        self.connection.commit()
+
+    def serialise(self, value: Any) -> Any:
+        return value
+
+    def deserialise(self, value: Any) -> Any:
+        return value
+
+    def _count(self, model_id: str, counter: str, value: int) -> None:
+        counters = self.stats.setdefault(model_id, {'memory_hits': 0, 'disk_hits': 0, 'misses': 0})
+        counters[counter] += value
+
+    def _remember(self, key: str, value: Any) -> None:
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def lookup(self, model_id: str, keys: List[str]) -> Dict[str, Any]:
+        """
+        Look up many keys at once, first in memory then in a few bulk SQLite queries.
+
+        Args:
+            model_id (str): Identity of the model, used for the hit-rate metrics.
+            keys (List[str]): Keys to look up, possibly repeated.
+
+        Returns:
+            Dict[str, Any]: The cached values found for some of those keys.
+        """
+        found = {}
+        with self.lock:
+            missing = []
+            for key in dict.fromkeys(keys):
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    found[key] = self.memory[key]
+                else:
+                    missing.append(key)
+            memory_hits = len(found)
+
+            try:
+                for i in range(0, len(missing), SQLITE_MAX_VARIABLES):
+                    chunk = missing[i:i + SQLITE_MAX_VARIABLES]
+                    rows = self.connection.execute(
+                        f"SELECT key, value FROM {self.table} WHERE key IN ({','.join('?' * len(chunk))})",
+                        chunk
+                    ).fetchall()
+                    for key, value in rows:
+                        found[key] = self.deserialise(value)
+                        self._remember(key, found[key])
+            except sqlite3.Error as e:
+                logger.error(f"Error reading {self.table} cache {self.path}: {e}")
+
+            self._count(model_id, 'memory_hits', memory_hits)
+            self._count(model_id, 'disk_hits', len(found) - memory_hits)
+            self._count(model_id, 'misses', len(missing) - (len(found) - memory_hits))
+
+        return found
+
+    def store(self, values: Dict[str, Any]) -> None:
+        """
+        Store freshly computed values in both tiers.
+
+        Args:
+            values (Dict[str, Any]): Values by key.
+        """
+        if not values:
+            return
+        with self.lock:
+            for key, value in values.items():
+                self._remember(key, value)
+            try:
+                self.connection.executemany(
+                    f'INSERT OR REPLACE INTO {self.table} (key, value) VALUES (?, ?)',
+                    [(key, self.serialise(value)) for key, value in values.items()]
+                )
+                self.connection.commit()
+            except sqlite3.Error as e:
+                logger.error(f"Error writing {self.table} cache {self.path}: {e}")
+
+    def metrics(self) -> Dict[str, Dict[str, float]]:
+        """
+        Hit-rate metrics per model identity since the cache was opened.
+
+        Returns:
+            Dict[str, Dict[str, float]]: Counters and hit rate for every model identity.
+        """
+        with self.lock:
+            metrics = {}
+            for model_id, counters in self.stats.items():
+                lookups = sum(counters.values())
+                hits = counters['memory_hits'] + counters['disk_hits']
+                metrics[model_id] = {
+                    **counters,
+                    'lookups': lookups,
+                    'hit_rate': hits / lookups if lookups else 0.0,
+                }
+            return metrics
+
+
+class ScoreCache(PersistentLRUCache):
+    """
+    ScoreCache stores model scores for (claim, sentence) pairs, so that re-running an item or
+    verifying another item citing the same page does not run the cross-encoders again.
+
+    Keys are hashes of the model identity, the normalised claim and the sentence, so the scores of
+    different models and checkpoints can live in the same cache.
+
+    Args:
+        path (str): Path of the SQLite database. Defaults to 'score_cache.db'.
+        memory_items (int): Maximum number of entries in the LRU tier. Defaults to 100000.
+    """
+    table = 'scores'
+
+    def __init__(self, path: str = 'score_cache.db', memory_items: int = 100000) -> None:
+        super().__init__(path, memory_items)
+
+    def serialise(self, value: np.ndarray) -> bytes:
+        return np.asarray(value, dtype=np.float32).reshape(-1).tobytes()
+
+    def deserialise(self, value: bytes) -> np.ndarray:
+        return np.frombuffer(value, dtype=np.float32)
+
+    @staticmethod
+    def make_key(model_id: str, claim: str, sentence: str) -> str:
+        payload = '\x1f'.join([model_id, normalise_claim(claim), sentence])
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+    def get_many(self, model_id: str, pairs: List[Tuple[str, str]]) -> Tuple[List[str], Dict[str, np.ndarray]]:
+        """
+        Look up the scores of many (claim, sentence) pairs at once.
+
+        Args:
+            model_id (str): Identity of the model that produced the scores.
+            pairs (List[Tuple[str, str]]): (claim, sentence) pairs.
+
+        Returns:
+            Tuple[List[str], Dict[str, np.ndarray]]: The key of every pair, in order, and the
+                cached scores found for some of those keys.
+        """
+        keys = [self.make_key(model_id, claim, sentence) for claim, sentence in pairs]
+        return keys, self.lookup(model_id, keys)
+
+    def set_many(self, scores: Dict[str, np.ndarray]) -> None:
+        """
+        Store freshly computed scores in both tiers.
+
+        Args:
+            scores (Dict[str, np.ndarray]): Scores by key, as returned by get_many.
+        """
+        self.store({
+            key: np.asarray(value, dtype=np.float32).reshape(-1) for key, value in scores.items()
+        })
+
+    def score(
+        self,
+        model_id: str,
+        pairs: List[Tuple[str, str]],
+        score_function: Callable[[List[Tuple[str, str]]], np.ndarray]
+    ) -> np.ndarray:
+        """
+        Score pairs through the cache: hits are looked up in bulk and only the distinct missing
+        pairs are sent to score_function, whose results are stored for next time.
+
+        Args:
+            model_id (str): Identity of the model behind score_function.
+            pairs (List[Tuple[str, str]]): (claim, sentence) pairs.
+            score_function (Callable): Scores a list of pairs, returning one row per pair.
+
+        Returns:
+            np.ndarray: Array of shape (len(pairs), n_scores), in input order.
+        """
+        keys, found = self.get_many(model_id, pairs)
+
+        missing = {}
+        for key, pair in zip(keys, pairs):
+            if key not in found:
+                missing.setdefault(key, pair)
+
+        if missing:
+            computed = np.asarray(score_function(list(missing.values())), dtype=np.float32)
+            computed = computed.reshape(len(missing), -1)
+            computed = dict(zip(missing.keys(), computed))
+            self.set_many(computed)
+            found.update(computed)
+
+        return np.stack([found[key] for key in keys]) if keys else np.zeros((0, 1), dtype=np.float32)
+
+
+class VerbalisationCache(PersistentLRUCache):
+    """
+    VerbalisationCache stores the T5 verbalisation of each graph-to-text input, so a triple is
+    generated once per checkpoint instead of once per reference and per re-run of the item.
+
+    Keys are hashes of the model identity and the whitespace-normalised model input, which
+    encodes the (subject, predicate, object) labels of the triple or triples.
+
+    Args:
+        path (str): Path of the SQLite database. Defaults to 'score_cache.db'.
+        memory_items (int): Maximum number of entries in the LRU tier. Defaults to 100000.
+    """
+    table = 'verbalisations'
+    value_type = 'TEXT'
+
+    def __init__(self, path: str = 'score_cache.db', memory_items: int = 100000) -> None:
+        super().__init__(path, memory_items)
+
+    @staticmethod
+    def make_key(model_id: str, verbalisation_input: str) -> str:
+        payload = '\x1f'.join([model_id, normalise_claim(verbalisation_input)])
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+    def verbalise(
+        self,
+        model_id: str,
+        inputs: List[str],
+        verbalise_function: Callable[[List[str]], List[str]]
+    ) -> List[str]:
+        """
+        Verbalise inputs through the cache: hits are looked up in bulk and only the distinct
+        missing inputs are sent to verbalise_function, whose outputs are stored for next time.
+
+        Args:
+            model_id (str): Identity of the model behind verbalise_function.
+            inputs (List[str]): Graph-to-text model inputs.
+            verbalise_function (Callable): Verbalises a list of inputs, one output per input.
+
+        Returns:
+            List[str]: Verbalisations in input order.
+        """
+        keys = [self.make_key(model_id, verbalisation_input) for verbalisation_input in inputs]
+        found = self.lookup(model_id, keys)
+
+        missing = {}
+        for key, verbalisation_input in zip(keys, inputs):
+            if key not in found:
+                missing.setdefault(key, verbalisation_input)
+
+        if missing:
+            computed = dict(zip(missing.keys(), verbalise_function(list(missing.values()))))
+            self.store(computed)
+            found.update(computed)
+
+        return [found[key] for key in keys]
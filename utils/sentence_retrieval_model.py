@@ -4,9 +4,13 @@ import torch.nn as nn
 from utils.bert_model import BertForSequenceEncoder
 
 class sentence_retrieval_model(nn.Module):
-    def __init__(self, args):
+    def __init__(self, args, bert_config=None):
         super(sentence_retrieval_model, self).__init__()
-        self.pred_model = BertForSequenceEncoder.from_pretrained(args['bert_pretrain'])
+        if bert_config is not None:
+            # Untrained encoder, for weights loaded right after from a full checkpoint
+            self.pred_model = BertForSequenceEncoder(bert_config)
+        else:
+            self.pred_model = BertForSequenceEncoder.from_pretrained(args['bert_pretrain'])
         self.bert_hidden_dim = args['bert_hidden_dim']
         self.dropout = nn.Dropout(args['dropout'])
         self.proj_match = nn.Linear(self.bert_hidden_dim, 1)
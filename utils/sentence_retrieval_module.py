@@ -1,10 +1,15 @@
+import os
 import re
 from typing import List, Tuple
 import pathlib
 
+import numpy as np
 import torch
-from transformers import BertTokenizer
+from transformers import BertTokenizerFast
 
+from utils.batching import length_bucketed_batches
+from utils.pair_encoding import PairEncoder
+from utils.score_cache import checkpoint_identity
 from utils.sentence_retrieval_model import sentence_retrieval_model
 from utils.logger import logger
 
@@ -35,54 +40,113 @@ def process_sent(sentence):
 
 class SentenceRetrievalModule():
 
-    def __init__(self, max_len=None):
+    def __init__(
+        self, max_len=None, score_cache=None, pre_ranker=None, quantised_dir=None,
+        backend='pytorch', onnx_dir=None, intra_op_threads=0, inter_op_threads=0, safetensors_dir=None
+    ):
         
         if max_len:
             ARGS['max_len'] = max_len
         
-        self.tokenizer = BertTokenizer.from_pretrained(ARGS['bert_pretrain'], do_lower_case=False)
-        self.model = sentence_retrieval_model(ARGS)
-        self.model.load_state_dict(torch.load(ARGS['checkpoint'], map_location=torch.device('cpu'))['model'])
-        if ARGS['cuda']:
-            self.model = self.model.cuda()
-
-    def score_sentence_pairs(self, inputs, batch_size=32):
-        """Score sentence pairs in batches to avoid memory issues"""
-        self.model.eval()
-        scores = []
-        
-        # Process in batches
-        for i in range(0, len(inputs), batch_size):
-            batch = inputs[i:i + batch_size]
+        self.tokenizer = BertTokenizerFast.from_pretrained(ARGS['bert_pretrain'], do_lower_case=False)
+        # Token ids of each distinct sentence and claim, computed once and shared by all their pairs
+        self.pair_encoder = PairEncoder(self.tokenizer, preprocess=process_sent)
+        self.onnx_model = None
+        if backend == 'onnx':
+            # Graph exported by utils/onnx_cross_encoders.py
+            from utils.onnx_cross_encoders import OnnxCrossEncoder, RETRIEVAL_FILE
+
+            onnx_path = os.path.join(onnx_dir, RETRIEVAL_FILE)
+            self.cuda = False
+            self.model = None
+            self.onnx_model = OnnxCrossEncoder(onnx_path, intra_op_threads, inter_op_threads)
+            model_identity = f"onnx-{checkpoint_identity(onnx_path)}"
+        elif backend != 'pytorch':
+            raise ValueError(f"Unknown cross-encoder backend: {backend}")
+        elif quantised_dir:
+            # Pre-quantised int8 model from utils/quantisation.py, CPU only
+            from utils.quantisation import load_quantised, quantised_identity
+
+            self.cuda = False
+            self.model = load_quantised(quantised_dir, 'retrieval', checkpoint_identity(ARGS['checkpoint']))
+            model_identity = f"int8-{quantised_identity(quantised_dir, 'retrieval')}"
+        elif safetensors_dir:
+            # Memory-mapped weights from utils/safetensors_checkpoints.py, same scores as the checkpoint
+            from utils.safetensors_checkpoints import load_retrieval, source_identity
+
+            self.cuda = ARGS['cuda']
+            self.model = load_retrieval(safetensors_dir, ARGS)
+            if self.cuda:
+                self.model = self.model.cuda()
+            model_identity = source_identity(safetensors_dir, 'retrieval', checkpoint_identity(ARGS['checkpoint']))
+        else:
+            self.cuda = ARGS['cuda']
+            self.model = sentence_retrieval_model(ARGS)
+            self.model.load_state_dict(torch.load(ARGS['checkpoint'], map_location=torch.device('cpu'))['model'])
+            if self.cuda:
+                self.model = self.model.cuda()
+            model_identity = checkpoint_identity(ARGS['checkpoint'])
+
+        # Optional ScoreCache shared with the other models
+        self.score_cache = score_cache
+        self.model_id = f"retrieval-{model_identity}-{ARGS['max_len']}"
+        # Optional BiEncoderPreRanker narrowing the sentences this cross-encoder reranks
+        self.pre_ranker = pre_ranker
+        # Batch size picked by utils/cpu_threads.py, when tuned
+        self.batch_size = None
+
+    def score_sentence_pairs(self, inputs, batch_size=32, token_budget=None):
+        """Score sentence pairs, reusing cached scores when a ScoreCache is set"""
+        if self.score_cache is None or not inputs:
+            return self.compute_sentence_pair_scores(inputs, batch_size, token_budget)
+
+        scores = self.score_cache.score(
+            self.model_id,
+            inputs,
+            lambda pairs: self.compute_sentence_pair_scores(pairs, batch_size, token_budget)
+        )
+        return scores[:, 0].tolist()
+
+    def compute_sentence_pair_scores(self, inputs, batch_size=32, token_budget=None):
+        """Score sentence pairs in length-sorted batches, each padded to its longest pair"""
+        if self.model is not None:
+            self.model.eval()
+        scores = np.zeros(len(inputs))
+        if not inputs:
+            return scores.tolist()
+
+        encodings = self.encode_pairs(inputs)
+        lengths = [len(input_ids) for input_ids in encodings['input_ids']]
+
+        # Process in batches of similar length, then restore the original order
+        for batch_indices in length_bucketed_batches(lengths, self.batch_size or batch_size, token_budget):
             
+            if self.onnx_model is not None:
+                scores[batch_indices] = self.onnx_model.run(self.prepare_input(encodings, batch_indices, 'np'))
+                continue
+
             # Prepare batch tensors
-            inp, msk, seg = self.prepare_input(batch)
+            inp, msk, seg = self.prepare_input(encodings, batch_indices)
             
             with torch.no_grad():
-                batch_scores = self.model(inp, msk, seg).tolist()
-            scores.extend(batch_scores)
+                scores[batch_indices] = self.model(inp, msk, seg).cpu().numpy()
         
-        assert len(scores) == len(inputs)
-        return scores
-
-    def prepare_input(self, batch):
-        inputs_processed = [(process_sent(input[0]), process_sent(input[1])) for input in batch]
-
-        encodings =  self.tokenizer(
-            inputs_processed,
-            padding='max_length',
-            truncation='longest_first',
-            max_length=ARGS['max_len'],
-            return_token_type_ids=True,
-            return_attention_mask=True,
-            return_tensors='pt',
-        )
+        return scores.tolist()
+
+    def encode_pairs(self, inputs):
+        return self.pair_encoder.encode(inputs, ARGS['max_len'])
+
+    def prepare_input(self, encodings, batch_indices, return_tensors='pt'):
+        batch = self.pair_encoder.pad(encodings, batch_indices)
+        if return_tensors == 'np':
+            # Padded numpy arrays fed as they are to the ONNX graph
+            return batch
 
-        inp = encodings['input_ids']
-        msk = encodings['attention_mask']
-        seg = encodings['token_type_ids']
+        inp = torch.from_numpy(batch['input_ids'])
+        msk = torch.from_numpy(batch['attention_mask'])
+        seg = torch.from_numpy(batch['token_type_ids'])
 
-        if ARGS['cuda']:
+        if self.cuda:
             inp = inp.cuda()
             msk = msk.cuda()
             seg = seg.cuda()
@@ -0,0 +1,160 @@
+"""
+Timing spans around the stages of the pipeline, aggregated into Prometheus histograms.
+
+Every task records its stages in a TaskSpans: ``with spans.span('fetching') as span:`` times the
+body and ``span.count('urls', n)`` / ``span.add_bytes(n)`` attach what the stage processed. The
+per-task breakdown is a plain dict stored in parser_stats under 'stages', so slow entities can be
+analysed offline. Each closed span is also observed in the histograms of the process, which
+serve_metrics exposes in the Prometheus text format when ``metrics.enabled`` is set in config.yaml.
+"""
+import bisect
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import Dict, List, Optional, Tuple
+
+from utils.logger import logger
+
+DURATION_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+ITEM_BUCKETS = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 50000]
+BYTE_BUCKETS = [1e3, 1e4, 1e5, 1e6, 5e6, 1e7, 5e7, 1e8]
+
+
+class Histogram():
+    """Cumulative histogram of one metric, one series per label set."""
+    def __init__(self, name: str, help_text: str, buckets: List[float]):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        # Labels -> (count per bucket, +Inf included, sum of the observations)
+        self.series: Dict[Tuple[Tuple[str, str], ...], Tuple[List[int], float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        counts, total = self.series.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.series[key] = (counts, total + value)
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        for key, (counts, total) in sorted(self.series.items()):
+            labels = ','.join(f'{name}="{value}"' for name, value in key)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ['+Inf'], counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{labels}}} {total}')
+            lines.append(f'{self.name}_count{{{labels}}} {cumulative}')
+        return lines
+
+
+class StageMetrics():
+    """Histograms of the stage durations, item counts and bytes of this process."""
+    def __init__(self):
+        self.lock = Lock()
+        self.durations = Histogram(
+            'prove_stage_duration_seconds', 'Duration of a pipeline stage for one task.', DURATION_BUCKETS
+        )
+        self.items = Histogram(
+            'prove_stage_items', 'Items (claims, urls, sentences, pairs) handled by a stage for one task.', ITEM_BUCKETS
+        )
+        self.bytes = Histogram('prove_stage_bytes', 'Bytes handled by a stage for one task.', BYTE_BUCKETS)
+        self.errors: Dict[str, int] = {}
+
+    def record(self, stage: str, seconds: float, counts: Dict[str, int], n_bytes: Optional[int], failed: bool) -> None:
+        with self.lock:
+            self.durations.observe(seconds, stage=stage)
+            for item, count in counts.items():
+                self.items.observe(count, stage=stage, item=item)
+            if n_bytes is not None:
+                self.bytes.observe(n_bytes, stage=stage)
+            if failed:
+                self.errors[stage] = self.errors.get(stage, 0) + 1
+
+    def render(self) -> str:
+        """All the metrics in the Prometheus text format."""
+        with self.lock:
+            lines = self.durations.render() + self.items.render() + self.bytes.render()
+            lines += ['# HELP prove_stage_errors_total Stages that raised.', '# TYPE prove_stage_errors_total counter']
+            lines += [f'prove_stage_errors_total{{stage="{stage}"}} {count}' for stage, count in sorted(self.errors.items())]
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = StageMetrics()
+
+
+class Span():
+    """What a stage handled, filled in by the body of TaskSpans.span."""
+    def __init__(self):
+        self.counts: Dict[str, int] = {}
+        self.bytes: Optional[int] = None
+
+    def count(self, item: str, n: int) -> None:
+        self.counts[item] = self.counts.get(item, 0) + int(n)
+
+    def add_bytes(self, n: int) -> None:
+        self.bytes = (self.bytes or 0) + int(n)
+
+
+class TaskSpans():
+    """
+    Stage spans of one task.
+
+    Args:
+        stages (Optional[Dict[str, Dict]]): Breakdown to record into, e.g. the 'stages' entry of
+            parser_stats when a task is continued elsewhere. Defaults to a new dict.
+
+    Attributes:
+        stages (Dict[str, Dict]): seconds and counts (plus bytes) of every stage of the task.
+    """
+    def __init__(self, stages: Optional[Dict[str, Dict]] = None):
+        self.stages = {} if stages is None else stages
+
+    @contextmanager
+    def span(self, stage: str):
+        """Time the body as stage, recording it even when the body raises."""
+        span = Span()
+        failed = False
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            entry = self.stages.setdefault(stage, {'seconds': 0.0})
+            entry['seconds'] = round(entry['seconds'] + seconds, 4)
+            for item, count in span.counts.items():
+                entry[item] = entry.get(item, 0) + count
+            if span.bytes is not None:
+                entry['bytes'] = entry.get('bytes', 0) + span.bytes
+            if failed:
+                entry['failed'] = True
+            METRICS.record(stage, seconds, span.counts, span.bytes, failed)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = METRICS.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not worth a log line each
+        pass
+
+
+def serve_metrics(host: str = '127.0.0.1', port: int = 9464) -> ThreadingHTTPServer:
+    """Serve the metrics of this process on http://host:port/metrics from a daemon thread."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    Thread(target=server.serve_forever, name='prove-metrics', daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
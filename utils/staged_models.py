@@ -0,0 +1,73 @@
+"""
+Pipeline models loaded only for the stage that uses them, for hosts that cannot hold them all.
+
+With ``workers.profile: 'low_memory'`` in config.yaml, a worker takes up to
+``workers.batch_entities`` tasks from the queues and runs each stage over all of them before the
+next one starts (ProVe_main_process.process_entities_staged). StageModels loads the model of a
+stage when the stage starts and releases it when it ends, so at most one of the two BERTs and T5
+is in memory at a time and each of them is loaded once per batch rather than once per entity.
+The peak RSS of every stage is measured and logged.
+"""
+import ctypes
+import gc
+import time
+from typing import Any, Callable, Dict
+
+from utils.logger import logger
+from utils.process_memory import peak_rss, process_memory, reset_peak_rss
+
+
+def release_memory() -> None:
+    """Collect the released objects and hand the freed heap back to the system."""
+    gc.collect()
+    try:
+        # glibc keeps freed blocks in the process otherwise, so the RSS would not go down
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+class StageModels():
+    """
+    Runs the stages of a batch, each with its model loaded for the duration of the stage.
+
+    Args:
+        loaders (Dict[str, Callable[[], Any]]): Loader of the pipeline module of each stage that
+            needs a model, by stage name.
+
+    Attributes:
+        peaks (Dict[str, float]): Peak RSS in MB of the last run of each stage.
+        load_times (Dict[str, float]): Seconds spent loading the model of each stage, last run.
+    """
+    def __init__(self, loaders: Dict[str, Callable[[], Any]]):
+        self.loaders = loaders
+        self.peaks: Dict[str, float] = {}
+        self.load_times: Dict[str, float] = {}
+
+    def run(self, stage: str, function: Callable[[Any], None]) -> None:
+        """
+        Load the model of a stage, call function with it and release it.
+
+        The module is only referenced by this call, so function must not keep it beyond its own
+        return, e.g. in an attribute of a longer lived object.
+
+        Args:
+            stage (str): Stage name, without a loader the function is called with None.
+            function (Callable[[Any], None]): Work of the stage over the whole batch.
+        """
+        measured = reset_peak_rss()
+        module = None
+        try:
+            if stage in self.loaders:
+                start = time.perf_counter()
+                module = self.loaders[stage]()
+                self.load_times[stage] = time.perf_counter() - start
+            function(module)
+        finally:
+            del module
+            release_memory()
+            self.peaks[stage] = peak_rss() if measured else process_memory().get('rss', 0.0)
+            logger.info(
+                f"Stage {stage}: peak RSS {self.peaks[stage]:.0f} MB, "
+                f"model loaded in {self.load_times.get(stage, 0):.1f}s"
+            )
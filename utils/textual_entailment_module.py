@@ -1,16 +1,23 @@
 import json
+import os
 import numpy as np
 import pandas as pd
 from pathlib import Path
 import torch
 import re
 
-from transformers import BertTokenizer, BertForSequenceClassification
+from transformers import BertTokenizerFast, BertForSequenceClassification
+
+from utils.batching import length_bucketed_batches
+from utils.pair_encoding import PairEncoder
+from utils.score_cache import checkpoint_identity
 
 # Constants and paths
 HOME = Path('/users/k2031554')
 DEVICE = 'cuda:0' if torch.cuda.is_available() else 'cpu'
 MAX_LEN = 512
+MODEL_PATH = '/home/ubuntu/RQV/base/models/BERT_FEVER_v4_model_PBT'
+TOKENIZER_PATH = '/home/ubuntu/RQV/base/models/BERT_FEVER_v4_tok_PBT'
 CLASSES = ['SUPPORTS','REFUTES','NOT ENOUGH INFO']
 METHODS = ['WEIGHTED_SUM', 'MALON']
 
@@ -28,16 +35,63 @@ class TextualEntailmentModule():
 
     def __init__(
         self,
-        model_path = '/home/ubuntu/RQV/base/models/BERT_FEVER_v4_model_PBT',
-        tokenizer_path = '/home/ubuntu/RQV/base/models/BERT_FEVER_v4_tok_PBT'
+        model_path = MODEL_PATH,
+        tokenizer_path = TOKENIZER_PATH,
+        score_cache = None,
+        quantised_dir = None,
+        backend = 'pytorch',
+        onnx_dir = None,
+        intra_op_threads = 0,
+        inter_op_threads = 0,
+        safetensors_dir = None
         ):
-        self.tokenizer = BertTokenizer.from_pretrained(
+        self.tokenizer = BertTokenizerFast.from_pretrained(
             tokenizer_path
         )
-        self.model = BertForSequenceClassification.from_pretrained(
-            model_path
-        )
-        self.model.to(DEVICE)
+        # Token ids of each distinct claim and sentence, computed once and shared by all their pairs
+        self.pair_encoder = PairEncoder(self.tokenizer)
+        self.onnx_model = None
+        if backend == 'onnx':
+            # Graph exported by utils/onnx_cross_encoders.py
+            from utils.onnx_cross_encoders import OnnxCrossEncoder, ENTAILMENT_FILE
+
+            onnx_path = os.path.join(onnx_dir, ENTAILMENT_FILE)
+            self.device = 'cpu'
+            self.model = None
+            self.onnx_model = OnnxCrossEncoder(onnx_path, intra_op_threads, inter_op_threads)
+            self.model_id = f"entailment-onnx-{checkpoint_identity(onnx_path)}"
+        elif backend != 'pytorch':
+            raise ValueError(f"Unknown cross-encoder backend: {backend}")
+        elif quantised_dir:
+            # Pre-quantised int8 model from utils/quantisation.py, CPU only
+            from utils.quantisation import load_quantised, quantised_identity
+
+            self.device = 'cpu'
+            self.model = load_quantised(
+                quantised_dir, 'entailment', checkpoint_identity(model_path, tokenizer_path)
+            )
+            self.model_id = f"entailment-int8-{quantised_identity(quantised_dir, 'entailment')}"
+        elif safetensors_dir:
+            # Memory-mapped weights from utils/safetensors_checkpoints.py, same scores as the checkpoint
+            from utils.safetensors_checkpoints import load_entailment, source_identity
+
+            self.device = DEVICE
+            self.model = load_entailment(safetensors_dir)
+            self.model.to(DEVICE)
+            self.model_id = "entailment-{}".format(
+                source_identity(safetensors_dir, 'entailment', checkpoint_identity(model_path, tokenizer_path))
+            )
+        else:
+            self.device = DEVICE
+            self.model = BertForSequenceClassification.from_pretrained(
+                model_path
+            )
+            self.model.to(DEVICE)
+            self.model_id = f"entailment-{checkpoint_identity(model_path, tokenizer_path)}"
+        # Optional ScoreCache shared with the other models
+        self.score_cache = score_cache
+        # Batch size picked by utils/cpu_threads.py, when tuned
+        self.batch_size = None
 
     #def get_pair_scores(self, claim, evidence):
     #    
@@ -59,31 +113,68 @@ class TextualEntailmentModule():
     #    
     #    return torch.softmax(probs.logits,dim=1).cpu().numpy()
 
-    def get_batch_scores(self, claims, evidence):
+    def get_batch_scores(self, claims, evidence, batch_size=32, token_budget=None):
 
         inputs = list(zip(claims, evidence))
-        
-        encodings = self.tokenizer(
+        if self.score_cache is None or not inputs:
+            return self.compute_batch_scores(inputs, batch_size, token_budget)
+
+        return self.score_cache.score(
+            self.model_id,
             inputs,
-            max_length= MAX_LEN,
-            return_token_type_ids=False,
-            padding='max_length',
-            truncation=True,
-            return_tensors='pt',
-        ).to(DEVICE)
-
-        self.model.eval()
-        with torch.no_grad():
-            probs = self.model(
-                input_ids=encodings['input_ids'],
-                attention_mask=encodings['attention_mask']
-            )
+            lambda pairs: self.compute_batch_scores(pairs, batch_size, token_budget)
+        )
+
+    def compute_batch_scores(self, inputs, batch_size=32, token_budget=None):
+
+        probs = np.zeros((len(inputs), len(CLASSES)), dtype=np.float32)
+        if not inputs:
+            return probs
         
-        return torch.softmax(probs.logits,dim=1).cpu().numpy()
+        encodings = self.pair_encoder.encode(inputs, MAX_LEN, return_token_type_ids=False)
+        lengths = [len(input_ids) for input_ids in encodings['input_ids']]
+
+        if self.model is not None:
+            self.model.eval()
+        # Batches of similar length padded to their longest pair, scattered back in input order
+        for batch_indices in length_bucketed_batches(lengths, self.batch_size or batch_size, token_budget):
+            batch = self.pair_encoder.pad(encodings, batch_indices)
+            if self.onnx_model is not None:
+                logits = torch.from_numpy(self.onnx_model.run(batch))
+                probs[batch_indices] = torch.softmax(logits, dim=1).numpy()
+                continue
+
+            batch = {key: torch.from_numpy(value).to(self.device) for key, value in batch.items()}
+
+            with torch.no_grad():
+                logits = self.model(
+                    input_ids=batch['input_ids'],
+                    attention_mask=batch['attention_mask']
+                ).logits
+            probs[batch_indices] = torch.softmax(logits, dim=1).cpu().numpy()
+        
+        return probs
+
+    def count_tokens(self, texts):
+        # Word-piece count of every text, without the special tokens of the pair
+        return [len(input_ids) for input_ids in self.pair_encoder.token_ids(list(texts))]
 
     def get_label_from_scores(self, scores):
         return CLASSES[np.argmax(scores)]
 
+    def get_labels_from_scores(self, scores):
+        # Vectorised get_label_from_scores over an (N, 3) array
+        scores = np.asarray(scores).reshape(-1, len(CLASSES))
+        return np.asarray(CLASSES, dtype=object)[np.argmax(scores, axis=1)].tolist()
+
+    def get_labels_malon(self, score_sets):
+        # Vectorised get_label_malon over an (N, n_evidence, 3) array
+        score_labels = np.argmax(np.asarray(score_sets), axis=-1)
+        label_idx = np.where(
+            (score_labels == 0).any(axis=1), 0, np.where((score_labels == 1).any(axis=1), 1, 2)
+        )
+        return np.asarray(CLASSES, dtype=object)[label_idx].tolist()
+
     def get_label_malon(self, score_set):
         score_labels = [np.argmax(s) for s in score_set]
         if 1 not in score_labels and 0 not in score_labels:
@@ -1,4 +1,8 @@
 from utils.finetune import Graph2TextModule
+from utils.score_cache import checkpoint_identity
+from utils.batching import length_bucketed_batches
+from collections import deque
+import os
 from typing import Dict, List, Tuple, Union, Optional
 import torch
 import re
@@ -13,38 +17,128 @@ CHECKPOINT = '/home/ubuntu/RQV/base/t5-base_13881_val_avg_bleu=68.1000-step_coun
 MAX_LENGTH = 384
 SEED = 42
 
+JAPANESE_CHARACTERS = str.maketrans({'（': '(', '）': ')', '〈': '<', '／': '/', '〉': '>'})
+UNK_RUN = re.compile('(?:(?: )*<unk>(?: )*)+')
+MULTIPLE_SPACES = re.compile(r'\s+')
+DOUBLE_SPACES = re.compile(r'\s{2,}')
+SPACE_BEFORE_PUNCTUATION = re.compile(r'\s([?.!",](?:\s|$))')
+
 
 class VerbModule():
     
-    def __init__(self, override_args: Dict[str, str] = None):
+    def __init__(
+        self,
+        override_args: Dict[str, str] = None,
+        verbalisation_cache = None,
+        batch_size: int = 32,
+        token_budget: Optional[int] = None,
+        backend: str = 'pytorch',
+        onnx_dir: Optional[str] = None,
+        intra_op_threads: int = 0,
+        inter_op_threads: int = 0,
+        quantised_dir: Optional[str] = None,
+        safetensors_dir: Optional[str] = None
+    ):
         # Model
         if not override_args:
             override_args = {}
-        self.g2t_module = Graph2TextModule.load_from_checkpoint(CHECKPOINT, strict=False, **override_args)
-        self.tokenizer = self.g2t_module.tokenizer
-        # Unk replacer
+        self.backend = backend
+        if backend == 'onnx':
+            # Graphs, tokenizer and generation settings exported by utils/onnx_verbalisation.py
+            from transformers import AutoTokenizer
+            from utils.onnx_verbalisation import OnnxT5Generator, ENCODER_FILE, DECODER_FILE, DECODER_WITH_PAST_FILE
+
+            self.g2t_module = None
+            self.model = None
+            self.device = 'cpu'
+            self.onnx_generator = OnnxT5Generator(onnx_dir, intra_op_threads, inter_op_threads)
+            self.tokenizer = AutoTokenizer.from_pretrained(onnx_dir)
+            self.eval_beams = self.onnx_generator.generation_config['eval_beams']
+            self.eval_max_length = self.onnx_generator.generation_config['eval_max_length']
+            model_identity = checkpoint_identity(
+                *(os.path.join(onnx_dir, name) for name in (ENCODER_FILE, DECODER_FILE, DECODER_WITH_PAST_FILE))
+            )
+        elif backend == 'pytorch' and quantised_dir:
+            # Pre-quantised int8 T5, tokenizer and generation settings from utils/quantisation.py
+            from transformers import AutoTokenizer
+            from utils.quantisation import (
+                load_quantised, quantised_identity, read_manifest, VERBALISATION_TOKENIZER_DIR
+            )
+
+            self.g2t_module = None
+            self.onnx_generator = None
+            self.device = 'cpu'
+            self.model = load_quantised(quantised_dir, 'verbalisation', checkpoint_identity(CHECKPOINT))
+            self.tokenizer = AutoTokenizer.from_pretrained(os.path.join(quantised_dir, VERBALISATION_TOKENIZER_DIR))
+            generation_config = read_manifest(quantised_dir)['verbalisation']
+            self.eval_beams = generation_config['eval_beams']
+            self.eval_max_length = generation_config['eval_max_length']
+            model_identity = f"int8-{quantised_identity(quantised_dir, 'verbalisation')}"
+        elif backend == 'pytorch' and safetensors_dir:
+            # Memory-mapped T5, tokenizer and generation settings from utils/safetensors_checkpoints.py
+            from utils.safetensors_checkpoints import load_verbalisation, source_identity
+
+            self.g2t_module = None
+            self.onnx_generator = None
+            self.device = DEVICE
+            self.model, self.tokenizer, generation_config = load_verbalisation(safetensors_dir)
+            self.model.to(DEVICE)
+            self.eval_beams = generation_config['eval_beams']
+            self.eval_max_length = generation_config['eval_max_length']
+            model_identity = source_identity(safetensors_dir, 'verbalisation', checkpoint_identity(CHECKPOINT))
+        elif backend == 'pytorch':
+            self.g2t_module = Graph2TextModule.load_from_checkpoint(CHECKPOINT, strict=False, **override_args)
+            self.onnx_generator = None
+            self.device = DEVICE
+            self.model = self.g2t_module.model
+            self.tokenizer = self.g2t_module.tokenizer
+            self.eval_beams = self.g2t_module.eval_beams
+            self.eval_max_length = self.g2t_module.eval_max_length
+            model_identity = checkpoint_identity(CHECKPOINT)
+        else:
+            raise ValueError(f"Unknown verbalisation backend: {backend}")
+        # Optional VerbalisationCache, keyed by model input and checkpoint/generation settings
+        self.verbalisation_cache = verbalisation_cache
+        self.model_id = 'verbalisation-{}-{}-{}-{}'.format(
+            backend, model_identity, self.eval_beams, self.eval_max_length
+        )
+        # Generation chunks: at most batch_size inputs and token_budget padded source tokens
+        self.batch_size = batch_size
+        self.token_budget = token_budget
+        # Unk replacer settings, the replacers themselves are made per request
         self.vocab = self.tokenizer.get_vocab()
         self.convert_some_japanese_characters = True
         self.unk_char_replace_sliding_window_size = 2
-        self.unknowns = []
 
     def __generate_verbalisations_from_inputs(self, inputs: Union[str, List[str]]):
         try:
+            if self.onnx_generator is not None:
+                inputs_encoding = self.tokenizer(
+                    inputs, truncation=True, max_length=MAX_LENGTH, padding='longest', return_tensors='np'
+                )
+                return self.onnx_generator.generate(
+                    inputs_encoding['input_ids'],
+                    inputs_encoding['attention_mask'],
+                    max_length=self.eval_max_length,
+                    num_beams=self.eval_beams,
+                    length_penalty=1.0,
+                )
+
             inputs_encoding = self.tokenizer.prepare_seq2seq_batch(
                 inputs, truncation=True, max_length=MAX_LENGTH, return_tensors='pt'
             )
-            inputs_encoding = {k: v.to(DEVICE) for k, v in inputs_encoding.items()}
+            inputs_encoding = {k: v.to(self.device) for k, v in inputs_encoding.items()}
             
-            self.g2t_module.model.eval()
+            self.model.eval()
             with torch.no_grad():
                 # Add decoder_start_token_id configuration
-                self.g2t_module.model.config.decoder_start_token_id = self.g2t_module.tokenizer.pad_token_id
+                self.model.config.decoder_start_token_id = self.tokenizer.pad_token_id
                 
-                gen_output = self.g2t_module.model.generate(
+                gen_output = self.model.generate(
                     input_ids=inputs_encoding['input_ids'],
                     attention_mask=inputs_encoding['attention_mask'],
-                    max_length=self.g2t_module.eval_max_length,
-                    num_beams=self.g2t_module.eval_beams,
+                    max_length=self.eval_max_length,
+                    num_beams=self.eval_beams,
                     length_penalty=1.0,
                     early_stopping=True,
                 )
@@ -92,13 +186,38 @@ class VerbModule():
         decoded_sentences = [self.__decode_ids_to_string_custom(i, skip_special_tokens=True) for i in encoded_sentences]
         return decoded_sentences
         
+    def verbalise_batch(self, inputs: List[str]) -> List[str]:
+        # Generate each distinct input once, in chunks of similar length, then scatter back
+        unique_inputs = list(dict.fromkeys(inputs))
+        lengths = [
+            len(input_ids) for input_ids in self.tokenizer(
+                unique_inputs, truncation=True, max_length=MAX_LENGTH
+            )['input_ids']
+        ]
+
+        decoded_sentences = [None] * len(unique_inputs)
+        for batch_indices in length_bucketed_batches(lengths, self.batch_size, self.token_budget):
+            gen_output = self.__generate_verbalisations_from_inputs(
+                [unique_inputs[idx] for idx in batch_indices]
+            )
+            for idx, sentence in zip(batch_indices, self.__decode_sentences(gen_output)):
+                decoded_sentences[idx] = sentence
+
+        positions = {verbalisation_input: idx for idx, verbalisation_input in enumerate(unique_inputs)}
+        return [decoded_sentences[positions[verbalisation_input]] for verbalisation_input in inputs]
+
+    def verbalise_inputs(self, inputs: List[str]) -> List[str]:
+        # One verbalisation per model input, through the cache when there is one
+        if self.verbalisation_cache is None:
+            return self.verbalise_batch(inputs)
+        # Only the distinct inputs missing from the cache reach the model
+        return self.verbalisation_cache.verbalise(self.model_id, inputs, self.verbalise_batch)
+
     def verbalise_sentence(self, inputs: Union[str, List[str]]):
         if type(inputs) == str:
             inputs = [inputs]
         
-        gen_output = self.__generate_verbalisations_from_inputs(inputs)
-        
-        decoded_sentences = self.__decode_sentences(gen_output)
+        decoded_sentences = self.verbalise_inputs(inputs)
 
         if len(decoded_sentences) == 1:
             return decoded_sentences[0]
@@ -145,21 +264,64 @@ class VerbModule():
             print(f'ERROR VERBALISING {input}')
             raise
                 
-    def add_label_to_unk_replacer(self, label: str):
+    def new_unk_replacer(self, labels: List[str] = ()) -> 'UnkReplacer':
+        '''
+        Create the <unk> replacer of one request. Each request gets its own replacer, so concurrent
+        requests sharing this module never see each other's labels.
+        '''
+        return UnkReplacer(
+            self.tokenizer,
+            labels,
+            convert_some_japanese_characters=self.convert_some_japanese_characters,
+            sliding_window_size=self.unk_char_replace_sliding_window_size,
+        )
+
+
+class UnkReplacer():
+    '''
+    Replaces the <unk> tokens of verbalisations with the characters of the labels they stand for.
+
+    Labels are analysed once when added, and the replacing keys of all labels are compiled into a
+    single alternation pattern, so each pass over a sentence substitutes every key in one scan
+    instead of one str.replace per key and label.
+    '''
+    def __init__(
+        self,
+        tokenizer,
+        labels: List[str] = (),
+        convert_some_japanese_characters: bool = True,
+        sliding_window_size: int = 2
+    ):
+        self.tokenizer = tokenizer
+        self.convert_some_japanese_characters = convert_some_japanese_characters
+        self.unk_char_replace_sliding_window_size = sliding_window_size
+        self.unknowns: List[Dict[str, str]] = []
+        # Flattened (key, value) entries and the patterns compiled from them, built lazily
+        self._entries = None
+        self._patterns: Dict[Tuple[str, ...], re.Pattern] = {}
+        for label in labels:
+            self.add_label(label)
+
+    @classmethod
+    def from_unknowns(cls, unknowns: List[Dict[str, str]]) -> 'UnkReplacer':
+        '''Build a replacer from already analysed labels, as stored in the regression fixture.'''
+        replacer = cls(tokenizer=None)
+        replacer.unknowns = [dict(label_unknowns) for label_unknowns in unknowns]
+        return replacer
+
+    def add_label(self, label: str):
         N = self.unk_char_replace_sliding_window_size
-        self.unknowns.append({})
-        
+        unknowns = {}
+        self.unknowns.append(unknowns)
+        self._entries = None
+
         # Some pre-processing of labels to normalise some characters
         if self.convert_some_japanese_characters:
-            label = label.replace('（','(')
-            label = label.replace('）',')')
-            label = label.replace('〈','<')
-            label = label.replace('／','/')
-            label = label.replace('〉','>')        
-        
+            label = label.translate(JAPANESE_CHARACTERS)
+
         label_encoded = self.tokenizer.encode(label)
         label_tokens = self.tokenizer.convert_ids_to_tokens(label_encoded)
-        
+
         # Here, we also remove </s> (eos) and <pad> tokens in the replacing key, because:
         # 1) When the whole label is all unk:
         #   label_token_to_string would be '<unk></s>', meaning the replacing key (which is the same) only replaces
@@ -175,79 +337,64 @@ class VerbModule():
 
         label_token_to_string = self.tokenizer.convert_tokens_to_string(label_tokens)
         unk_token_to_string = self.tokenizer.convert_tokens_to_string([self.tokenizer.unk_token])
-                
-        #print(label_encoded,label_tokens,label_token_to_string)
-        
-        match_unks_in_label = re.findall('(?:(?: )*<unk>(?: )*)+', label_token_to_string)
+
+        match_unks_in_label = UNK_RUN.findall(label_token_to_string)
         if len(match_unks_in_label) > 0:
             # If the whole label is made of UNK
             if (match_unks_in_label[0]) == label_token_to_string:
-                #print('Label is all unks')                    
-                self.unknowns[-1][label_token_to_string.strip()] = label
+                unknowns[label_token_to_string.strip()] = label
             # Else, there should be non-UNK characters in the label
             else:
-                #print('Label is NOT all unks')
                 # Analyse the label with a sliding window of size N (N before, N ahead)
                 for idx, token in enumerate(label_tokens):
                     idx_before = max(0,idx-N)
                     idx_ahead = min(len(label_tokens), idx+N+1)
-                    
-                                       
+
                     # Found a UNK
                     if token == self.tokenizer.unk_token:
-                        
+
                         # In case multiple UNK, exclude UNKs seen after this one, expand window to other side if possible
                         if len(match_unks_in_label) > 1:
-                            #print(idx)
-                            #print(label_tokens)
-                            #print(label_tokens[idx_before:idx_ahead])
-                            #print('HERE!')
                             # Reduce on the right, expanding on the left
                             while self.tokenizer.unk_token in label_tokens[idx+1:idx_ahead]:
                                 idx_before = max(0,idx_before-1)
                                 idx_ahead = min(idx+2, idx_ahead-1)
-                                #print(label_tokens[idx_before:idx_ahead])
                             # Now just reduce on the left
                             while self.tokenizer.unk_token in label_tokens[idx_before:idx]:
                                 idx_before = min(idx-1,idx_before+2)
-                                #print(label_tokens[idx_before:idx_ahead])
 
-                        span = self.tokenizer.convert_tokens_to_string(label_tokens[idx_before:idx_ahead])        
-                        # First token of the label is UNK                        
+                        span = self.tokenizer.convert_tokens_to_string(label_tokens[idx_before:idx_ahead])
+                        # First token of the label is UNK
                         if idx == 1 and label_tokens[0] == '▁':
-                            #print('Label begins with unks')
                             to_replace = '^' + re.escape(span).replace(
                                     re.escape(unk_token_to_string),
                                     '.+?'
                                 )
-                            
+
                             replaced_span = re.search(
                                 to_replace,
                                 label
                             )[0]
-                            self.unknowns[-1][span.strip()] = replaced_span
+                            unknowns[span.strip()] = replaced_span
                         # Last token of the label is UNK
                         elif idx == len(label_tokens)-2 and label_tokens[-1] == self.tokenizer.eos_token:
-                            #print('Label ends with unks')
                             pre_idx = self.tokenizer.convert_tokens_to_string(label_tokens[idx_before:idx])
-                            pre_idx_unk_counts = pre_idx.count(unk_token_to_string)
                             to_replace = re.escape(span).replace(
                                     re.escape(unk_token_to_string),
                                     f'[^{re.escape(pre_idx)}]+?'
                                 ) + '$'
-                            
+
                             if pre_idx.strip() == '':
                                 to_replace = to_replace.replace('[^]', '(?<=\s)[^a-zA-Z0-9]')
-                            
+
                             replaced_span = re.search(
                                 to_replace,
                                 label
                             )[0]
-                            self.unknowns[-1][span.strip()] = replaced_span
-                            
-                        # A token in-between the label is UNK                            
+                            unknowns[span.strip()] = replaced_span
+
+                        # A token in-between the label is UNK
                         else:
-                            #print('Label has unks in the middle')
                             pre_idx = self.tokenizer.convert_tokens_to_string(label_tokens[idx_before:idx])
 
                             to_replace = re.escape(span).replace(
@@ -258,41 +405,80 @@ class VerbModule():
                             #a ??, then we would end up with to_replace beginning with [^], which we can't have
                             if pre_idx.strip() == '':
                                 to_replace = to_replace.replace('[^]', '(?<=\s)[^a-zA-Z0-9]')
-        
+
                             replaced_span = re.search(
                                 to_replace,
                                 label
                             )
-                            
+
                             if replaced_span:
-                                span = re.sub(r'\s([?.!",](?:\s|$))', r'\1', span.strip())
-                                self.unknowns[-1][span] = replaced_span[0]  
+                                span = SPACE_BEFORE_PUNCTUATION.sub(r'\1', span.strip())
+                                unknowns[span] = replaced_span[0]
+
+    def _get_entries(self) -> List[Tuple[str, str, str, str, Optional[str]]]:
+        # (key, value, capitalised key, capitalised value, key with collapsed spaces) in label order
+        if self._entries is None:
+            self._entries = []
+            for unknowns in self.unknowns:
+                for k, v in unknowns.items():
+                    if not k:
+                        continue
+                    self._entries.append((
+                        k,
+                        v,
+                        k[0].upper() + k[1:] if k[0] == k[0].lower() else None,
+                        v[0].upper() + v[1:] if v else v,
+                        MULTIPLE_SPACES.sub(' ', k) if DOUBLE_SPACES.search(k) else None,
+                    ))
+        return self._entries
 
-    def replace_unks_on_sentence(self, sentence: str, loop_n : int = 3, empty_after : bool = False):
+    def _get_pattern(self, keys: Tuple[str, ...]) -> re.Pattern:
+        # Longest keys first, so that the alternation prefers them when keys overlap
+        pattern = self._patterns.get(keys)
+        if pattern is None:
+            pattern = re.compile('|'.join(re.escape(k) for k in sorted(keys, key=len, reverse=True)))
+            self._patterns[keys] = pattern
+        return pattern
+
+    def replace(self, sentence: str, loop_n: int = 3) -> str:
+        '''
+        Replace the <unk> tokens of a verbalisation using the labels added to this replacer.
+
+        Each key replaces one occurrence per label it was found in, as many passes as needed up to
+        loop_n in case labels are repeated. Keys made only of <unk> are left for the last pass.
+        '''
+        entries = self._get_entries()
         # Loop through in case the labels are repeated, maximum of three times
         while '<unk>' in sentence and loop_n > 0:
             loop_n -= 1
-            for unknowns in self.unknowns:
-                for k,v in unknowns.items():
-                    # Leave to replace all-unk labels at the last pass
-                    if k == '<unk>' and loop_n > 0:
-                        continue
+            replacements: Dict[str, deque] = {}
+            for k, v, capitalised_k, capitalised_v, collapsed_k in entries:
+                # Leave to replace all-unk labels at the last pass
+                if k == '<unk>' and loop_n > 0:
+                    continue
+                if k not in sentence:
                     # In case it is because the first letter of the sentence has been uppercased
-                    if not k in sentence and k[0] == k[0].lower() and k[0].upper() == sentence[0]:
-                        k = k[0].upper() + k[1:]
-                        v = v[0].upper() + v[1:]
+                    if capitalised_k is not None and sentence and capitalised_k[0] == sentence[0]:
+                        k, v = capitalised_k, capitalised_v
                     # In case it is because a double space is found where it should not be
-                    elif not k in sentence and len(re.findall(r'\s{2,}',k))>0:
-                        k = re.sub(r'\s+', ' ', k)
-                    #print(k,'/',v,'/',sentence)
-                    sentence = sentence.replace(k.strip(),v.strip(),1)
-                    #sentence = re.sub(k, v, sentence)
+                    elif collapsed_k is not None:
+                        k = collapsed_k
+                k = k.strip()
+                if k:
+                    replacements.setdefault(k, deque()).append(v.strip())
+
+            if replacements:
+                # Single scan substituting the first occurrences of every key
+                sentence = self._get_pattern(tuple(replacements)).sub(
+                    lambda match: (
+                        replacements[match[0]].popleft() if replacements[match[0]] else match[0]
+                    ),
+                    sentence
+                )
             # Removing final doublespaces
-            sentence = re.sub(r'\s+', ' ', sentence).strip()
+            sentence = MULTIPLE_SPACES.sub(' ', sentence).strip()
             # Removing spaces before punctuation
-            sentence = re.sub(r'\s([?.!",](?:\s|$))', r'\1', sentence)
-        if empty_after:
-            self.unknowns = []
+            sentence = SPACE_BEFORE_PUNCTUATION.sub(r'\1', sentence)
         return sentence
 
 if __name__ == '__main__':
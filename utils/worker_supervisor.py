@@ -0,0 +1,166 @@
+"""
+Fork-after-load pipeline workers sharing the model weights copy-on-write.
+
+With ``workers.processes`` above 1 in config.yaml, ProVeService loads the models once, freezes
+them and forks the pipeline workers, which take tasks from the queues exactly as a single worker
+does. Nothing writes to the weights after the fork, so their pages stay shared between the
+workers, and the supervisor logs the private memory of every worker to show it. Workers that die
+are restarted. On SIGTERM or SIGINT every worker finishes its current task before the supervisor
+exits, and workers still busy after ``drain_timeout`` seconds are killed.
+"""
+import gc
+import os
+import signal
+import time
+from typing import Callable, Dict
+
+import torch
+
+from utils.logger import logger
+from utils.process_memory import process_memory
+from utils.score_cache import PersistentLRUCache
+
+
+def freeze_models(models: tuple) -> None:
+    """Put the torch models of the pipeline modules in eval mode without gradients."""
+    modules = list(models)
+    modules += [module.pre_ranker.encoder for module in models if getattr(module, 'pre_ranker', None) is not None]
+    for module in modules:
+        model = getattr(module, 'model', None)
+        if isinstance(model, torch.nn.Module):
+            model.eval()
+            model.requires_grad_(False)
+
+
+def reopen_caches(models: tuple) -> None:
+    """Give a forked worker its own SQLite connections to the caches of the models."""
+    caches = {
+        id(cache): cache
+        for module in models
+        for cache in (getattr(module, 'score_cache', None), getattr(module, 'verbalisation_cache', None))
+        if isinstance(cache, PersistentLRUCache)
+    }
+    for cache in caches.values():
+        cache.connect()
+
+
+class WorkerSupervisor():
+    """
+    Forks worker processes that inherit the loaded models and keeps them running.
+
+    Args:
+        n_workers (int): Number of worker processes.
+        worker (Callable[[int], None]): Run under torch.inference_mode in each forked worker,
+            with the worker index. The worker exits when it returns.
+        restart_delay (float): Seconds before a dead worker is replaced. Defaults to 5.
+        drain_timeout (float): Seconds the workers get to finish their task after SIGTERM before
+            they are killed. Defaults to 600.
+        memory_report_interval (float): Seconds between two memory reports, 0 disables them.
+            Defaults to 600.
+
+    Attributes:
+        workers (Dict[int, int]): Worker index of every running worker pid.
+    """
+    def __init__(
+        self,
+        n_workers: int,
+        worker: Callable[[int], None],
+        restart_delay: float = 5,
+        drain_timeout: float = 600,
+        memory_report_interval: float = 600
+    ):
+        self.n_workers = n_workers
+        self.worker = worker
+        self.restart_delay = restart_delay
+        self.drain_timeout = drain_timeout
+        self.memory_report_interval = memory_report_interval
+        self.workers: Dict[int, int] = {}
+        self.draining = False
+        self.drain_deadline = None
+
+    def start_worker(self, index: int) -> None:
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = index
+            logger.info(f"Started worker {index} (pid {pid})")
+            return
+
+        exit_code = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            with torch.inference_mode():
+                self.worker(index)
+            exit_code = 0
+        except SystemExit as e:
+            exit_code = e.code if isinstance(e.code, int) else 1
+        except BaseException as e:
+            logger.fatal(f"Worker {index} failed: {e}")
+        finally:
+            for handler in logger.handlers:
+                handler.flush()
+            # Skip the exit handlers of the supervisor inherited by the fork
+            os._exit(exit_code)
+
+    def handle_shutdown(self, *args) -> None:
+        if self.draining:
+            logger.fatal("Second shutdown signal received, killing the workers")
+            self.drain_deadline = time.monotonic()
+            return
+        logger.fatal("Shutdown signal received, draining the workers...")
+        self.draining = True
+        self.drain_deadline = time.monotonic() + self.drain_timeout
+        for pid in self.workers:
+            os.kill(pid, signal.SIGTERM)
+
+    def memory_report(self) -> Dict[int, Dict[str, float]]:
+        """Log and return the memory in MB of every worker, by worker index."""
+        report = {}
+        for pid, index in sorted(self.workers.items(), key=lambda item: item[1]):
+            memory = process_memory(pid)
+            if not memory:
+                continue
+            report[index] = memory
+            logger.info(
+                f"Worker {index} (pid {pid}): RSS {memory['rss']:.0f} MB, PSS {memory['pss']:.0f} MB, "
+                f"private {memory['private_dirty']:.0f} MB"
+            )
+        return report
+
+    def run(self) -> None:
+        """Start the workers and supervise them until they have drained after a shutdown signal."""
+        if torch.cuda.is_initialized():
+            raise RuntimeError("Forked workers cannot use CUDA, load the models on CPU")
+
+        signal.signal(signal.SIGTERM, self.handle_shutdown)
+        signal.signal(signal.SIGINT, self.handle_shutdown)
+        # Keep the collector of the workers off the objects of the supervisor, so that their pages stay shared
+        gc.collect()
+        gc.freeze()
+        for index in range(self.n_workers):
+            self.start_worker(index)
+
+        next_report = time.monotonic() + self.memory_report_interval
+        while self.workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid:
+                index = self.workers.pop(pid)
+                if not self.draining:
+                    logger.error(
+                        f"Worker {index} (pid {pid}) exited with code {os.waitstatus_to_exitcode(status)}, restarting"
+                    )
+                    time.sleep(self.restart_delay)
+                    if not self.draining:
+                        self.start_worker(index)
+                continue
+
+            if self.draining and time.monotonic() >= self.drain_deadline:
+                for pid in self.workers:
+                    logger.error(f"Worker {self.workers[pid]} (pid {pid}) did not drain in time, killing it")
+                    os.kill(pid, signal.SIGKILL)
+                self.drain_deadline = float('inf')
+            if self.memory_report_interval and time.monotonic() >= next_report:
+                self.memory_report()
+                next_report = time.monotonic() + self.memory_report_interval
+            time.sleep(1)
+        logger.info("All workers stopped")